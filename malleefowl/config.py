@@ -37,3 +37,94 @@ def archive_node():
     node = node or 'default'
     node = node.lower()
     return node
+
+
+def esgf_catalog():
+    """path of the local ESGF catalog database or None if not configured."""
+    value = configuration.get_config_value("extra", "esgf_catalog")
+    return value or None
+
+
+def esgf_search_pool_size():
+    """maximum number of kept-alive connections per ESGF index node."""
+    value = configuration.get_config_value("extra", "esgf_search_pool_size")
+    return int(value or 10)
+
+
+def esgf_search_threads():
+    """number of threads used for the file and aggregation searches of a request."""
+    value = configuration.get_config_value("extra", "esgf_search_threads")
+    return int(value or 4)
+
+
+def esgf_search_timeout():
+    """seconds to wait for the response of an ESGF index node to a search query."""
+    value = configuration.get_config_value("extra", "esgf_search_timeout")
+    return float(value or 30)
+
+
+def esgf_search_rates():
+    """
+    maximum number of search queries per second for each index node.
+
+    Configured as comma separated list of ``hostname=rate`` items. A single number
+    is used for all other nodes. A rate of 0 means no limit.
+    """
+    value = configuration.get_config_value("extra", "esgf_search_rates")
+    rates = {}
+    for item in (value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            host, rate = item.split('=', 1)
+            rates[host.strip()] = float(rate)
+        else:
+            rates['default'] = float(item)
+    return rates
+
+
+def esgf_search_cache():
+    """path of the ESGF search response cache database or None if not configured."""
+    value = configuration.get_config_value("extra", "esgf_search_cache")
+    return value or None
+
+
+def esgf_search_cache_ttl():
+    """seconds until cached ESGF search responses expire."""
+    value = configuration.get_config_value("extra", "esgf_search_cache_ttl")
+    return int(value or 60)
+
+
+def credentials_path():
+    """
+    private directory of the cached MyProxy credentials.
+
+    It is created with mode 0700 and must not be below the outputpath served by the web server.
+    """
+    value = configuration.get_config_value("extra", "credentials_path")
+    return value or os.path.join(tempfile.gettempdir(), 'malleefowl-credentials')
+
+
+def credentials_margin():
+    """seconds before expiry when cached MyProxy credentials are no longer used."""
+    value = configuration.get_config_value("extra", "credentials_margin")
+    return int(value or 600)
+
+
+def credentials_refresh_margin():
+    """seconds before expiry when cached MyProxy credentials are renewed in the background."""
+    value = configuration.get_config_value("extra", "credentials_refresh_margin")
+    return int(value or 3600)
+
+
+def nc_copy_memory_budget():
+    """bytes of data held in memory by nc_copy."""
+    value = configuration.get_config_value("extra", "nc_copy_memory_budget")
+    return int(value or 64 * 1024 * 1024)
+
+
+def workflow_status_rate():
+    """maximum number of workflow status updates per second written to the PyWPS status document."""
+    value = configuration.get_config_value("extra", "workflow_status_rate")
+    return float(value or 2)
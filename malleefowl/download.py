@@ -3,48 +3,217 @@ TODO: handle parallel downloads
 """
 
 import os
+import sys
+import json
+import shutil
+import hashlib
 import urlparse
+import tempfile
 import threading
-from Queue import Queue, Empty
+from contextlib import contextmanager
+from Queue import Queue
 import subprocess
 
 from malleefowl import config
 from malleefowl.utils import esgf_archive_path
+from malleefowl.utils import nc_copy
+from malleefowl.utils import nc_concat
 from malleefowl.exceptions import ProcessFailed
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
 
-def download_with_archive(url, credentials=None):
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+@contextmanager
+def _download_lock(key):
+    """
+    Holds the lock of a download, so that concurrent requests of the same url are downloaded once.
+    The lock is removed when its last holder releases it.
+    """
+    with _locks_lock:
+        entry = _locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] = entry[1] + 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_lock:
+            entry[1] = entry[1] - 1
+            if entry[1] == 0:
+                del _locks[key]
+
+
+def is_opendap_url(url):
+    """
+    True if url is an OPeNDAP url, like the THREDDS ``dodsC`` urls of ESGF aggregations.
+    """
+    return '/dodsC/' in urlparse.urlparse(url).path
+
+
+def download_with_archive(url, credentials=None, subset=None):
     """
     Downloads file. Checks before downloading if file is already in
     local esgf archive.
     """
     file_url = esgf_archive_path(url)
     if file_url is None:
-        file_url = download(url, use_file_url=True, credentials=credentials)
+        file_url = download(url, use_file_url=True, credentials=credentials, subset=subset)
     return file_url
 
 
-def download(url, use_file_url=False, credentials=None):
+def download(url, use_file_url=False, credentials=None, subset=None):
     """
     Downloads url and returns local filename.
 
     :param url: url of file
     :param use_file_url: True if result should be a file url "file://", otherwise use system path.
     :param credentials: path to credentials if security is needed to download file
+    :param subset: dict of :func:`malleefowl.utils.nc_copy` arguments (variables, start, end, bbox)
+        used for OPeNDAP urls.
     :returns: downloaded file with either file:// or system path
     """
     import urlparse
     parsed_url = urlparse.urlparse(url)
     if parsed_url.scheme == 'file':
         result = url
+    elif is_opendap_url(url):
+        with _download_lock((url, _subset_key(subset))):
+            result = opendap(url=url, use_file_url=use_file_url, credentials=credentials, subset=subset)
     else:
-        result = wget(url=url, use_file_url=use_file_url, credentials=credentials)
+        with _download_lock((url, None)):
+            result = wget(url=url, use_file_url=use_file_url, credentials=credentials)
     return result
 
 
+def _subset_key(subset):
+    if not subset:
+        return None
+    return json.dumps(subset, sort_keys=True, default=str)
+
+
+def _link_to_cache(dn_filename, filename):
+    if not os.path.exists(filename):
+        LOGGER.debug("linking downloaded file to cache.")
+        if not os.path.isdir(os.path.dirname(filename)):
+            LOGGER.debug("Creating cache directories.")
+            os.makedirs(os.path.dirname(filename), 0700)
+        try:
+            os.link(dn_filename, filename)
+        except Exception:
+            LOGGER.warn('Could not link file, try to copy it ...')
+            from shutil import copy2
+            copy2(dn_filename, filename)
+
+
+def _write_dodsrc(credentials, workdir):
+    """
+    Writes the netcdf OPeNDAP client configuration with the credentials to ``.dodsrc`` in ``workdir``.
+    """
+    with open(os.path.join(workdir, '.dodsrc'), 'w') as fp:
+        fp.write("HTTP.COOKIEJAR={0}\n".format(os.path.join(workdir, '.dods_cookies')))
+        fp.write("HTTP.SSL.VALIDATE=0\n")
+        fp.write("HTTP.SSL.CERTIFICATE={0}\n".format(credentials))
+        fp.write("HTTP.SSL.KEY={0}\n".format(credentials))
+        fp.write("HTTP.SSL.CAINFO={0}\n".format(credentials))
+
+
+def _copy_with_credentials(url, filename, credentials, subset):
+    """
+    Runs :func:`malleefowl.utils.nc_copy` in a new python process with its own ``.dodsrc`` holding ``credentials``.
+    netcdf reads the OPeNDAP client configuration only once per process,
+    so the credentials of later requests would not be used by the server process itself.
+    The copy is not forked from the (threaded) server, which could inherit locks held by other threads.
+    """
+    workdir = tempfile.mkdtemp(prefix='dodsrc-')
+    try:
+        _write_dodsrc(credentials, workdir)
+        env = dict(os.environ)
+        env['HOME'] = workdir
+        args = dict(url=url, filename=filename, memory_budget=config.nc_copy_memory_budget(), subset=subset or {})
+        process = subprocess.Popen(
+            [sys.executable, '-c', 'from malleefowl.download import _nc_copy_main; _nc_copy_main()'],
+            cwd=workdir, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = process.communicate(json.dumps(args, default=_json_date))[0]
+        if process.returncode != 0:
+            try:
+                error = json.loads(output)['error']
+            except (ValueError, KeyError):
+                error = 'copy process ended with exit code {0}'.format(process.returncode)
+            raise Exception(error)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _json_date(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _nc_copy_main():
+    """
+    Copy process of :func:`_copy_with_credentials`: reads the ``nc_copy`` arguments as JSON from stdin
+    and writes an error as JSON to stdout. netcdf looks up the ``.dodsrc`` in the working and home directory.
+    """
+    args = json.load(sys.stdin)
+    try:
+        subset = dict((str(key), value) for key, value in args['subset'].items())
+        nc_copy(args['url'], args['filename'], resume=True, memory_budget=args['memory_budget'], **subset)
+    except Exception as e:
+        json.dump(dict(error=str(e)), sys.stdout)
+        sys.exit(1)
+
+
+def opendap(url, use_file_url=False, credentials=None, subset=None):
+    """
+    Copies an OPeNDAP dataset (like an ESGF aggregation) with :func:`malleefowl.utils.nc_copy`
+    into a local netcdf file and returns local filename.
+    Only the variables and the time and lat/lon ranges given by ``subset`` are transferred.
+    The copy is written to a partial file in the cache and renamed when it is complete,
+    so an interrupted copy is resumed by a later request.
+
+    :param url: OPeNDAP url
+    :param use_file_url: True if result should be a file url "file://", otherwise use system path.
+    :param credentials: path to credentials if security is needed to access the url
+    :param subset: dict of :func:`malleefowl.utils.nc_copy` arguments (variables, start, end, bbox).
+    :returns: netcdf file with either file:// or system path
+    """
+    LOGGER.info('copying %s', url)
+    parsed_url = urlparse.urlparse(url)
+    rel_path = os.path.join(parsed_url.netloc, parsed_url.path.strip('/'))
+    if subset:
+        rel_path = rel_path + '_' + hashlib.sha1(_subset_key(subset)).hexdigest()[:10]
+    if not rel_path.endswith('.nc'):
+        rel_path = rel_path + '.nc'
+    filename = os.path.join(config.cache_path(), rel_path)
+    # check if in cache
+    if os.path.isfile(filename):
+        LOGGER.debug("using cached file.")
+    else:
+        dn_filename = filename + '.part'
+        if not os.path.isdir(os.path.dirname(dn_filename)):
+            LOGGER.debug("Creating cache directories.")
+            os.makedirs(os.path.dirname(dn_filename), 0700)
+        try:
+            if credentials is not None:
+                LOGGER.debug('using credentials')
+                _copy_with_credentials(url, dn_filename, credentials, subset)
+            else:
+                nc_copy(url, dn_filename, resume=True, **(subset or {}))
+        except Exception as e:
+            msg = "copy failed on {0}: {1}".format(url, e)
+            LOGGER.exception(msg)
+            raise ProcessFailed(msg)
+        os.rename(dn_filename, filename)
+    if use_file_url:
+        filename = "file://" + filename
+    return filename
+
+
 def wget(url, use_file_url=False, credentials=None):
     """
     Downloads url and returns local filename.
@@ -107,26 +276,68 @@ def wget(url, use_file_url=False, credentials=None):
         LOGGER.exception(msg)
         raise ProcessFailed(msg)
 
-
-    if not os.path.exists(filename):
-        LOGGER.debug("linking downloaded file to cache.")
-        if not os.path.isdir(os.path.dirname(filename)):
-            LOGGER.debug("Creating cache directories.")
-            os.makedirs(os.path.dirname(filename), 0700)
-        try:
-            os.link(dn_filename, filename)
-        except Exception:
-            LOGGER.warn('Could not link file, try to copy it ...')
-            from shutil import copy2
-            copy2(dn_filename, filename)
+    _link_to_cache(dn_filename, filename)
     if use_file_url:
         filename = "file://" + filename
     return filename
 
 
-def download_files(urls=[], credentials=None, monitor=None):
-    dm = DownloadManager(monitor)
-    return dm.download(urls, credentials)
+def download_files(urls=[], credentials=None, monitor=None, subset=None, concat=False):
+    dm = DownloadManager(monitor, subset=subset)
+    files = dm.download(urls, credentials)
+    if concat:
+        files = concat_files(files, monitor=monitor)
+    return files
+
+
+def concat_files(files, outdir=None, monitor=None):
+    """
+    Concatenates the downloaded files of each dataset along the time dimension with
+    :func:`malleefowl.utils.nc_concat`. The files of a dataset have the same filename
+    except for the time range, like ``tas_Amon_MPI-ESM-LR_historical_r1i1p1_185001-200512.nc``.
+    Files without time range and single files are returned as they are.
+
+    :param outdir: directory of the concatenated files. Default is a directory in the cache
+        for each set of files, so the concatenation of the same files is reused.
+    :returns: list of files (file:// urls)
+    """
+    from malleefowl.esgf.search import date_from_filename
+    groups = {}
+    result = []
+    for file_url in files:
+        filename = os.path.basename(file_url)
+        if date_from_filename(filename) is None:
+            result.append(file_url)
+        else:
+            groups.setdefault(filename.rsplit('_', 1)[0], []).append(file_url)
+    for name, group in sorted(groups.items()):
+        if len(group) == 1:
+            result.extend(group)
+            continue
+        group.sort(key=lambda file_url: (date_from_filename(os.path.basename(file_url)), file_url))
+        first = os.path.basename(group[0]).rsplit('_', 1)[1][:-len('.nc')].split('-')[0]
+        last = os.path.basename(group[-1]).rsplit('_', 1)[1][:-len('.nc')].split('-')[-1]
+        if outdir is None:
+            group_dir = os.path.join(config.cache_path(), 'concat', hashlib.sha1('\n'.join(group)).hexdigest()[:10])
+        else:
+            group_dir = outdir
+        filename = os.path.join(group_dir, '{0}_{1}-{2}.nc'.format(name, first, last))
+        if outdir is not None or not os.path.isfile(filename):
+            if not os.path.isdir(group_dir):
+                os.makedirs(group_dir, 0700)
+            # the complete file is moved in place, so concurrent requests never read a partial file
+            fd, partial = tempfile.mkstemp(suffix='.part', dir=group_dir)
+            os.close(fd)
+            try:
+                nc_concat(group, partial)
+                os.rename(partial, filename)
+            except Exception:
+                os.remove(partial)
+                raise
+        result.append('file://' + filename)
+        if monitor is not None:
+            monitor('concatenated %d files to %s' % (len(group), os.path.basename(filename)), 100)
+    return result
 
 
 def download_files_from_thredds(url, recursive=False, monitor=None):
@@ -134,11 +345,42 @@ def download_files_from_thredds(url, recursive=False, monitor=None):
     return download_files(urls=threddsclient.download_urls(url), monitor=monitor)
 
 
+def search_and_download(esgsearch, credentials=None, monitor=None, search_type='File', subset=None, **search_args):
+    """
+    Runs an ESGF file search and downloads the files while the search is still running.
+    Each file found by the search is passed directly to the download threads.
+    With ``search_type='Aggregation'`` the OPeNDAP aggregations are copied (see :func:`opendap`).
+
+    :param esgsearch: :class:`malleefowl.esgf.search.ESGSearch` instance.
+    :param subset: dict of :func:`malleefowl.utils.nc_copy` arguments used for aggregations.
+    :param search_args: arguments passed to :meth:`ESGSearch.search`.
+    :returns: tuple (list of downloaded files, search summary)
+    """
+    dm = DownloadManager(monitor, subset=subset)
+    dm.start(credentials)
+    try:
+        (_, summary, _) = esgsearch.search(search_type=search_type, file_callback=dm.put, **search_args)
+    finally:
+        files = dm.join()
+    return (files, summary)
+
+
 class DownloadManager(object):
-    def __init__(self, monitor=None):
+    """
+    Downloads files with a pool of threads.
+
+    Either call :meth:`download` with a list of urls or stream urls with
+    :meth:`start`, :meth:`put` and :meth:`join`.
+
+    OPeNDAP urls are copied with ``subset`` (see :func:`opendap`).
+    """
+    def __init__(self, monitor=None, num_threads=4, subset=None):
         self.files = []
         self.count = 0
+        self.max_count = 0
         self.monitor = monitor
+        self.num_threads = num_threads
+        self.subset = subset
 
     def show_status(self, message, progress):
         if self.monitor is None:
@@ -148,25 +390,23 @@ class DownloadManager(object):
 
     # The threader thread pulls an worker from the queue and processes it
     def threader(self):
-        queue_full = True
-        while queue_full:
+        while True:
+            # gets an worker from the queue
+            worker = self.job_queue.get()
+            if worker is None:
+                self.job_queue.task_done()
+                break
             # Run the example job with the avail worker in queue (thread)
-            # TODO: handle exception ... maybe download job should stop.
             try:
-                # gets an worker from the queue
-                worker = self.job_queue.get()
                 self.download_job(**worker)
-            except Empty:
-                queue_full = False
             except Exception:
                 LOGGER.exception('download failed!')
-                queue_full = False
             finally:
                 # completed with the job
                 self.job_queue.task_done()
 
-    def download_job(self, url, credentials):
-        file_url = download_with_archive(url, credentials)
+    def download_job(self, url, credentials, subset=None):
+        file_url = download_with_archive(url, credentials, subset=subset)
         with self.result_lock:
             self.files.append(file_url)
             self.count = self.count + 1
@@ -174,20 +414,23 @@ class DownloadManager(object):
         self.show_status('Downloaded %d/%d' % (self.count, self.max_count),
                          progress)
 
-    def download(self, urls, credentials=None):
-        # start ...
+    def start(self, credentials=None, num_threads=None):
+        """
+        Starts the download threads. Urls are added with :meth:`put`.
+        """
         from datetime import datetime
-        t0 = datetime.now()
-        self.show_status("start downloading of %d files" % len(urls), 0)
+        self.t0 = datetime.now()
+        self.credentials = credentials
         # lock for parallel search
         self.result_lock = threading.Lock()
         self.files = []
         self.count = 0
-        self.max_count = len(urls)
+        self.max_count = 0
         # init threading
         self.job_queue = Queue()
-        # using max 4 thredds
-        num_threads = min(4, len(urls))
+        self.threads = []
+        if num_threads is None:
+            num_threads = self.num_threads
         LOGGER.info('starting %d download threads', num_threads)
         for x in range(num_threads):
             t = threading.Thread(target=self.threader)
@@ -195,19 +438,46 @@ class DownloadManager(object):
             t.daemon = True
             # begins, must come after daemon definition
             t.start()
-        for url in urls:
-            # fill job queue
-            self.job_queue.put(dict(url=url, credentials=credentials))
+            self.threads.append(t)
 
+    def put(self, url):
+        """
+        Adds url to the download queue.
+        """
+        with self.result_lock:
+            self.max_count = self.max_count + 1
+        # fill job queue
+        self.job_queue.put(dict(url=url, credentials=self.credentials, subset=self.subset))
+
+    def join(self):
+        """
+        Waits until all queued urls are downloaded and stops the download threads.
+
+        :returns: list of downloaded files.
+        """
         # wait until the thread terminates.
         self.job_queue.join()
+        for t in self.threads:
+            self.job_queue.put(None)
+        for t in self.threads:
+            t.join()
         # how long?
-        duration = (datetime.now() - t0).seconds
+        from datetime import datetime
+        duration = (datetime.now() - self.t0).seconds
         self.show_status(
-            "downloaded %d files in %d seconds" % (len(urls), duration), 100)
-        if len(self.files) != len(urls):
+            "downloaded %d files in %d seconds" % (self.max_count, duration), 100)
+        if len(self.files) != self.max_count:
             raise ProcessFailed(
                 "could not download all files %d/%d" %
-                (len(self.files), len(urls)))
+                (len(self.files), self.max_count))
         # done
         return self.files
+
+    def download(self, urls, credentials=None):
+        # start ...
+        self.show_status("start downloading of %d files" % len(urls), 0)
+        # using max 4 thredds
+        self.start(credentials, num_threads=min(self.num_threads, len(urls)))
+        for url in urls:
+            self.put(url)
+        return self.join()
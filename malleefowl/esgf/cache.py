@@ -0,0 +1,132 @@
+"""
+Short lived cache of ESGF search responses.
+
+Only facet count queries (``limit=0``) and queries without hits are cached.
+These are the bulk of the requests sent by user interfaces which fill their
+facet dropdowns with the ``facet_counts`` output of ``esgsearch``.
+
+The cache is a SQLite database (``esgf_search_cache`` in the ``extra`` section)
+so that it is shared by all PyWPS worker processes.
+
+Example::
+
+    $ python -m malleefowl.esgf.cache -d search_cache.db --clear
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from malleefowl import config
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT,
+    expires REAL,
+    response TEXT);
+CREATE INDEX IF NOT EXISTS responses_expires_idx ON responses (expires);
+"""
+
+
+class SearchCache(object):
+    """
+    SQLite store of search responses which expire after ``ttl`` seconds.
+
+    :param path: path of the database file.
+    :param ttl: seconds until a cached response expires.
+    """
+    def __init__(self, path, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get(self, url, key):
+        """
+        Returns the cached response for query ``key`` at index node ``url`` or None.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT response FROM responses WHERE key = ? AND expires > ?',
+                                  (url + '?' + key, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, url, key, response):
+        """
+        Stores ``response`` of query ``key`` at index node ``url`` and removes expired responses.
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE expires <= ?', (now,))
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                            (url + '?' + key, url, now + self.ttl, json.dumps(response)))
+            self.db.commit()
+
+    def clear(self, url=None):
+        """
+        Removes all cached responses, or only those of index node ``url``.
+        """
+        with self.lock:
+            if url is None:
+                self.db.execute('DELETE FROM responses')
+            else:
+                self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            self.db.commit()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def search_cache():
+    """
+    Returns the :class:`SearchCache` of this process or None if no cache is configured.
+
+    A forked worker process opens its own database connection.
+    """
+    path = config.esgf_search_cache()
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = SearchCache(path, ttl=config.esgf_search_cache_ttl())
+        return _caches[key]
+
+
+def is_cacheable(limit, response):
+    """
+    True for facet count queries and queries without hits.
+    """
+    return limit == 0 or response['response']['numFound'] == 0
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Manage the ESGF search response cache.")
+    parser.add_argument('-d', '--database', required=True, help="path of the cache database")
+    parser.add_argument('-u', '--url', help="only clear responses of this ESGF search index")
+    parser.add_argument('--clear', action='store_true', help="remove cached responses")
+    args = parser.parse_args()
+    cache = SearchCache(args.database)
+    try:
+        if args.clear:
+            cache.clear(args.url)
+    finally:
+        cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+"""
+Local mirror of ESGF search records.
+
+The harvester copies dataset and file records matching some constraints
+(like ``project:CORDEX``) from an ESGF index node into a SQLite database.
+Subsequent harvests only fetch records which have changed since the last run.
+
+:class:`CatalogConnection` answers ESGF search queries from that database.
+It can be used in place of a pyesgf ``SearchConnection``, so :class:`ESGSearch`
+returns the same ``(result, summary, facet_counts)`` tuple for local searches.
+
+Example::
+
+    $ python -m malleefowl.esgf.catalog -d catalog.db -u https://esgf-data.dkrz.de/esg-search project:CORDEX
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from pyesgf.multidict import MultiDict
+from pyesgf.search import SearchConnection
+
+from malleefowl import config
+from malleefowl.esgf.search import PooledSearchConnection
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+# record fields which are not stored as facets
+NON_FACET_FIELDS = ['id', 'url', 'title', 'description', 'xlink', 'checksum', 'checksum_type',
+                    'tracking_id', 'score', '_version_', '_timestamp', 'timestamp']
+# record fields used for the freetext search
+TEXT_FIELDS = ['id', 'title', 'description', 'variable_long_name', 'cf_standard_name']
+# query parameters which are no facet constraints.
+# start/end select the time coverage and from/to the modification time of the records.
+SYSTEM_PARAMS = ['format', 'limit', 'offset', 'distrib', 'shards', 'facets', 'fields', 'type',
+                 'query', 'latest', 'replica', 'start', 'end', 'from', 'to']
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# record types copied by a harvest
+HARVEST_TYPES = ('Dataset', 'File')
+# records needed to answer a search of each search type
+SEARCH_TYPE_RECORDS = {'Dataset': ['Dataset'], 'Summary': ['Dataset'],
+                       'File': ['Dataset', 'File'], 'Aggregation': ['Dataset', 'Aggregation']}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id TEXT PRIMARY KEY,
+    type TEXT,
+    latest INTEGER,
+    replica INTEGER,
+    datetime_start TEXT,
+    datetime_stop TEXT,
+    doc TEXT,
+    timestamp TEXT);
+CREATE TABLE IF NOT EXISTS facets (
+    id TEXT,
+    facet TEXT,
+    value TEXT);
+CREATE INDEX IF NOT EXISTS facets_value_idx ON facets (facet, value);
+CREATE INDEX IF NOT EXISTS facets_id_idx ON facets (id);
+CREATE VIRTUAL TABLE IF NOT EXISTS records_text USING fts4 (id, body);
+CREATE TABLE IF NOT EXISTS harvests (
+    url TEXT,
+    constraints TEXT,
+    timestamp TEXT,
+    search_types TEXT,
+    PRIMARY KEY (url, constraints));
+"""
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+def _as_bool(value):
+    if isinstance(value, basestring):
+        return value.lower() == 'true'
+    return bool(value)
+
+
+class Catalog(object):
+    """
+    SQLite store of ESGF search records.
+
+    :param path: path of the database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(records)')]
+        if 'timestamp' not in columns:
+            # catalogs created by older versions. Their records match from/to only after the next harvest.
+            self.db.execute('ALTER TABLE records ADD COLUMN timestamp TEXT')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(harvests)')]
+        if 'search_types' not in columns:
+            # harvests of older versions copied the default HARVEST_TYPES
+            self.db.execute('ALTER TABLE harvests ADD COLUMN search_types TEXT')
+            self.db.execute('UPDATE harvests SET search_types = ?', (json.dumps(HARVEST_TYPES),))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, docs):
+        """
+        Inserts or replaces the given solr documents.
+        """
+        with self.lock:
+            for doc in docs:
+                doc_id = doc['id']
+                self.db.execute('DELETE FROM facets WHERE id = ?', (doc_id,))
+                self.db.execute('DELETE FROM records_text WHERE id = ?', (doc_id,))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (doc_id, doc.get('type', 'Dataset'),
+                     _as_bool(doc.get('latest', True)), _as_bool(doc.get('replica', False)),
+                     doc.get('datetime_start'), doc.get('datetime_stop'),
+                     json.dumps(doc), doc.get('_timestamp')))
+                facets = []
+                for key, value in doc.items():
+                    if key in NON_FACET_FIELDS:
+                        continue
+                    for item in _as_list(value):
+                        if isinstance(item, basestring):
+                            facets.append((doc_id, key, item))
+                self.db.executemany('INSERT INTO facets VALUES (?, ?, ?)', facets)
+                text = ' '.join(unicode(item) for key in TEXT_FIELDS for item in _as_list(doc.get(key)))
+                self.db.execute('INSERT INTO records_text VALUES (?, ?)', (doc_id, text))
+            self.db.commit()
+
+    def last_harvest(self, url, constraints, search_types=HARVEST_TYPES):
+        """
+        Returns the start time of the last harvest of ``url`` with ``constraints`` which copied
+        all ``search_types`` or None.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT timestamp, search_types FROM harvests WHERE url = ? AND constraints = ?',
+                                  (url, _constraints_key(constraints))).fetchone()
+        if row is None or not set(search_types) <= set(json.loads(row[1])):
+            return None
+        return row[0]
+
+    def set_harvest(self, url, constraints, timestamp, search_types=HARVEST_TYPES):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO harvests VALUES (?, ?, ?, ?)',
+                            (url, _constraints_key(constraints), timestamp, json.dumps(list(search_types))))
+            self.db.commit()
+
+    def covers(self, url, constraints, search_type='Dataset'):
+        """
+        Returns True if the records matching ``constraints`` at index node ``url`` have been harvested.
+        This is the case if a harvest for ``url`` was done with constraints which are less or equally strict
+        and it copied the record types needed by ``search_type``.
+        """
+        requested = MultiDict(constraints).mixed()
+        needed = set(SEARCH_TYPE_RECORDS.get(search_type, [search_type]))
+        with self.lock:
+            rows = self.db.execute('SELECT constraints, search_types FROM harvests WHERE url = ?',
+                                   (url,)).fetchall()
+        for (harvest_constraints, search_types) in rows:
+            if not needed <= set(json.loads(search_types)):
+                continue
+            covered = True
+            for key, values in json.loads(harvest_constraints).items():
+                if key not in requested or not set(_as_list(requested[key])) <= set(values):
+                    covered = False
+                    break
+            if covered:
+                return True
+        return False
+
+    def query(self, query_dict, limit=None, offset=None):
+        """
+        Answers an ESGF search query with a solr json response.
+
+        Like the index node a time range (``start``/``end`` or ``from``/``to``)
+        does not match records without the corresponding time fields.
+        """
+        params = MultiDict(item for item in query_dict.items() if item[1] is not None)
+        where = ['type = ?']
+        args = [params.get('type', 'Dataset')]
+        if 'latest' in params:
+            where.append('latest = ?')
+            args.append(_as_bool(params['latest']))
+        if 'replica' in params:
+            where.append('replica = ?')
+            args.append(_as_bool(params['replica']))
+        if params.get('start'):
+            where.append('datetime_stop >= ?')
+            args.append(params['start'])
+        if params.get('end'):
+            where.append('datetime_start <= ?')
+            args.append(params['end'])
+        if params.get('from'):
+            where.append('timestamp >= ?')
+            args.append(params['from'])
+        if params.get('to'):
+            where.append('timestamp <= ?')
+            args.append(params['to'])
+        query = params.get('query')
+        if query and query not in ['*', '*:*']:
+            where.append('id IN (SELECT id FROM records_text WHERE records_text MATCH ?)')
+            args.append(query)
+        for key, values in params.dict_of_lists().items():
+            if key in SYSTEM_PARAMS:
+                continue
+            where.append('id IN (SELECT id FROM facets WHERE facet = ? AND value IN ({0}))'.format(
+                ','.join('?' * len(values))))
+            args.append(key)
+            args.extend(values)
+        where = ' AND '.join(where)
+
+        with self.lock:
+            hit_count = self.db.execute('SELECT COUNT(*) FROM records WHERE ' + where, args).fetchone()[0]
+            docs = []
+            if limit is None or limit > 0:
+                rows = self.db.execute(
+                    'SELECT doc FROM records WHERE {0} ORDER BY id LIMIT ? OFFSET ?'.format(where),
+                    args + [limit if limit is not None else -1, offset or 0])
+                docs = [json.loads(row[0]) for row in rows]
+            facet_fields = {}
+            if params.get('facets'):
+                facet_query = ('SELECT facet, value, COUNT(*) FROM facets '
+                               'WHERE id IN (SELECT id FROM records WHERE {0}) '.format(where))
+                facet_args = list(args)
+                if params['facets'] != '*':
+                    names = params['facets'].split(',')
+                    facet_query += 'AND facet IN ({0}) '.format(','.join('?' * len(names)))
+                    facet_args.extend(names)
+                for facet, value, count in self.db.execute(facet_query + 'GROUP BY facet, value', facet_args):
+                    facet_fields.setdefault(facet, []).extend([value, count])
+
+        if params.get('fields'):
+            fields = params['fields'].split(',')
+            docs = [dict((key, value) for key, value in doc.items() if key in fields) for doc in docs]
+        return {
+            'responseHeader': {'params': {}},
+            'response': {'numFound': hit_count, 'start': offset or 0, 'docs': docs},
+            'facet_counts': {'facet_fields': facet_fields},
+        }
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def local_catalog():
+    """
+    Returns the :class:`Catalog` of this process or None if no catalog is configured.
+
+    The catalog is shared by all requests. A forked worker process opens its own database connection.
+    """
+    path = config.esgf_catalog()
+    if not path:
+        return None
+    key = (os.getpid(), path)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = Catalog(path)
+        return _catalogs[key]
+
+
+def _constraints_key(constraints):
+    return json.dumps(MultiDict(constraints).dict_of_lists(), sort_keys=True)
+
+
+class CatalogConnection(SearchConnection):
+    """
+    pyesgf ``SearchConnection`` which answers search queries from a local :class:`Catalog`.
+    """
+    def __init__(self, catalog, url='catalog', distrib=False):
+        SearchConnection.__init__(self, url, distrib=distrib)
+        self.catalog = catalog
+
+    def __deepcopy__(self, memo):
+        """
+        Search contexts are deep copied by pyesgf but they must share the catalog (and its database handle).
+        """
+        return self
+
+    def send_search(self, query_dict, limit=None, offset=None, shards=None):
+        return self.catalog.query(query_dict, limit=limit, offset=offset)
+
+
+def harvest(catalog, url, constraints, search_types=HARVEST_TYPES, batch_size=500):
+    """
+    Copies all records matching ``constraints`` from index node ``url`` into ``catalog``.
+    Only records changed since the last harvest with the same constraints and search types are fetched.
+
+    :param constraints: list of (facet, value) tuples.
+    :returns: number of harvested records.
+    """
+    conn = PooledSearchConnection(url, distrib=False)
+    since = catalog.last_harvest(url, constraints, search_types)
+    started = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    LOGGER.info('harvesting %s with constraints %s since %s', url, constraints, since)
+    count = 0
+    for search_type in search_types:
+        offset = 0
+        while True:
+            query_dict = MultiDict(constraints)
+            query_dict['type'] = search_type
+            if since:
+                query_dict['from'] = since
+            response = conn.send_search(query_dict, limit=batch_size, offset=offset)
+            docs = response['response']['docs']
+            catalog.add(docs)
+            offset = offset + len(docs)
+            if not docs or offset >= response['response']['numFound']:
+                break
+        LOGGER.info('harvested %d %s records', offset, search_type)
+        count = count + offset
+    catalog.set_harvest(url, constraints, started, search_types)
+    return count
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Harvest ESGF search records into a local catalog.")
+    parser.add_argument('-d', '--database', required=True, help="path of the catalog database")
+    parser.add_argument('-u', '--url', default='https://esgf-data.dkrz.de/esg-search',
+                        help="url of the ESGF search index")
+    parser.add_argument('constraints', nargs='+', help="constraints like project:CORDEX")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    constraints = [tuple(item.strip() for item in constraint.split(':', 1)) for constraint in args.constraints]
+    catalog = Catalog(args.database)
+    try:
+        harvest(catalog, args.url, constraints)
+    finally:
+        catalog.close()
+
+
+if __name__ == '__main__':
+    main()
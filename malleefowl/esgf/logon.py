@@ -14,18 +14,42 @@ See also:
 """
 
 import os
+import errno
 import requests
 import re
+import hmac
+import shutil
+import hashlib
+import time
+import tempfile
+import threading
+from datetime import datetime, timedelta
 from lxml import etree
 from io import BytesIO
 import OpenSSL
 from dateutil import parser as date_parser
+from dateutil import tz
 
 from pyesgf.logon import LogonManager, ESGF_CREDENTIALS
 
+from malleefowl import config
+
 import logging
 logger = logging.getLogger(__name__)
 
+# (connect, read) timeout in seconds for fetching openid documents
+OPENID_TIMEOUT = (5, 10)
+# seconds a parsed openid document is cached
+OPENID_CACHE_TTL = 3600
+# file with the salted password hash next to the cached credentials
+PASSWORD_HASH = 'password.sha256'
+# pbkdf2 iterations of the password hash
+PASSWORD_ITERATIONS = 10000
+
+_openid_cache = {}
+_openid_revalidating = set()
+_openid_lock = threading.Lock()
+
 
 def myproxy_logon_with_openid(openid, password=None, interactive=False, outdir=None):
     """
@@ -42,7 +66,52 @@ def myproxy_logon_with_openid(openid, password=None, interactive=False, outdir=N
     return os.path.join(outdir, ESGF_CREDENTIALS)
 
 
-def parse_openid(openid, ssl_verify=False):
+def parse_openid(openid, ssl_verify=False, timeout=OPENID_TIMEOUT, ttl=OPENID_CACHE_TTL):
+    """
+    parse openid document to get myproxy service.
+
+    The result is cached for ``ttl`` seconds. After that the cached result is still returned
+    while the document is fetched again in the background (stale-while-revalidate).
+
+    :param timeout: tuple (connect, read) timeout in seconds.
+    :param ttl: seconds the result is cached. No caching with ``ttl=0``.
+    :returns: tuple (username, hostname, port)
+    """
+    if not ttl:
+        return _discover_openid(openid, ssl_verify, timeout)
+    with _openid_lock:
+        cached = _openid_cache.get(openid)
+        revalidate = cached is not None and time.time() - cached[0] > ttl and openid not in _openid_revalidating
+        if revalidate:
+            _openid_revalidating.add(openid)
+    if cached is None:
+        return _cache_openid(openid, _discover_openid(openid, ssl_verify, timeout))
+    if revalidate:
+        thread = threading.Thread(target=_revalidate_openid, args=(openid, ssl_verify, timeout))
+        thread.daemon = True
+        thread.start()
+    return cached[1]
+
+
+def _cache_openid(openid, result):
+    # only cache complete results
+    if result[1] is not None:
+        with _openid_lock:
+            _openid_cache[openid] = (time.time(), result)
+    return result
+
+
+def _revalidate_openid(openid, ssl_verify, timeout):
+    try:
+        _cache_openid(openid, _discover_openid(openid, ssl_verify, timeout))
+    except Exception:
+        logger.warn('could not fetch openid document %s, keep using cached result', openid)
+    finally:
+        with _openid_lock:
+            _openid_revalidating.discard(openid)
+
+
+def _discover_openid(openid, ssl_verify=False, timeout=OPENID_TIMEOUT):
     """
     parse openid document to get myproxy service
     """
@@ -51,7 +120,7 @@ def parse_openid(openid, ssl_verify=False):
     ESGF_OPENID_REXP = r'https://.*/esgf-idp/openid/(.*)'
     MYPROXY_URI_REXP = r'socket://([^:]*):?(\d+)?'
 
-    response = requests.get(openid, verify=ssl_verify)
+    response = requests.get(openid, verify=ssl_verify, timeout=timeout)
     xml = etree.parse(BytesIO(response.content))
 
     hostname = None
@@ -90,3 +159,159 @@ def cert_infos(filename):
         cert = OpenSSL.crypto.load_certificate(OpenSSL.SSL.FILETYPE_PEM, data)
         expires = date_parser.parse(cert.get_notAfter())
     return dict(expires=expires)
+
+
+class CredentialCache(object):
+    """
+    Caches MyProxy credentials per OpenID.
+
+    A certificate is reused until ``margin`` seconds before it expires.
+    Within ``refresh_margin`` seconds before expiry a new certificate is fetched
+    in a background thread while the current one is still returned.
+    Concurrent logons for the same OpenID are serialized.
+
+    The credentials are stored in the private directory ``cache_dir`` (mode 0700, one directory per OpenID),
+    so processes sharing ``cache_dir`` reuse valid certificates of each other.
+    A salted hash of the password of the last logon is stored with the credentials.
+    Cached credentials are only returned for the same password, other passwords are rejected.
+    Passwords are kept in memory to allow the background refresh.
+
+    :param logon: function ``logon(openid, password=..., outdir=...)`` returning the credentials file,
+        defaults to :func:`myproxy_logon_with_openid`.
+    """
+    def __init__(self, cache_dir, margin=600, refresh_margin=3600, logon=None):
+        self.cache_dir = cache_dir
+        _private_dir(cache_dir)
+        self.margin = timedelta(seconds=margin)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.logon = logon or myproxy_logon_with_openid
+        self.lock = threading.Lock()
+        self.user_locks = {}
+        self.passwords = {}
+        self.refreshing = set()
+
+    def _user_lock(self, openid):
+        with self.lock:
+            return self.user_locks.setdefault(openid, threading.Lock())
+
+    def _filename(self, openid):
+        return os.path.join(self.cache_dir, hashlib.sha1(openid).hexdigest(), ESGF_CREDENTIALS)
+
+    def _remaining(self, filename):
+        """time until the certificate in ``filename`` expires or None if there is none."""
+        if not os.path.isfile(filename):
+            return None
+        try:
+            expires = cert_infos(filename)['expires']
+        except Exception:
+            logger.warn('could not read certificate %s', filename)
+            return None
+        return expires - datetime.now(tz.tzutc())
+
+    def _logon(self, openid, password):
+        """runs a logon in a temporary directory and moves the credentials in place."""
+        filename = self._filename(openid)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename), 0700)
+        outdir = tempfile.mkdtemp(dir=os.path.dirname(filename))
+        try:
+            credentials = self.logon(openid, password=password, outdir=outdir)
+            _write_password_hash(os.path.join(outdir, PASSWORD_HASH), password)
+            os.rename(os.path.join(outdir, PASSWORD_HASH), os.path.join(os.path.dirname(filename), PASSWORD_HASH))
+            os.rename(credentials, filename)
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+        logger.info('new credentials for %s', openid)
+        return filename
+
+    def _refresh(self, openid):
+        try:
+            with self._user_lock(openid):
+                remaining = self._remaining(self._filename(openid))
+                if remaining is None or remaining <= self.refresh_margin:
+                    self._logon(openid, self.passwords.get(openid))
+        except Exception:
+            logger.exception('refresh of credentials for %s failed', openid)
+        finally:
+            with self.lock:
+                self.refreshing.discard(openid)
+
+    def credentials(self, openid, password):
+        """
+        Returns the path of valid credentials for ``openid``. A logon is only done
+        if there are no cached credentials or they are about to expire.
+
+        :raises Exception: if ``password`` does not match the password of the cached credentials.
+        """
+        if not password:
+            raise Exception("a password is required for the credentials of {0}".format(openid))
+        filename = self._filename(openid)
+        password_hash = os.path.join(os.path.dirname(filename), PASSWORD_HASH)
+        with self._user_lock(openid):
+            remaining = self._remaining(filename)
+            if remaining is None or remaining <= self.margin or not os.path.isfile(password_hash):
+                filename = self._logon(openid, password)
+                self.passwords[openid] = password
+                return filename
+            if not _check_password_hash(password_hash, password):
+                raise Exception("password does not match the cached credentials of {0}".format(openid))
+            self.passwords[openid] = password
+        if remaining <= self.refresh_margin:
+            with self.lock:
+                if openid in self.refreshing:
+                    return filename
+                self.refreshing.add(openid)
+            thread = threading.Thread(target=self._refresh, args=(openid,))
+            thread.daemon = True
+            thread.start()
+        return filename
+
+
+_credential_cache = None
+_credential_cache_lock = threading.Lock()
+
+
+def credential_cache():
+    """
+    Returns the process-wide :class:`CredentialCache` storing credentials in the credentials path.
+    """
+    global _credential_cache
+    with _credential_cache_lock:
+        if _credential_cache is None:
+            _credential_cache = CredentialCache(
+                config.credentials_path(),
+                margin=config.credentials_margin(),
+                refresh_margin=config.credentials_refresh_margin())
+    return _credential_cache
+
+
+def _private_dir(path):
+    """
+    Creates the directory ``path`` accessible only by the current user.
+    Raises an exception if it exists with another owner or with access for others.
+    """
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    stat = os.stat(path)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0077:
+        raise Exception("credentials directory {0} must be private to the current user (mode 0700)".format(path))
+
+
+def _password_hash(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, PASSWORD_ITERATIONS)
+
+
+def _write_password_hash(filename, password):
+    salt = os.urandom(16)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write('{0}:{1}'.format(salt.encode('hex'), _password_hash(password, salt).encode('hex')))
+
+
+def _check_password_hash(filename, password):
+    with open(filename) as fp:
+        salt, expected = fp.read().strip().split(':')
+    return hmac.compare_digest(_password_hash(password, salt.decode('hex')), expected.decode('hex'))
@@ -1,31 +1,381 @@
 from datetime import datetime
 
+import io
+import re
+import json
+import time
+import urlparse
+import itertools
 import threading
-from Queue import Queue
+from Queue import Queue, Empty
+
+import numpy as np
+import requests
+from pyesgf.search import SearchConnection
+from pyesgf.util import urlencode
+
+from malleefowl import config
+from malleefowl.esgf.cache import search_cache, is_cacheable
 
 import logging
 LOGGER = logging.getLogger("PYWPS")
 
+# time range at the end of a filename: _YYYY[MM[DD[HH[MM]]]]-YYYY[MM[DD[HH[MM]]]][-clim].nc
+FILENAME_DATE_REXP = re.compile(r'(\d{4}(?:\d\d){0,4})(?:-(\d{4}(?:\d\d){0,4}))?(?:-clim)?\.nc$')
+# padding of dates YYYY[MM[DD[HH[MM]]]] to YYYYMMDDHHMM
+DATE_PADDING = {4: '01010000', 6: '010000', 8: '0000', 10: '00', 12: ''}
+
+# number of threads used for partitioned dataset searches
+PARTITION_THREADS = 4
+
+# fields requested for file and aggregation records
+FILE_FIELDS = 'id,dataset_id,title,size,checksum,checksum_type,url'
+AGGREGATION_FIELDS = 'id,size,url'
+# number of file and aggregation records requested per query
+RECORD_BATCH_SIZE = 500
+
+
+class FileRecord(object):
+    """
+    Lightweight file record built from the raw json of a file search.
+    """
+    __slots__ = ('filename', 'dataset_id', 'size', 'checksum', 'checksum_type', 'download_url')
+
+    def __init__(self, doc):
+        self.filename = doc['title']
+        self.dataset_id = doc.get('dataset_id')
+        self.size = int(doc['size'])
+        self.checksum = _first(doc.get('checksum'))
+        self.checksum_type = _first(doc.get('checksum_type'))
+        self.download_url = service_url(doc, 'HTTPServer')
+
+
+class AggregationRecord(object):
+    """
+    Lightweight aggregation record built from the raw json of an aggregation search.
+    """
+    __slots__ = ('aggregation_id', 'size', 'opendap_url')
+
+    def __init__(self, doc):
+        self.aggregation_id = doc['id']
+        self.size = int(doc.get('size', 0))
+        self.opendap_url = service_url(doc, 'OPENDAP')
+        if self.opendap_url is not None and self.opendap_url.endswith('.html'):
+            self.opendap_url = self.opendap_url[:-5]
+
+
+def file_columns(records):
+    """
+    Converts a list of :class:`FileRecord` into columns.
+
+    :returns: dict of numpy arrays with the keys ``url``, ``size``, ``checksum``, ``checksum_type``,
+        ``dataset_id``, ``start`` and ``end``. ``start`` and ``end`` (exclusive) are the time range
+        of the filename as ``datetime64[m]`` and ``NaT`` for fixed fields.
+    """
+    start, end, fixed = filename_dates([record.filename for record in records])
+    start[fixed] = np.datetime64('NaT')
+    end[fixed] = np.datetime64('NaT')
+    return dict(
+        url=np.array([record.download_url for record in records], dtype=unicode),
+        size=np.array([record.size for record in records], dtype=np.int64),
+        checksum=np.array([record.checksum or '' for record in records], dtype=unicode),
+        checksum_type=np.array([record.checksum_type or '' for record in records], dtype=unicode),
+        dataset_id=np.array([record.dataset_id or '' for record in records], dtype=unicode),
+        start=start,
+        end=end)
+
+
+def save_file_records(records, filename, format='ndjson'):
+    """
+    Writes a list of :class:`FileRecord` in the compact formats ``ndjson`` (one json object per line)
+    or ``npz`` (numpy arrays, see :func:`file_columns`).
+    """
+    columns = file_columns(records)
+    if format == 'npz':
+        with open(filename, 'wb') as fp:
+            np.savez_compressed(fp, **columns)
+        return
+    names = sorted(columns.keys())
+    with open(filename, 'w') as fp:
+        for i in range(len(records)):
+            row = {}
+            for name in names:
+                value = columns[name][i]
+                if name in ('start', 'end'):
+                    value = None if np.isnat(value) else str(value)
+                elif name == 'size':
+                    value = int(value)
+                else:
+                    value = value or None
+                row[name] = value
+            fp.write(json.dumps(row, sort_keys=True))
+            fp.write('\n')
+
+
+def _first(values):
+    return values[0] if values else None
+
+
+def service_url(doc, service):
+    """
+    Returns the first url of ``service`` in the encoded url list (``url|mime_type|service``)
+    of a search record or None.
+    """
+    suffix = '|' + service
+    for encoded in doc.get('url', []):
+        if encoded.endswith(suffix):
+            return encoded.split('|', 1)[0]
+    return None
+
+
+def search_records(ctx, record_class, fields, batch_size=RECORD_BATCH_SIZE):
+    """
+    Pages through the raw search results of ``ctx`` and returns them as ``record_class`` instances.
+
+    Unlike ``ctx.search()`` this requests only ``fields``, skips the facet count query
+    and does not build pyesgf result objects.
+    """
+    query_dict = ctx._build_query()
+    query_dict['fields'] = fields
+    records = []
+    offset = 0
+    while True:
+        response = ctx.connection.send_search(query_dict, limit=batch_size, offset=offset, shards=ctx.shards)
+        docs = response['response']['docs']
+        records.extend(record_class(doc) for doc in docs)
+        offset = offset + len(docs)
+        if not docs or offset >= response['response']['numFound']:
+            break
+    return records
+
+
+def instance_id(doc):
+    """
+    Returns the ``instance_id`` of a dataset document, which is the same on all index nodes.
+    """
+    return doc.get('instance_id', doc['id'])
+
+
+class TokenBucket(object):
+    """
+    Limits calls to ``rate`` per second with bursts of up to ``capacity`` calls.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiters = {}
+_session = None
+_session_lock = threading.Lock()
+
+
+def rate_limiter(url):
+    """
+    Returns the process-wide :class:`TokenBucket` for the index node of ``url``
+    or None if queries to this node are not rate limited (see ``esgf_search_rates``).
+    """
+    hostname = urlparse.urlparse(url).hostname
+    with _session_lock:
+        if hostname not in _rate_limiters:
+            rates = config.esgf_search_rates()
+            rate = rates.get(hostname, rates.get('default', 0))
+            _rate_limiters[hostname] = TokenBucket(rate) if rate > 0 else None
+        return _rate_limiters[hostname]
+
+
+def http_session():
+    """
+    Returns the process-wide HTTP session used for all ESGF search queries.
+
+    The session keeps connections alive and pools them per index node
+    (``esgf_search_pool_size`` connections per node). It is shared by all threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = config.esgf_search_pool_size()
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+class PooledSearchConnection(SearchConnection):
+    """
+    pyesgf ``SearchConnection`` which sends its queries with the pooled :func:`http_session`
+    instead of opening a new connection for each query. Queries are rate limited per index node.
+
+    Facet count queries and queries without hits are answered from the :func:`search_cache` if configured.
+
+    :param timeout: seconds to wait for the response of the index node.
+        Defaults to ``esgf_search_timeout`` of the configuration.
+    """
+    def __init__(self, url, distrib=True, context_class=None, timeout=None):
+        SearchConnection.__init__(self, url, distrib=distrib, context_class=context_class)
+        self.timeout = timeout or config.esgf_search_timeout()
+
+    def send_search(self, query_dict, limit=None, offset=None, shards=None):
+        cache = search_cache()
+        if cache is None:
+            return SearchConnection.send_search(self, query_dict, limit=limit, offset=offset, shards=shards)
+        key = urlencode(sorted(self._build_query(query_dict, limit, offset, shards).items()))
+        response = cache.get(self.url, key)
+        if response is None:
+            response = SearchConnection.send_search(self, query_dict, limit=limit, offset=offset, shards=shards)
+            if is_cacheable(limit, response):
+                cache.set(self.url, key, response)
+        return response
+
+    def _send_query(self, endpoint, full_query):
+        query_url = '%s/%s?%s' % (self.url, endpoint, urlencode(full_query))
+        LOGGER.debug('Query request is %s', query_url)
+        limiter = rate_limiter(self.url)
+        if limiter is not None:
+            limiter.acquire()
+        response = http_session().get(query_url, timeout=self.timeout)
+        if response.status_code == 400:
+            errors = set(re.findall(r"Invalid HTTP query parameter=(\w+)", response.text))
+            raise Exception("Invalid query parameter(s): %s" % "; ".join(errors))
+        elif response.status_code != 200:
+            LOGGER.warn("HTTP request received error code: %s", response.status_code)
+            raise Exception("Error returned from URL: %s" % query_url)
+        return io.BytesIO(response.content)
+
+
+def run_jobs(func, jobs, num_threads, timeout=None):
+    """
+    Calls ``func(**job)`` for each job on at most ``num_threads`` threads.
+
+    :param timeout: seconds to wait for the jobs. Jobs which are not done by then
+        are abandoned and their result is ``None``.
+    :returns: list of results in the order of ``jobs``.
+    """
+    job_queue = Queue()
+    for index, job in enumerate(jobs):
+        job_queue.put((index, job))
+    results = [None] * len(jobs)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                index, job = job_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[index] = func(**job)
+            except Exception as e:
+                LOGGER.exception('Search job failed!')
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker, name='search-job-{0}'.format(i))
+               for i in range(min(num_threads, len(jobs)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for t in threads:
+        if timeout is None:
+            t.join()
+        else:
+            t.join(max(0, deadline - time.time()))
+    if errors:
+        raise errors[0]
+    return list(results)
+
 
 def date_from_filename(filename):
     """Example cordex:
     tas_EUR-44i_ECMWF-ERAINT_evaluation_r1i1p1_HMS-ALADIN52_v1_mon_200101-200812.nc
+
+    :returns: tuple (start_year, end_year) or None for fixed fields.
     """
     LOGGER.debug('filename=%s', filename)
     result = None
-    value = filename.split('.')
-    value.pop()  # remove .nc
-    value = value[-1]  # part with date
-    value = value.split('_')[-1]  # only date part
-    LOGGER.debug('date part = %s', value)
-    if value != 'fx':
-        value = value.split('-')  # split start-end
-        start_year = int(value[0][:4])  # keep only the year
-        end_year = int(value[1][:4])
-        result = (start_year, end_year)
+    mo = FILENAME_DATE_REXP.match(filename.rsplit('_', 1)[-1])
+    if mo:
+        start, end = mo.group(1), mo.group(2) or mo.group(1)
+        LOGGER.debug('date part = %s-%s', start, end)
+        result = (int(start[:4]), int(end[:4]))
     return result
 
 
+def filename_dates(filenames):
+    """
+    Parses the time ranges of a list of filenames like
+    ``tas_Amon_MPI-ESM-LR_historical_r1i1p1_185001-200512.nc``.
+    The dates may have the precision YYYY[MM[DD[HH[MM]]]].
+
+    :returns: tuple of numpy arrays ``(start, end, fixed)``. ``start`` and ``end`` are ``datetime64[m]``
+        where ``end`` is exclusive (the end of the last year, month, day, ... of the range).
+        ``fixed`` is True for files without time range (like ``fx`` files).
+    """
+    match = FILENAME_DATE_REXP.match
+    ranges = [match(filename.rsplit('_', 1)[-1]) for filename in filenames]
+    fixed = np.array([mo is None for mo in ranges], dtype=bool)
+    ranges = [mo.groups() if mo else ('1970', None) for mo in ranges]
+    starts = [start + DATE_PADDING[len(start)] for start, _ in ranges]
+    ends = [end or start for start, end in ranges]
+    end_lengths = [len(end) for end in ends]
+    ends = [end + DATE_PADDING[len(end)] for end in ends]
+    return (_parse_dates(starts), _parse_dates(ends, end_lengths), fixed)
+
+
+def _parse_dates(values, upper_lengths=None):
+    """
+    Converts padded date strings YYYYMMDDHHMM to ``datetime64[m]``.
+    With ``upper_lengths`` (the lengths of the unpadded dates) the end of the period
+    is returned, i.e. the start of the next year, month, day, hour or minute.
+    """
+    if not values:
+        return np.array([], dtype='datetime64[m]')
+    # str() since filenames from json are unicode (with 4 bytes per character in the buffer)
+    digits = (np.frombuffer(str(''.join(values)), dtype=np.uint8).reshape(-1, 12) - ord('0')).astype(np.int64)
+    year = digits[:, 0:4].dot([1000, 100, 10, 1])
+    month = digits[:, 4:6].dot([10, 1])
+    day = digits[:, 6:8].dot([10, 1])
+    hour = digits[:, 8:10].dot([10, 1])
+    minute = digits[:, 10:12].dot([10, 1])
+    months = (year - 1970) * 12 + month - 1
+    minutes = (day - 1) * 1440 + hour * 60 + minute
+    if upper_lengths is not None:
+        length = np.array(upper_lengths)
+        months = months + np.select([length == 4, length == 6], [12, 1], 0)
+        minutes = minutes + np.select([length == 8, length == 10, length == 12], [1440, 60, 1], 0)
+    return months.astype('datetime64[M]').astype('datetime64[m]') + minutes.astype('timedelta64[m]')
+
+
+def _datetime64(value):
+    if isinstance(value, basestring):
+        from dateutil import parser as date_parser
+        value = date_parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return np.datetime64(value, 'm')
+
+
 def variable_filter(constraints, variables):
     """return True if variable fulfills contraints"""
     var_types = ['variable', 'cf_standard_name', 'variable_long_name']
@@ -50,30 +400,20 @@ def variable_filter(constraints, variables):
 
 def temporal_filter(filename, start_date=None, end_date=None):
     """return True if file is in timerange start/end"""
-    # TODO: keep fixed fields fx ... see esgsearch.js
-    """
-    // fixed fields are always in time range
-    if ($.inArray("fx", doc.time_frequency) >= 0) {
-    return true;
-    }
-    """
+    return bool(temporal_filter_batch([filename], start_date, end_date)[0])
 
-    LOGGER.debug('filename=%s, start_date=%s, end_date=%s', filename, start_date, end_date)
 
+def temporal_filter_batch(filenames, start_date=None, end_date=None):
+    """
+    Checks a list of filenames against the time range start/end.
+    Fixed fields (files without time range in the filename) are always in the time range.
+
+    :returns: numpy boolean array, True for each file overlapping the time range.
+    """
     if start_date is None or end_date is None:
-        return True
-    start_end = date_from_filename(filename)
-    if start_end is None:  # fixed field
-        return True
-    start_year = start_end[0]
-    end_year = start_end[1]
-    if start_year > end_date.year:
-        LOGGER.debug('skip: %s > %s', start_year, end_date.year)
-        return False
-    if end_year < start_date.year:
-        LOGGER.debug('skip: %s < %s', end_year, start_date.year)
-        return False
-    return True
+        return np.ones(len(filenames), dtype=bool)
+    start, end, fixed = filename_dates(filenames)
+    return fixed | ((start <= _datetime64(end_date)) & (end > _datetime64(start_date)))
 
 
 class ESGSearch(object):
@@ -89,7 +429,21 @@ class ESGSearch(object):
             distrib=False,
             replica=False,
             latest=True,
-            monitor=None):
+            monitor=None,
+            timeout=30,
+            catalog=None,
+            num_threads=None):
+        """
+        :param url: url of the ESGF search index. If a list of urls is given the search is distributed
+            on the client side: all index nodes are queried concurrently (without server side distribution)
+            and the results are merged. The first url is used as the local index node.
+        :param timeout: seconds to wait for each index node in a client side distributed search.
+            It is also the timeout of each query sent to the nodes, so that jobs of abandoned nodes end.
+        :param catalog: optional local :class:`malleefowl.esgf.catalog.Catalog` with harvested records
+            of ``url``. If given all queries are answered from the catalog.
+        :param num_threads: number of threads for the file and aggregation searches.
+            Defaults to ``esgf_search_threads`` of the configuration.
+        """
         # replica is  boolean defining whether to return master records
         # or replicas, or None to return both.
         if replica is True:
@@ -106,11 +460,25 @@ class ESGSearch(object):
 
         self.monitor = monitor
 
-        from pyesgf.search import SearchConnection
-        self.conn = SearchConnection(url, distrib=distrib)
+        if isinstance(url, (list, tuple)):
+            urls = list(url)
+            url = urls.pop(0)
+            distrib = False
+        else:
+            urls = []
+        if catalog is not None:
+            from malleefowl.esgf.catalog import CatalogConnection
+            self.conn = CatalogConnection(catalog, url)
+            local_conn = self.conn
+        else:
+            node_timeout = timeout if urls else None
+            self.conn = PooledSearchConnection(url, distrib=distrib, timeout=node_timeout)
+            local_conn = PooledSearchConnection(url, distrib=False, timeout=node_timeout)
+        self.node_conns = [PooledSearchConnection(node_url, distrib=False, timeout=timeout) for node_url in urls]
+        self.timeout = timeout
+        self.num_threads = num_threads or config.esgf_search_threads()
         self.fields = 'id,instance_id,number_of_files,number_of_aggregations,size,url'
         # local context has *all* local datasets
-        local_conn = SearchConnection(url, distrib=False)
         self.local_ctx = local_conn.new_context(fields=self.fields, replica=True, latest=None)
 
     def show_status(self, message, progress):
@@ -122,8 +490,26 @@ class ESGSearch(object):
     def search(self, constraints=[('project', 'CORDEX')], query=None,
                start=None, end=None, limit=1, offset=0,
                search_type='Dataset',
-               temporal=False):
+               temporal=False,
+               partition_facet=None,
+               file_callback=None):
+        """
+        Runs the search and returns the tuple ``(result, summary, facet_counts)``.
+        The selected files of a ``File`` search are also kept in ``records`` as list of :class:`FileRecord`.
+
+        :param search_type: one of ``Dataset``, ``File``, ``Aggregation`` or ``Summary``.
+            ``Summary`` only runs a single facet query and returns no result list,
+            just the hit count and facet counts.
+        :param partition_facet: optional facet name (like ``model`` or ``institute``). If set the
+            dataset search is split into one sub-query per facet value which are run concurrently.
+            This keeps the paging depth of each sub-query low for large offsets.
+        :param file_callback: optional function called with the download url of each file
+            as soon as it is found by a ``File`` search, or with the OPeNDAP url of each
+            aggregation found by an ``Aggregation`` search.
+        """
         self.show_status("Starting ...", 0)
+        self.file_callback = file_callback
+        self.records = []
 
         from pyesgf.multidict import MultiDict
         my_constraints = MultiDict()
@@ -139,58 +525,60 @@ class ESGSearch(object):
         # TODO: check type of start, end
         LOGGER.debug('start=%s, end=%s', start, end)
 
-        ctx = None
-        if temporal is True:
-            LOGGER.debug("using dataset search with time constraints")
-            # TODO: handle timestamps in a better way
-            timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
-            if start:
-                from_timestamp = start.strftime(timestamp_format)
-            else:
-                from_timestamp = None
-            if end:
-                to_timestamp = end.strftime(timestamp_format)
-            else:
-                to_timestamp = None
-            LOGGER.debug("from=%s, to=%s", from_timestamp, to_timestamp)
-            ctx = self.conn.new_context(fields=self.fields,
-                                        replica=self.replica,
-                                        latest=self.latest,
-                                        query=query,
-                                        from_timestamp=from_timestamp,
-                                        to_timestamp=to_timestamp)
-        else:
-            ctx = self.conn.new_context(fields=self.fields,
-                                        replica=self.replica,
-                                        latest=self.latest,
-                                        query=query)
-        if len(my_constraints) > 0:
-            ctx = ctx.constrain(**my_constraints.mixed())
+        if search_type == 'Summary':
+            limit = offset = 0
 
-        LOGGER.debug('ctx: facet_constraints=%s, replica=%s, latests=%s',
-                     ctx.facet_constraints, ctx.replica, ctx.latest)
-
-        self.show_status("Datasets found=%d" % ctx.hit_count, 0)
-
-        self.summary = dict(total_number_of_datasets=ctx.hit_count,
+        # search datasets
+        # we always do this to get the summary document
+        t0 = datetime.now()
+        if self.node_conns:
+            (datasets, hit_count, facet_counts, unavailable) = self._distributed_search(
+                my_constraints, query, start, end, temporal, limit, offset)
+        else:
+            unavailable = None
+            ctx = self._context(my_constraints, query, start, end, temporal)
+            LOGGER.debug('ctx: facet_constraints=%s, replica=%s, latests=%s',
+                         ctx.facet_constraints, ctx.replica, ctx.latest)
+            hit_count = ctx.hit_count
+            facet_counts = ctx.facet_counts
+            if search_type == 'Summary':
+                datasets = []
+            elif partition_facet:
+                datasets = self._partitioned_search(ctx, my_constraints, query, start, end, temporal,
+                                                    partition_facet, limit, offset)
+            else:
+                datasets = ctx.search(ignore_facet_check=True)
+                (start_index, stop_index, _) = self._index(datasets, limit, offset)
+                datasets = [datasets[i] for i in range(start_index, stop_index)]
+
+        self.show_status("Datasets found=%d" % hit_count, 0)
+
+        if search_type == 'Summary':
+            self.result = []
+            self.summary = dict(total_number_of_datasets=hit_count,
+                                ds_search_duration_secs=(datetime.now() - t0).seconds)
+            if unavailable is not None:
+                self.summary['unavailable_index_nodes'] = unavailable
+                self.summary['total_number_of_datasets_is_approximate'] = True
+            self.show_status('Done', 100)
+            return (self.result, self.summary, facet_counts)
+
+        self.summary = dict(total_number_of_datasets=hit_count,
                             number_of_datasets=0,
                             number_of_files=0,
                             number_of_aggregations=0,
                             size=0)
+        if unavailable is not None:
+            self.summary['unavailable_index_nodes'] = unavailable
+            self.summary['total_number_of_datasets_is_approximate'] = True
 
         self.result = []
 
         self.count = 0
-        # search datasets
-        # we always do this to get the summary document
-        datasets = ctx.search(ignore_facet_check=True)
-
-        (self.start_index, self.stop_index, self.max_count) = self._index(datasets, limit, offset)
-        self.summary['number_of_datasets'] = max(0, self.max_count)
+        self.max_count = len(datasets)
+        self.summary['number_of_datasets'] = self.max_count
 
-        t0 = datetime.now()
-        for i in range(self.start_index, self.stop_index):
-            ds = datasets[i]
+        for ds in datasets:
             # progress = self.count * 100.0 / self.max_count
             self.count = self.count + 1
             self.result.append(ds.json)
@@ -218,7 +606,136 @@ class ESGSearch(object):
         LOGGER.debug('summary=%s', self.summary)
         self.show_status('Done', 100)
 
-        return (self.result, self.summary, ctx.facet_counts)
+        return (self.result, self.summary, facet_counts)
+
+    def _context(self, constraints, query=None, start=None, end=None, temporal=False, conn=None):
+        conn = conn or self.conn
+        if temporal is True:
+            LOGGER.debug("using dataset search with time constraints")
+            # TODO: handle timestamps in a better way
+            timestamp_format = '%Y-%m-%dT%H:%M:%SZ'
+            if start:
+                from_timestamp = start.strftime(timestamp_format)
+            else:
+                from_timestamp = None
+            if end:
+                to_timestamp = end.strftime(timestamp_format)
+            else:
+                to_timestamp = None
+            LOGGER.debug("from=%s, to=%s", from_timestamp, to_timestamp)
+            ctx = conn.new_context(fields=self.fields,
+                                   replica=self.replica,
+                                   latest=self.latest,
+                                   query=query,
+                                   from_timestamp=from_timestamp,
+                                   to_timestamp=to_timestamp)
+        else:
+            ctx = conn.new_context(fields=self.fields,
+                                   replica=self.replica,
+                                   latest=self.latest,
+                                   query=query)
+        if len(constraints) > 0:
+            ctx = ctx.constrain(**constraints.mixed())
+        return ctx
+
+    def _partitioned_search(self, ctx, constraints, query, start, end, temporal, facet, limit, offset):
+        """
+        Splits the dataset search into disjoint sub-queries along the values of ``facet``
+        (ordered by value) and fetches only the partitions overlapping the ``offset``/``limit`` window.
+        The partitions are queried concurrently, merged in order and deduplicated by dataset id.
+
+        The window can only be placed if every dataset has exactly one value of ``facet``.
+        Otherwise (the facet counts do not add up to the hit count) the search is not partitioned.
+        """
+        counts = ctx.facet_counts.get(facet)
+        if not counts or sum(counts.values()) != ctx.hit_count:
+            LOGGER.warn('facet %s does not partition the datasets, using unpartitioned search.', facet)
+            datasets = ctx.search(ignore_facet_check=True)
+            (start_index, stop_index, _) = self._index(datasets, limit, offset)
+            return [datasets[i] for i in range(start_index, stop_index)]
+
+        from pyesgf.multidict import MultiDict
+        jobs = []
+        first = 0
+        for value, count in sorted(counts.items()):
+            if count <= 0:
+                continue
+            lo = max(offset - first, 0)
+            hi = min(offset + limit - first, count)
+            if lo < hi:
+                part_constraints = MultiDict(item for item in constraints.items() if item[0] != facet)
+                part_constraints.add(facet, value)
+                part_ctx = self._context(part_constraints, query, start, end, temporal)
+                jobs.append(dict(ctx=part_ctx, start_index=lo, stop_index=hi))
+            first += count
+        LOGGER.debug('partitioned search on %s: %d of %d partitions selected', facet, len(jobs), len(counts))
+
+        datasets = []
+        ids = set()
+        for part in run_jobs(self._partition_job, jobs, PARTITION_THREADS):
+            for ds in part:
+                if ds.dataset_id not in ids:
+                    ids.add(ds.dataset_id)
+                    datasets.append(ds)
+        return datasets
+
+    def _distributed_search(self, constraints, query, start, end, temporal, limit, offset):
+        """
+        Queries all index nodes concurrently, each with a timeout of ``self.timeout`` seconds.
+        Datasets are deduplicated by ``instance_id`` where the local node (the first url)
+        wins over the other nodes. Each node only returns its first ``offset + limit`` datasets.
+        The hit count is the sum of the node hit counts, which is approximate because datasets
+        found on several nodes are counted more than once.
+        Nodes which fail or time out are returned as unavailable.
+        """
+        conns = [self.conn] + self.node_conns
+        jobs = [dict(ctx=self._context(constraints, query, start, end, temporal, conn=conn),
+                     stop_index=offset + limit) for conn in conns]
+        results = run_jobs(self._node_job, jobs, len(jobs), timeout=self.timeout)
+
+        datasets = []
+        instance_ids = set()
+        hit_count = 0
+        facet_counts = {}
+        unavailable = []
+        for conn, result in zip(conns, results):
+            if result is None:
+                LOGGER.warn('index node %s timed out.', conn.url)
+                unavailable.append(conn.url)
+                continue
+            elif 'error' in result:
+                LOGGER.warn('index node %s failed: %s', conn.url, result['error'])
+                unavailable.append(conn.url)
+                continue
+            hit_count = hit_count + result['hit_count']
+            for facet, counts in result['facet_counts'].items():
+                merged = facet_counts.setdefault(facet, {})
+                for value, count in counts.items():
+                    merged[value] = merged.get(value, 0) + count
+            for ds in result['datasets']:
+                ds_id = instance_id(ds.json)
+                if ds_id not in instance_ids:
+                    instance_ids.add(ds_id)
+                    datasets.append(ds)
+        return (datasets[offset:offset + limit], hit_count, facet_counts, unavailable)
+
+    def _node_job(self, ctx, stop_index):
+        try:
+            hit_count = ctx.hit_count
+            datasets = []
+            if stop_index > 0 and hit_count > 0:
+                datasets = ctx.search(ignore_facet_check=True)
+                datasets = [datasets[i] for i in range(min(stop_index, len(datasets)))]
+            return dict(hit_count=hit_count,
+                        facet_counts=ctx.facet_counts,
+                        datasets=datasets)
+        except Exception as e:
+            return dict(error=str(e))
+
+    def _partition_job(self, ctx, start_index, stop_index):
+        datasets = ctx.search(ignore_facet_check=True)
+        stop_index = min(stop_index, len(datasets))
+        return [datasets[i] for i in range(start_index, stop_index)]
 
     def _index(self, datasets, limit, offset):
         start_index = min(offset, len(datasets))
@@ -255,37 +772,32 @@ class ESGSearch(object):
                 LOGGER.info('no local replica found')
         return agg_ctx
 
-    # The threader thread pulls an worker from the queue and processes it
-    def threader(self):
-        while True:
-            # gets an worker from the queue
-            worker = self.job_queue.get()
-
-            # Run the example job with the avail worker in queue (thread)
-            try:
-                self._file_search_job(**worker)
-            except Exception:
-                LOGGER.exception('Search job failed! Could not retrieve files/aggregations.')
-            # completed with the job
-            self.job_queue.task_done()
-
-    def _file_search_job(self, f_ctx, start_date, end_date):
-        # LOGGER.debug('num files: %d', f_ctx.hit_count)
-        LOGGER.debug('facet constraints=%s', f_ctx.facet_constraints)
-        for f in f_ctx.search(ignore_facet_check=True):
-            if not temporal_filter(f.filename, start_date, end_date):
-                continue
-            with self.result_lock:
+    def _file_search_job(self, ds, constraints, start_date, end_date):
+        try:
+            f_ctx = self._file_context(ds)
+            f_ctx = f_ctx.constrain(**constraints.mixed())
+            f_ctx.freetext_constraint = "*:*"
+            LOGGER.debug('facet constraints=%s', f_ctx.facet_constraints)
+            files = search_records(f_ctx, FileRecord, FILE_FIELDS)
+        except Exception:
+            LOGGER.exception('Search job failed! Could not retrieve files.')
+            files = []
+        selected = temporal_filter_batch([f.filename for f in files], start_date, end_date)
+        with self.result_lock:
+            for f in itertools.compress(files, selected):
                 LOGGER.debug('add file %s', f.filename)
-                if f.download_url == 'null':
+                if f.download_url in (None, 'null'):
                     self.summary['number_of_invalid_files'] = self.summary['number_of_invalid_files'] + 1
                 else:
                     self.summary['number_of_selected_files'] = self.summary['number_of_selected_files'] + 1
                     self.summary['file_size'] = self.summary['file_size'] + f.size
                     self.result.append(f.download_url)
-        progress = self.count * 100.0 / self.max_count
+                    self.records.append(f)
+                    if self.file_callback is not None:
+                        self.file_callback(f.download_url)
+            self.count = self.count + 1
+            progress = self.count * 100.0 / self.max_count
         self.show_status("Dataset %d/%d" % (self.count, self.max_count), progress)
-        self.count = self.count + 1
 
     def _file_search(self, datasets, constraints, start_date, end_date):
         self.show_status("file search ...", 0)
@@ -298,32 +810,28 @@ class ESGSearch(object):
         self.result_lock = threading.Lock()
         self.result = []
         self.count = 0
-        # init threading
-        self.job_queue = Queue()
-        # using max 2 threads
-        num_threads = min(2, self.max_count)
-        for x in range(num_threads):
-            t = threading.Thread(target=self.threader)
-            # classifying as a daemon, so they will die when the main dies
-            t.daemon = True
-            # begins, must come after daemon definition
-            t.start()
-
-        for i in range(self.start_index, self.stop_index):
-            # f_ctx = datasets[i].file_context()
-            f_ctx = self._file_context(datasets[i])
-            f_ctx = f_ctx.constrain(**constraints.mixed())
-            f_ctx.freetext_constraint = "*:*"
-            # fill job queue
-            self.job_queue.put(dict(f_ctx=f_ctx, start_date=start_date, end_date=end_date))
-
-        # wait until the thread terminates.
-        self.job_queue.join()
+        jobs = [dict(ds=ds, constraints=constraints, start_date=start_date, end_date=end_date)
+                for ds in datasets]
+        run_jobs(self._file_search_job, jobs, self.num_threads)
 
         self.summary['file_search_duration_secs'] = (datetime.now() - t0).seconds
         self.summary['file_size_mb'] = self.summary['file_size'] / 1024 / 1024
         self.show_status("Files found=%d" % len(self.result), 100)
 
+    def _aggregation_search_job(self, ds, constraints):
+        agg_ctx = self._aggregation_context(ds)
+        agg_ctx = agg_ctx.constrain(**constraints.mixed())
+        agg_ctx.freetext_constrain = "*:*"
+        LOGGER.debug('facet constraints=%s', agg_ctx.facet_constraints)
+        aggregations = search_records(agg_ctx, AggregationRecord, AGGREGATION_FIELDS)
+        if not aggregations:
+            LOGGER.warn('dataset %s has no aggregations!', ds.dataset_id)
+        with self.result_lock:
+            self.count = self.count + 1
+            progress = self.count * 100.0 / self.max_count
+        self.show_status("Dataset %d/%d" % (self.count, self.max_count), progress)
+        return aggregations
+
     def _aggregation_search(self, datasets, constraints):
         self.show_status("aggregation search ...", 0)
 
@@ -333,24 +841,15 @@ class ESGSearch(object):
         self.summary['number_of_invalid_aggregations'] = 0
         self.result = []
         self.count = 0
-        for i in range(self.start_index, self.stop_index):
-            ds = datasets[i]
-            progress = self.count * 100.0 / self.max_count
-            self.show_status("Dataset %d/%d" % (self.count, self.max_count), progress)
-            self.count = self.count + 1
-            # agg_ctx = ds.aggregation_context()
-            agg_ctx = self._aggregation_context(ds)
-            agg_ctx = agg_ctx.constrain(**constraints.mixed())
-            agg_ctx.freetext_constrain = "*:*"
-            # LOGGER.debug('num aggregations: %d', agg_ctx.hit_count)
-            LOGGER.debug('facet constraints=%s', agg_ctx.facet_constraints)
-            if agg_ctx.hit_count == 0:
-                LOGGER.warn('dataset %s has no aggregations!', ds.dataset_id)
-                continue
-            for agg in agg_ctx.search(ignore_facet_check=True):
+        self.result_lock = threading.Lock()
+        jobs = [dict(ds=ds, constraints=constraints) for ds in datasets]
+        for aggregations in run_jobs(self._aggregation_search_job, jobs, self.num_threads):
+            for agg in aggregations:
                 self.summary['number_of_selected_aggregations'] = self.summary['number_of_selected_aggregations'] + 1
                 self.summary['aggregation_size'] = self.summary['aggregation_size'] + agg.size
                 self.result.append(agg.opendap_url)
+                if self.file_callback is not None and agg.opendap_url is not None:
+                    self.file_callback(agg.opendap_url)
         self.summary['agg_search_duration_secs'] = (datetime.now() - t0).seconds
         self.summary['aggregation_size_mb'] = self.summary['aggregation_size'] / 1024 / 1024
         self.show_status("Aggregations found=%d" % len(self.result), 100)
@@ -245,7 +245,7 @@ class GenericWPS(ProgressMonitorPE):
                     last_progress = progress
                     self.monitor(execution.statusMessage, progress)
 
-        self.monitor(execution.statusMessage, progress)
+        self.monitor(execution.statusMessage, progress, flush=True)
 
         # In case of success log all output value
         if execution.isSucceded():
@@ -265,7 +265,7 @@ class GenericWPS(ProgressMonitorPE):
         else:
             self.monitor('\n'.join(
                 ['ERROR: {0.text} code={0.code} locator={0.locator})'.
-                    format(ex) for ex in execution.errors]), progress)
+                    format(ex) for ex in execution.errors]), progress, flush=True)
 
     def get_output_datatype(self, output):
         """
@@ -422,7 +422,7 @@ class ParallelGenericWPS(GenericWPS):
         """
         return None
 
-    def monitor(self, message, progress=None, task_name=None):
+    def monitor(self, message, progress=None, task_name=None, verbose=False, flush=False):
         """
         Override TaskPE monitor function. See TaskPE.monitor for details.
         Add the process and data id to the task name.
@@ -432,7 +432,7 @@ class ParallelGenericWPS(GenericWPS):
             task_name = '{name}-proc{proc}-data{data}'.format(name=self.name,
                                                               proc='' if self.rank is None else self.rank,
                                                               data='' if map_idx is None else map_idx)
-        GenericWPS.monitor(self, message, progress=progress, task_name=task_name)
+        GenericWPS.monitor(self, message, progress=progress, task_name=task_name, verbose=verbose, flush=flush)
 
     def save_result(self, result):
         """
@@ -1,14 +1,17 @@
 import sys
 import json
 import copy
-from multiprocessing import Manager
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+import numpy as np
 
 from pywps import LiteralOutput, ComplexOutput, BoundingBoxOutput
 from pywps import ComplexInput
 from pywps import Format, get_format
 from owslib.wps import Input, Output
 
-from malleefowl.utils import DataWrapper, auto_list
+from malleefowl.utils import DataWrapper
 from malleefowl.pe.task import TaskPE
 from malleefowl.pe.generic_wps import ParallelGenericWPS
 from malleefowl.exceptions import WorkflowException
@@ -16,10 +19,42 @@ from malleefowl.exceptions import WorkflowException
 
 class ProgressList:
     """
-    Simple list to track the progress of each execution threads inside a parallel group that is shared by each tasks
+    Progress board to track the progress of each execution threads inside a parallel group that is shared by each tasks
+
+    The board is a fixed-size array in shared memory which is allocated once per group and inherited by the
+    forked task processes. Each execution thread writes its own slot without lock and the average is computed
+    directly from the shared memory. Map indexes beyond the board size share a slot.
     """
-    def __init__(self):
-        self.list = auto_list(Manager().list(), default_val=0)
+    # number of slots of the board
+    SIZE = 65536
+
+    def __init__(self, size=SIZE):
+        self.slots = RawArray('d', size)
+        self.length = RawValue('l', 0)
+        self.lock = Lock()
+
+    def set(self, index, progress, default=0):
+        """
+        Set the progress of the execution thread ``index``. The slots of new execution threads before ``index``
+        are set to ``default``.
+        """
+        index = index % len(self.slots)
+        if index >= self.length.value:
+            with self.lock:
+                length = self.length.value
+                if index >= length:
+                    self.slots[length:index + 1] = [default] * (index + 1 - length)
+                    self.length.value = index + 1
+        self.slots[index] = progress
+
+    def average(self):
+        """
+        Return the average progress of the execution threads
+        """
+        length = self.length.value
+        if length == 0:
+            return 0
+        return int(np.frombuffer(self.slots, dtype='f8', count=length).sum() / length)
 
     def __deepcopy__(self, memo):
         """
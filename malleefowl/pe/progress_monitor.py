@@ -53,9 +53,8 @@ class RangeGroupProgress(RangeProgress):
         :param percent_completed: Task progress [0-100]
         :return: The global progress
         """
-        self.progress_list.list.resize(self.map_idx + 1, self._start)
-        self.progress_list.list[self.map_idx] = RangeProgress.progress(self, percent_completed)
-        return sum(self.progress_list.list) / len(self.progress_list.list)
+        self.progress_list.set(self.map_idx, RangeProgress.progress(self, percent_completed), default=self._start)
+        return self.progress_list.average()
 
 
 class ProgressMonitorPE(TaskPE):
@@ -53,17 +53,21 @@ class TaskPE(GenericPE):
         # External monitor (not to be used directly)
         self._monitor = monitor
 
-    def monitor(self, message, progress=None, task_name=None):
+    def monitor(self, message, progress=None, task_name=None, verbose=False, flush=False):
         """
         Monitoring function to signal progress or status changes
         :param message: message to set into PyWPS
         :param progress: new progress
         :param task_name: current task name (could be decorated when the same task is executed concurrently)
+        :param verbose: detailed message which is only written to the log
+        :param flush: final or error state which is sent to PyWPS immediately
         """
         if self._monitor:
             self._monitor.update_status("{name}: {msg}".format(name=task_name or self.name,
                                                                msg=message),
-                                        progress)
+                                        progress,
+                                        verbose=verbose,
+                                        flush=flush)
         else:
             logger.info('STATUS (%s%s) - %s',
                         task_name or self.name,
@@ -243,7 +247,8 @@ class TaskPE(GenericPE):
                 self.monitor('{name} is sending value - [{headers}] {key}:{val}'.format(name=self.name,
                                                                                         headers=data_headers,
                                                                                         key=key,
-                                                                                        val=value))
+                                                                                        val=value),
+                             verbose=True)
                 self.write(key, DataWrapper(payload=value, headers=data_headers))
 
     def _read_inputs(self, inputs):
@@ -272,7 +277,8 @@ class TaskPE(GenericPE):
                     self.monitor('{name} is reading value - [{headers}] {key}:{val}'.format(name=self.name,
                                                                                             headers=inputs[key].headers,
                                                                                             key=key,
-                                                                                            val=value))
+                                                                                            val=value),
+                                 verbose=True)
                     yield (key, value)
 
     @staticmethod
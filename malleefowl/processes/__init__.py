@@ -1,4 +1,5 @@
 from .wps_esgsearch import ESGSearchProcess
+from .wps_esgsearch_download import ESGSearchDownload
 from .wps_download import Download
 from .wps_thredds import ThreddsDownload
 from .wps_workflow import DispelWorkflow
@@ -6,6 +7,7 @@ from .wps_custom_workflow import DispelCustomWorkflow
 
 processes = [
     ESGSearchProcess(),
+    ESGSearchDownload(),
     Download(),
     ThreddsDownload(),
     DispelWorkflow(),
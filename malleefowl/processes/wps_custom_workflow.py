@@ -1,5 +1,9 @@
 import json
+import time
 import traceback
+import threading
+import multiprocessing
+from Queue import Empty
 from datetime import datetime
 
 from pywps import Process
@@ -7,8 +11,8 @@ from pywps import ComplexInput
 from pywps import ComplexOutput
 from pywps import Format
 from pywps.app.Common import Metadata
-from multiprocessing import Manager
 
+from malleefowl import config
 from malleefowl.custom_workflow import run
 from malleefowl.utils import Monitor
 from malleefowl.exceptions import WorkflowException
@@ -17,7 +21,170 @@ import logging
 logger = logging.getLogger("PYWPS")
 
 
-class DispelCustomWorkflow(Process, Monitor):
+class WorkflowCollector(Monitor):
+    """
+    Collect the status, log, exceptions and task results of one workflow execution
+
+    The workflow tasks run in their own processes and only put messages on a queue. A thread of the process
+    running the workflow consumes the queue, owns all the state and appends the log lines in batches to the log file.
+
+    Status updates are coalesced: at most ``status_rate`` updates per second are sent to the PyWPS response
+    (which rewrites the status document) and the latest pending update is sent when the interval is over.
+    Verbose messages are only written to the log. Final and error states are sent immediately.
+    """
+
+    # Maximum number of queued messages handled at once
+    BATCH_SIZE = 100
+
+    def __init__(self, response, logfile, status_rate=None):
+        """
+        :param response: PyWPS response receiving the status updates
+        :param logfile: Path of the log file
+        :param status_rate: Maximum number of status updates per second (default from the configuration)
+        """
+        Monitor.__init__(self)
+        self.response = response
+        self.logfile = logfile
+        self.queue = multiprocessing.Queue()
+        self.full_log = []
+        self.exceptions_list = []
+        self.result_summary = {}
+        self.progress = 0
+        self.thread = None
+        self.status_interval = 1.0 / (status_rate or config.workflow_status_rate())
+        self.status_sent = 0
+        self.pending_status = None
+
+    def start(self):
+        """
+        Start the collecting thread. Must be called before the workflow processes are started
+        """
+        open(self.logfile, 'w').close()
+        self.thread = threading.Thread(target=self._collect)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """
+        Handle the remaining messages and stop the collecting thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def update_status(self, message, progress=None, verbose=False, flush=False):
+        """
+        Implement malleefowl.utils.Monitor.update_status function. See Monitor.update_status for details
+        """
+        self.queue.put(('status', datetime.now().strftime('%H:%M:%S'), message, progress, verbose, flush))
+
+    def raise_exception(self, exception):
+        """
+        Implement malleefowl.utils.Monitor.raise_exception function. See Monitor.raise_exception for details
+        """
+        self.queue.put(('exception', traceback.format_exc()))
+
+    def save_task_result(self, task, result):
+        """
+        Implement malleefowl.utils.Monitor.save_task_result function. See Monitor.save_task_result for details
+        """
+        self.queue.put(('result', task, result))
+
+    def log(self, text):
+        """
+        Append text to the log
+        """
+        self.queue.put(('log', text))
+
+    def write_log(self, lines):
+        """
+        Append lines to the log and the log file
+        """
+        self.full_log.extend(lines)
+        with open(self.logfile, 'a') as fp:
+            fp.write(''.join(line + '\n' for line in lines))
+
+    def summary(self):
+        """
+        Format the summary for a better looking
+        """
+        ordered_task = sorted(self.result_summary.items(), key=lambda x: x[1]['execution_order'])
+
+        return [{task[0]: sorted(task[1]['processes'], key=lambda x: x.get('data_id', 0))} for task in ordered_task]
+
+    def _collect(self):
+        """
+        Consume the queue until the closing message
+        """
+        done = False
+        while not done:
+            try:
+                if self.pending_status is None:
+                    messages = [self.queue.get()]
+                else:
+                    messages = [self.queue.get(timeout=max(0, self.status_sent + self.status_interval - time.time()))]
+            except Empty:
+                self._send_status()
+                continue
+            try:
+                while len(messages) < self.BATCH_SIZE:
+                    messages.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            lines = []
+            for message in messages:
+                if message is None:
+                    done = True
+                    continue
+                try:
+                    lines.extend(getattr(self, '_on_' + message[0])(*message[1:]))
+                except Exception:
+                    logger.exception('cannot handle workflow message %s', message[0])
+            if lines:
+                self.write_log(lines)
+            if done or time.time() >= self.status_sent + self.status_interval:
+                self._send_status()
+
+    def _send_status(self):
+        """
+        Send the pending status update to the PyWPS response
+        """
+        if self.pending_status is not None:
+            self.response.update_status(*self.pending_status)
+            self.pending_status = None
+            self.status_sent = time.time()
+
+    def _on_status(self, timestamp, message, progress, verbose=False, flush=False):
+        if not progress:
+            progress = self.progress
+        else:
+            self.progress = progress
+
+        logger.debug('{progress:>4}%: {msg}'.format(progress=progress, msg=message))
+
+        if not verbose:
+            self.pending_status = (message, progress)
+            if flush or progress >= 100 or time.time() >= self.status_sent + self.status_interval:
+                self._send_status()
+        return ['{timestamp}{progress:>4}%: {msg}'.format(timestamp=timestamp, progress=progress, msg=message)]
+
+    def _on_log(self, text):
+        return [text]
+
+    def _on_exception(self, text):
+        self.exceptions_list.append(text)
+        self._send_status()
+        return []
+
+    def _on_result(self, task, result):
+        if task in self.result_summary:
+            self.result_summary[task]['processes'].append(result)
+        else:
+            self.result_summary[task] = dict(execution_order=len(self.result_summary) + 1,
+                                             processes=[result, ])
+        return []
+
+
+class DispelCustomWorkflow(Process):
     """
     Implement a PyWPS process for executing custom workflow
     """
@@ -57,11 +224,6 @@ class DispelCustomWorkflow(Process, Monitor):
             status_supported=True,
             store_supported=True,
         )
-        synch = Manager()
-        self.full_log = synch.list()
-        self.overall_progress = synch.dict()
-        self.exceptions_list = synch.list()
-        self.result_summary = synch.dict()
 
     def _handler(self, request, response):
         """
@@ -70,109 +232,60 @@ class DispelCustomWorkflow(Process, Monitor):
         :param response:
         :return:
         """
-        # Reset and preparation
-        del self.full_log[:]
-        del self.exceptions_list[:]
-        self.result_summary.clear()
-        self.overall_progress['progress'] = 0
-        self.response = response
-        self.update_status("starting workflow ...", 0)
+        # The collector gathers the status and results of this execution
+        collector = WorkflowCollector(response, 'logfile.txt')
+        collector.start()
+        try:
+            collector.update_status("starting workflow ...", 0)
 
-        # Load the workflow
-        workflow = json.load(request.inputs['workflow'][0].stream)
-        workflow_name = workflow.get('name', 'unknown')
-        self.update_status("workflow {0} prepared:".format(workflow_name), 0)
-        self.full_log.append(json.dumps(workflow,
-                                        indent=4,
-                                        separators=(',', ': ')))
+            # Load the workflow
+            workflow = json.load(request.inputs['workflow'][0].stream)
+            workflow_name = workflow.get('name', 'unknown')
+            collector.update_status("workflow {0} prepared:".format(workflow_name), 0)
+            collector.log(json.dumps(workflow,
+                                     indent=4,
+                                     separators=(',', ': ')))
 
-        # Prepare headers
-        headers = {}
-        if 'X-X509-User-Proxy' in request.http_request.headers:
-            headers['X-X509-User-Proxy'] = request.http_request.headers['X-X509-User-Proxy']
-        if 'Access-Token' in request.http_request.headers:
-            headers['Access-Token'] = request.http_request.headers['Access-Token']
+            # Prepare headers
+            headers = {}
+            if 'X-X509-User-Proxy' in request.http_request.headers:
+                headers['X-X509-User-Proxy'] = request.http_request.headers['X-X509-User-Proxy']
+            if 'Access-Token' in request.http_request.headers:
+                headers['Access-Token'] = request.http_request.headers['Access-Token']
 
-        # Run the workflow
-        try:
-            run(workflow, monitor=self, headers=headers)
-            self.update_status("workflow {0} done.".format(workflow_name), 100)
-
-            formatted_summary = self._format_summary()
-            self.full_log.append('Workflow result:')
-            self.full_log.append(json.dumps(formatted_summary,
-                                            indent=4,
-                                            separators=(',', ': '),
-                                            sort_keys=True))
-        except Exception as e:
-            formatted_summary = None
-            self.raise_exception(e)
+            # Run the workflow
+            try:
+                run(workflow, monitor=collector, headers=headers)
+                collector.update_status("workflow {0} done.".format(workflow_name), 100)
+            except Exception as e:
+                collector.raise_exception(e)
+        finally:
+            collector.close()
 
         # Handle exceptions (if any)
-        if len(self.exceptions_list) > 0:
+        if len(collector.exceptions_list) > 0:
             full_msg = ('\nCatch {nb_e} exception(s) while running the workflow:\n'
                         '{exceptions}\n\n'
                         'Execution log:\n{log}').format(
-                nb_e=len(self.exceptions_list),
-                exceptions='\n'.join(self.exceptions_list),
-                log='\n'.join(self.full_log))
+                nb_e=len(collector.exceptions_list),
+                exceptions='\n'.join(collector.exceptions_list),
+                log='\n'.join(collector.full_log))
 
             # Augment the exception message by appending the full log but conserve the full exception stack
             raise WorkflowException(full_msg)
 
+        formatted_summary = collector.summary()
+        collector.write_log(['Workflow result:',
+                             json.dumps(formatted_summary,
+                                        indent=4,
+                                        separators=(',', ': '),
+                                        sort_keys=True)])
+
         # Send result
-        with open('logfile.txt', 'w') as fp:
-            fp.write('\n'.join(self.full_log))
-            response.outputs['logfile'].file = fp.name
+        response.outputs['logfile'].file = collector.logfile
 
         with open('output.json', 'w') as fp:
             fp.write(json.dumps(formatted_summary, sort_keys=True))
             response.outputs['output'].file = fp.name
 
         return response
-
-    def update_status(self, message, progress=None):
-        """
-        Implement malleefowl.utils.Monitor.update_status function. See Monitor.update_status for details
-        """
-        if not progress:
-            progress = self.overall_progress['progress']
-        else:
-            self.overall_progress['progress'] = progress
-
-        logger.debug('{progress:>4}%: {msg}'.format(progress=progress, msg=message))
-
-        log = '{timestamp}{progress:>4}%: {msg}'.format(
-            timestamp=datetime.now().strftime('%H:%M:%S'),
-            progress=progress,
-            msg=message)
-
-        self.response.update_status(message, progress)
-        self.full_log.append(log)
-
-    def raise_exception(self, exception):
-        """
-        Implement malleefowl.utils.Monitor.raise_exception function. See Monitor.raise_exception for details
-        """
-        self.exceptions_list.append(traceback.format_exc())
-
-    def save_task_result(self, task, result):
-        """
-        Implement malleefowl.utils.Monitor.save_task_result function. See Monitor.save_task_result for details
-        """
-        if task in self.result_summary:
-            task_result = self.result_summary[task]
-            task_result['processes'].append(result)
-            self.result_summary.update({task: task_result})
-        else:
-            result.update()
-            self.result_summary.update({task: dict(execution_order=len(self.result_summary) + 1,
-                                                   processes=[result, ])})
-
-    def _format_summary(self):
-        """
-        Format the summary for a better looking
-        """
-        ordered_task = sorted(self.result_summary.items(), key=lambda x: x[1]['execution_order'])
-
-        return [{task[0]: sorted(task[1]['processes'], key=lambda x: x.get('data_id', 0))} for task in ordered_task]
@@ -14,6 +14,25 @@ import logging
 LOGGER = logging.getLogger("PYWPS")
 
 
+def parse_subset(request):
+    """
+    Reads the variable, start, end and bbox inputs of a request.
+
+    :returns: dict of :func:`malleefowl.utils.nc_copy` arguments or None.
+    """
+    subset = {}
+    if 'variable' in request.inputs:
+        subset['variables'] = [inpt.data for inpt in request.inputs['variable']]
+    for name in ['start', 'end']:
+        if name in request.inputs:
+            subset[name] = request.inputs[name][0].data
+    if 'bbox' in request.inputs:
+        subset['bbox'] = tuple(float(value) for value in request.inputs['bbox'][0].data.split(','))
+        if len(subset['bbox']) != 4:
+            raise ValueError("bbox needs four values: min_lon,min_lat,max_lon,max_lat")
+    return subset or None
+
+
 class Download(Process):
     """
     The download process gets as input a list of URLs pointing to NetCDF files
@@ -25,6 +44,9 @@ class Download(Process):
 
     The downloader does not download files if they are already in the
     ESGF archive or in the local cache.
+
+    OPeNDAP URLs (like ESGF aggregations) are copied into local NetCDF files.
+    Only the requested variables, time range and bounding box are transferred.
     """
 
     def __init__(self):
@@ -35,6 +57,39 @@ class Download(Process):
                          min_occurs=1,
                          max_occurs=1024,
                          ),
+            LiteralInput('variable', 'Variable',
+                         data_type='string',
+                         abstract="Variable copied from OPeNDAP URLs. Default are all variables.",
+                         min_occurs=0,
+                         max_occurs=100,
+                         ),
+            LiteralInput('start', 'Start',
+                         data_type='dateTime',
+                         abstract="Start of the time range copied from OPeNDAP URLs: 2000-01-11T12:00:00Z",
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+            LiteralInput('end', 'End',
+                         data_type='dateTime',
+                         abstract="End of the time range copied from OPeNDAP URLs: 2005-12-31T12:00:00Z",
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+            LiteralInput('bbox', 'Bounding Box',
+                         data_type='string',
+                         abstract="Region copied from OPeNDAP URLs: min_lon,min_lat,max_lon,max_lat."
+                                  " Example: -10,35,30,70",
+                         min_occurs=0,
+                         max_occurs=1,
+                         ),
+            LiteralInput('concat', 'Concatenate',
+                         data_type='boolean',
+                         abstract="If flag is set then the files of each dataset are concatenated"
+                                  " along the time dimension into one file.",
+                         min_occurs=0,
+                         max_occurs=1,
+                         default='0',
+                         ),
         ]
         outputs = [
             ComplexOutput('output', 'Downloaded files',
@@ -47,7 +102,7 @@ class Download(Process):
             self._handler,
             identifier="download",
             title="Download files",
-            version="0.9",
+            version="0.10",
             abstract="Downloads files and provides file list as json document.",
             metadata=[
                 Metadata('Birdhouse', 'http://bird-house.github.io/'),
@@ -72,6 +127,10 @@ class Download(Process):
             credentials = None
             LOGGER.debug('Using no credentials')
 
+        concat = False
+        if 'concat' in request.inputs:
+            concat = request.inputs['concat'][0].data
+
         def monitor(msg, progress):
             LOGGER.info("%s - (%d/100)", msg, progress)
             # response.update_status(msg, progress)
@@ -79,7 +138,9 @@ class Download(Process):
         files = download_files(
             urls=urls,
             credentials=credentials,
-            monitor=monitor)
+            monitor=monitor,
+            subset=parse_subset(request),
+            concat=concat)
 
         with open('out.json', 'w') as fp:
             json.dump(obj=files, fp=fp, indent=4, sort_keys=True)
@@ -11,10 +11,176 @@ from pywps import Format, FORMATS
 from pywps.app.Common import Metadata
 
 from malleefowl.esgf.search import ESGSearch
+from malleefowl.esgf.search import save_file_records
+from malleefowl.esgf.catalog import local_catalog
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
+NDJSON_FORMAT = Format('application/x-ndjson', extension='.ndjson')
+NPZ_FORMAT = Format('application/x-npz', extension='.npz')
+
+
+def search_inputs():
+    """
+    Returns the search inputs shared by the ESGF search processes.
+    """
+    return [
+        LiteralInput('url', 'URL',
+                     data_type='string',
+                     abstract="URL of ESGF Search Index which is used for search queries."
+                              " Example: http://esgf-data.dkrz.de/esg-search."
+                              " If several URLs are given then the index nodes are queried concurrently"
+                              " and the results are merged. The first URL is used as local index node.",
+                     min_occurs=1,
+                     max_occurs=10,
+                     default="http://esgf-data.dkrz.de/esg-search",
+                     ),
+        LiteralInput('distrib', 'Distributed',
+                     data_type='boolean',
+                     abstract="If flag is set then a distributed search will be run.",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='0',
+                     ),
+        LiteralInput('replica', 'Replica',
+                     data_type='boolean',
+                     abstract="If flag is set then search will include replicated datasets.",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='False',
+                     ),
+        LiteralInput('latest', 'Latest',
+                     data_type='boolean',
+                     abstract="If flag is set then search will include only latest datasets.",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='True',
+                     ),
+        LiteralInput('temporal', 'Temporal',
+                     data_type='boolean',
+                     abstract="If flag is set then search will use temporal filter.",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='1',
+                     ),
+        LiteralInput('constraints', 'Constraints',
+                     data_type='string',
+                     abstract="Constraints as list of key/value pairs."
+                              "Example: project:CORDEX, time_frequency:mon, variable:tas",
+                     min_occurs=1,
+                     max_occurs=1,
+                     default="project:CORDEX, time_frequency:mon, variable:tas",
+                     ),
+        LiteralInput('query', 'Query',
+                     data_type='string',
+                     abstract="Freetext query. For Example: temperatue",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='*',
+                     ),
+        LiteralInput('start', 'Start',
+                     data_type='dateTime',
+                     abstract="Startime: 2000-01-11T12:00:00Z",
+                     min_occurs=0,
+                     max_occurs=1,
+                     ),
+        LiteralInput('end', 'End',
+                     data_type='dateTime',
+                     abstract="Endtime: 2005-12-31T12:00:00Z",
+                     min_occurs=0,
+                     max_occurs=1,
+                     ),
+        LiteralInput('limit', 'Limit',
+                     data_type='integer',
+                     abstract="Maximum number of datasets in search result",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='10',
+                     allowed_values=[0, 1, 2, 5, 10, 20, 50, 100, 200]
+                     ),
+        LiteralInput('offset', 'Offset',
+                     data_type='integer',
+                     abstract="Start search of datasets at offset.",
+                     min_occurs=0,
+                     max_occurs=1,
+                     default='0',
+                     ),
+    ]
+
+
+def parse_search_request(request, search_type='Dataset'):
+    """
+    Reads the search inputs of a request.
+
+    The local catalog is only used for a search of ``search_type`` on a single index node
+    without distributed search, and if the catalog has harvested the records needed for it.
+
+    :returns: tuple (:class:`ESGSearch` instance, dict of search arguments)
+    """
+    distrib = False
+    if 'distrib' in request.inputs:
+        distrib = request.inputs['distrib'][0].data
+    replica = False
+    if 'replica' in request.inputs:
+        replica = request.inputs['replica'][0].data
+    latest = True
+    if 'latest' in request.inputs:
+        latest = request.inputs['latest'][0].data
+    constrains_str = request.inputs['constraints'][0].data.strip()
+    constraints = []
+    for constrain in constrains_str.split(','):
+        key, value = constrain.split(':')
+        constraints.append((key.strip(), value.strip()))
+
+    urls = [inpt.data for inpt in request.inputs['url']]
+    # the catalog only has the harvested records of the index node itself
+    catalog = local_catalog() if len(urls) == 1 and not distrib else None
+    if catalog is not None:
+        if catalog.covers(urls[0], constraints, search_type):
+            LOGGER.info('using local catalog %s', catalog.path)
+        else:
+            catalog = None
+    esgsearch = ESGSearch(
+        url=urls if len(urls) > 1 else urls[0],
+        distrib=distrib,
+        replica=replica,
+        latest=latest,
+        catalog=catalog,
+    )
+
+    if 'start' in request.inputs:
+        start = request.inputs['start'][0].data
+    else:
+        start = None
+    if 'end' in request.inputs:
+        end = request.inputs['end'][0].data
+    else:
+        end = None
+    if 'offset' in request.inputs:
+        offset = request.inputs['offset'][0].data
+    else:
+        offset = 0
+    if 'limit' in request.inputs:
+        limit = request.inputs['limit'][0].data
+    else:
+        limit = 10
+    if 'query' in request.inputs:
+        query = request.inputs['query'][0].data
+    else:
+        query = '*'
+    temporal = True
+    if 'temporal' in request.inputs:
+        temporal = request.inputs['temporal'][0].data
+    search_args = dict(
+        constraints=constraints,
+        query=query,
+        start=start, end=end,
+        limit=limit,
+        offset=offset,
+        temporal=temporal)
+    return (esgsearch, search_args)
+
 
 class ESGSearchProcess(Process):
     """
@@ -28,103 +194,42 @@ class ESGSearchProcess(Process):
 
     The result is a JSON document with a list of ``http://`` URLs to files on ESGF data nodes.
 
+    If a local catalog is configured (``esgf_catalog`` in the ``extra`` section) and it has harvested
+    the requested index node with matching constraints and record types then a non-distributed search
+    is answered from the catalog.
+
     TODO: bbox constraint for datasets
     """
     def __init__(self):
-        inputs = [
-            LiteralInput('url', 'URL',
-                         data_type='string',
-                         abstract="URL of ESGF Search Index which is used for search queries."
-                                  " Example: http://esgf-data.dkrz.de/esg-search",
-                         min_occurs=1,
-                         max_occurs=1,
-                         default="http://esgf-data.dkrz.de/esg-search",
-                         ),
-            LiteralInput('distrib', 'Distributed',
-                         data_type='boolean',
-                         abstract="If flag is set then a distributed search will be run.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='0',
-                         ),
-            LiteralInput('replica', 'Replica',
-                         data_type='boolean',
-                         abstract="If flag is set then search will include replicated datasets.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='False',
-                         ),
-            LiteralInput('latest', 'Latest',
-                         data_type='boolean',
-                         abstract="If flag is set then search will include only latest datasets.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='True',
-                         ),
-            LiteralInput('temporal', 'Temporal',
-                         data_type='boolean',
-                         abstract="If flag is set then search will use temporal filter.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='1',
-                         ),
-            LiteralInput('search_type', 'Search Type',
-                         data_type='string',
-                         abstract="Search on Datasets, Files or Aggregations.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='Dataset',
-                         allowed_values=['Dataset', 'File', 'Aggregation']
-                         ),
-            LiteralInput('constraints', 'Constraints',
-                         data_type='string',
-                         abstract="Constraints as list of key/value pairs."
-                                  "Example: project:CORDEX, time_frequency:mon, variable:tas",
-                         min_occurs=1,
-                         max_occurs=1,
-                         default="project:CORDEX, time_frequency:mon, variable:tas",
-                         ),
-            LiteralInput('query', 'Query',
-                         data_type='string',
-                         abstract="Freetext query. For Example: temperatue",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='*',
-                         ),
-            LiteralInput('start', 'Start',
-                         data_type='dateTime',
-                         abstract="Startime: 2000-01-11T12:00:00Z",
-                         min_occurs=0,
-                         max_occurs=1,
-                         ),
-            LiteralInput('end', 'End',
-                         data_type='dateTime',
-                         abstract="Endtime: 2005-12-31T12:00:00Z",
-                         min_occurs=0,
-                         max_occurs=1,
-                         ),
-            LiteralInput('limit', 'Limit',
-                         data_type='integer',
-                         abstract="Maximum number of datasets in search result",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='10',
-                         allowed_values=[0, 1, 2, 5, 10, 20, 50, 100, 200]
-                         ),
-            LiteralInput('offset', 'Offset',
-                         data_type='integer',
-                         abstract="Start search of datasets at offset.",
-                         min_occurs=0,
-                         max_occurs=1,
-                         default='0',
-                         ),
-        ]
+        inputs = search_inputs()
+        inputs.insert(5, LiteralInput('search_type', 'Search Type',
+                                      data_type='string',
+                                      abstract="Search on Datasets, Files or Aggregations."
+                                               " Summary returns only the hit count and facet counts.",
+                                      min_occurs=0,
+                                      max_occurs=1,
+                                      default='Dataset',
+                                      allowed_values=['Dataset', 'File', 'Aggregation', 'Summary']
+                                      ))
+        inputs.append(LiteralInput('output_format', 'Output Format',
+                                   data_type='string',
+                                   abstract="Format of the search result of a File search."
+                                            " json is a list of URLs. ndjson (one JSON object per line)"
+                                            " and npz (NumPy arrays) have the columns url, size, checksum,"
+                                            " checksum_type, dataset_id, start and end.",
+                                   min_occurs=0,
+                                   max_occurs=1,
+                                   default='json',
+                                   allowed_values=['json', 'ndjson', 'npz']
+                                   ))
         outputs = [
             ComplexOutput('output', 'Search Result',
                           abstract="JSON document with search result,"
                                    " a list of URLs to files on ESGF archive nodes.",
                           as_reference=True,
-                          supported_formats=[Format('application/json')]),
+                          supported_formats=[Format('application/json'),
+                                             NDJSON_FORMAT,
+                                             NPZ_FORMAT]),
             ComplexOutput('summary', 'Search Result Summary',
                           abstract="JSON document with search result summary",
                           as_reference=True,
@@ -153,68 +258,31 @@ class ESGSearchProcess(Process):
         )
 
     def _handler(self, request, response):
-        distrib = False
-        if 'distrib' in request.inputs:
-            distrib = request.inputs['distrib'][0].data
-        replica = False
-        if 'replica' in request.inputs:
-            replica = request.inputs['replica'][0].data
-        latest = True
-        if 'latest' in request.inputs:
-            latest = request.inputs['latest'][0].data
-        esgsearch = ESGSearch(
-            url=request.inputs['url'][0].data,
-            distrib=distrib,
-            replica=replica,
-            latest=latest,
-        )
-
-        constrains_str = request.inputs['constraints'][0].data.strip()
-        constraints = []
-        for constrain in constrains_str.split(','):
-            key, value = constrain.split(':')
-            constraints.append((key.strip(), value.strip()))
-
-        if 'start' in request.inputs:
-            start = request.inputs['start'][0].data
-        else:
-            start = None
-        if 'end' in request.inputs:
-            end = request.inputs['end'][0].data
-        else:
-            end = None
-        if 'offset' in request.inputs:
-            offset = request.inputs['offset'][0].data
-        else:
-            offset = 0
-        if 'limit' in request.inputs:
-            limit = request.inputs['limit'][0].data
-        else:
-            limit = 10
-        if 'query' in request.inputs:
-            query = request.inputs['query'][0].data
-        else:
-            query = '*'
         if 'search_type' in request.inputs:
             search_type = request.inputs['search_type'][0].data
         else:
             search_type = 'Dataset'
-        temporal = True
-        if 'temporal' in request.inputs:
-            temporal = request.inputs['temporal'][0].data
-
-        (result, summary, facet_counts) = esgsearch.search(
-            constraints=constraints,
-            query=query,
-            start=start, end=end,
-            search_type=search_type,
-            limit=limit,
-            offset=offset,
-            temporal=temporal)
-
-        with open('out.json', 'w') as fp:
-            json.dump(obj=result, fp=fp, indent=4, sort_keys=True)
-            response.outputs['output'].file = fp.name
+        (esgsearch, search_args) = parse_search_request(request, search_type)
+
+        if 'output_format' in request.inputs:
+            output_format = request.inputs['output_format'][0].data
+        else:
+            output_format = 'json'
+
+        (result, summary, facet_counts) = esgsearch.search(search_type=search_type, **search_args)
+
+        if search_type == 'File' and output_format == 'ndjson':
+            save_file_records(esgsearch.records, 'out.ndjson', format='ndjson')
+            response.outputs['output'].data_format = NDJSON_FORMAT
+            response.outputs['output'].file = 'out.ndjson'
+        elif search_type == 'File' and output_format == 'npz':
+            save_file_records(esgsearch.records, 'out.npz', format='npz')
+            response.outputs['output'].data_format = NPZ_FORMAT
+            response.outputs['output'].file = 'out.npz'
+        else:
+            with open('out.json', 'w') as fp:
+                json.dump(obj=result, fp=fp, indent=4, sort_keys=True)
+                response.outputs['output'].file = fp.name
 
         with open('summary.json', 'w') as fp:
             json.dump(obj=summary, fp=fp, indent=4, sort_keys=True)
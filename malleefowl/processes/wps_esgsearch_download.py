@@ -0,0 +1,109 @@
+import json
+
+from pywps import Process
+from pywps import LiteralInput
+from pywps import ComplexOutput
+from pywps import Format
+from pywps.app.Common import Metadata
+
+from malleefowl.download import search_and_download
+from malleefowl.processes.wps_esgsearch import search_inputs
+from malleefowl.processes.wps_esgsearch import parse_search_request
+
+import logging
+LOGGER = logging.getLogger("PYWPS")
+
+
+class ESGSearchDownload(Process):
+    """
+    The ESGF search and download process runs an ESGF file search and downloads
+    the found files.
+
+    The downloads start as soon as the files of the first dataset are found
+    and run concurrently with the remaining file searches.
+    As a result it provides a list of local ``file://`` paths to the downloaded files.
+
+    With search type ``Aggregation`` the OPeNDAP aggregations are copied into local NetCDF files.
+    Only the time range (start, end) and the variables of the search constraints are transferred.
+    """
+    def __init__(self):
+        inputs = search_inputs()
+        inputs.insert(5, LiteralInput('search_type', 'Search Type',
+                                      data_type='string',
+                                      abstract="Download Files or copy Aggregations (OPeNDAP).",
+                                      min_occurs=0,
+                                      max_occurs=1,
+                                      default='File',
+                                      allowed_values=['File', 'Aggregation']
+                                      ))
+        outputs = [
+            ComplexOutput('output', 'Downloaded files',
+                          abstract="Json document with list of downloaded files with file url.",
+                          as_reference=True,
+                          supported_formats=[Format('application/json')]),
+            ComplexOutput('summary', 'Search Result Summary',
+                          abstract="JSON document with search result summary",
+                          as_reference=True,
+                          supported_formats=[Format('application/json')]),
+        ]
+
+        super(ESGSearchDownload, self).__init__(
+            self._handler,
+            identifier="esgsearch_download",
+            title="ESGF Search and Download",
+            version="0.2",
+            abstract="Search ESGF files and download them while the search is running.",
+            metadata=[
+                Metadata('Birdhouse', 'http://bird-house.github.io/'),
+                Metadata('User Guide', 'http://malleefowl.readthedocs.io/en/latest/'),
+            ],
+            inputs=inputs,
+            outputs=outputs,
+            status_supported=True,
+            store_supported=True,
+        )
+
+    def _handler(self, request, response):
+        response.update_status("starting search and download ...", 0)
+
+        if 'search_type' in request.inputs:
+            search_type = request.inputs['search_type'][0].data
+        else:
+            search_type = 'File'
+        (esgsearch, search_args) = parse_search_request(request, search_type)
+
+        if 'X-X509-User-Proxy' in request.http_request.headers:
+            credentials = request.http_request.headers['X-X509-User-Proxy']
+            LOGGER.debug('Using X509_USER_PROXY.')
+        else:
+            credentials = None
+            LOGGER.debug('Using no credentials')
+
+        subset = None
+        if search_type == 'Aggregation':
+            subset = dict((key, search_args[key]) for key in ['start', 'end'] if search_args[key] is not None)
+            variables = [value for key, value in search_args['constraints'] if key == 'variable']
+            if variables:
+                subset['variables'] = variables
+
+        def monitor(msg, progress):
+            LOGGER.info("%s - (%d/100)", msg, progress)
+
+        (files, summary) = search_and_download(
+            esgsearch,
+            credentials=credentials,
+            monitor=monitor,
+            search_type=search_type,
+            subset=subset,
+            **search_args)
+
+        with open('out.json', 'w') as fp:
+            json.dump(obj=files, fp=fp, indent=4, sort_keys=True)
+            response.outputs['output'].file = fp.name
+
+        with open('summary.json', 'w') as fp:
+            json.dump(obj=summary, fp=fp, indent=4, sort_keys=True)
+            response.outputs['summary'].file = fp.name
+
+        response.update_status("search and download done", 100)
+        return response
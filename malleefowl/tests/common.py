@@ -1,3 +1,10 @@
+import json
+import time
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
 from pywps.tests import WpsClient, WpsTestResponse
 
 TESTDATA = {
@@ -18,3 +25,203 @@ class WpsTestClient(WpsClient):
 
 def client_for(service):
     return WpsTestClient(service, WpsTestResponse)
+
+
+class SearchIndexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers ESGF search requests with solr json built from the documents of the owning :class:`FakeSearchIndex`.
+    """
+    SYSTEM_PARAMS = ['format', 'limit', 'offset', 'distrib', 'shards', 'facets', 'fields', 'type',
+                     'query', 'latest', 'replica', 'start', 'end', 'from', 'to']
+    # allows keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.index.connections = self.server.index.connections + 1
+
+    def do_GET(self):
+        index = self.server.index
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        index.requests.append(params)
+        if index.delay:
+            time.sleep(index.delay)
+
+        search_type = params.get('type', ['Dataset'])[0]
+        docs = [doc for doc in index.docs if doc.get('type', 'Dataset') == search_type]
+        for key, values in params.items():
+            if key in self.SYSTEM_PARAMS:
+                continue
+            docs = [doc for doc in docs if set(_as_list(doc.get(key))) & set(values)]
+
+        facet_fields = {}
+        if 'facets' in params:
+            for facet in index.facets:
+                counts = {}
+                for doc in docs:
+                    for value in _as_list(doc.get(facet)):
+                        counts[value] = counts.get(value, 0) + 1
+                facet_fields[facet] = [item for pair in sorted(counts.items()) for item in pair]
+
+        offset = int(params.get('offset', [0])[0])
+        limit = int(params.get('limit', [10])[0])
+        selected = docs[offset:offset + limit]
+        if 'fields' in params:
+            fields = params['fields'][0].split(',')
+            selected = [dict((k, v) for k, v in doc.items() if k in fields) for doc in selected]
+
+        body = json.dumps({
+            'responseHeader': {'params': {}},
+            'response': {'numFound': len(docs), 'start': offset, 'docs': selected},
+            'facet_counts': {'facet_fields': facet_fields},
+        })
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSearchIndex(object):
+    """
+    Local stand-in for an ESGF search index used by offline tests.
+
+    :param docs: list of solr documents. The ``type`` key selects Dataset, File or Aggregation.
+    :param facets: facet names for which counts are returned.
+    :param delay: seconds to wait before answering each request.
+
+    ``requests`` records the query parameters of each request and ``connections``
+    counts the accepted connections.
+    """
+    def __init__(self, docs, facets=('project', 'model', 'institute', 'variable'), delay=0):
+        self.docs = docs
+        self.facets = facets
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SearchIndexHandler)
+        self.server.index = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/esg-search'.format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [unicode(v) for v in value]
+    return [unicode(value)]
+
+
+def cordex_docs(models=('MPI-ESM-LR', 'EC-EARTH', 'HadGEM2-ES'), datasets_per_model=3, files_per_dataset=2):
+    """
+    Builds dataset and file documents for a :class:`FakeSearchIndex`.
+    """
+    docs = []
+    for model in models:
+        for i in range(datasets_per_model):
+            dataset_id = 'cordex.output.{0}.v{1}|esgf-data.dkrz.de'.format(model, i)
+            docs.append({'type': 'Dataset', 'id': dataset_id,
+                         'instance_id': dataset_id.split('|')[0],
+                         'project': ['CORDEX'], 'model': [model], 'institute': ['MPI-CSC'],
+                         'variable': ['tas'],
+                         'number_of_files': files_per_dataset, 'number_of_aggregations': 0,
+                         'size': 1024 * files_per_dataset, 'url': []})
+            for year in range(files_per_dataset):
+                filename = 'tas_EUR-44_{0}_historical_r1i1p1_v{1}_mon_{2}01-{2}12.nc'.format(
+                    model, i, 2001 + year)
+                docs.append({'type': 'File', 'id': '{0}.{1}'.format(dataset_id, filename),
+                             'dataset_id': dataset_id, 'title': filename,
+                             'project': ['CORDEX'], 'model': [model], 'variable': ['tas'],
+                             'size': 1024, 'checksum': ['abc{0}'.format(year)], 'checksum_type': ['SHA256'],
+                             'url': ['http://esgf-data.dkrz.de/thredds/fileServer/cordex/{0}|'
+                                     'application/netcdf|HTTPServer'.format(filename)]})
+    return docs
+
+
+def write_test_nc(filename, ntime=100, nlat=10, nlon=20, variables=('tas', 'pr'), start=0,
+                  calendar='standard', format='NETCDF3_64BIT'):
+    """
+    Writes a small netcdf file with daily time steps (``days since 2000-01-01``) on a lat/lon grid.
+    Values of variable ``i`` are ``i * 1000 + time index + lat/lon offset``.
+    """
+    import numpy as np
+    from netCDF4 import Dataset
+    nc = Dataset(filename, 'w', format=format)
+    nc.title = 'test data'
+    nc.createDimension('time', None)
+    nc.createDimension('lat', nlat)
+    nc.createDimension('lon', nlon)
+    time = nc.createVariable('time', 'f8', ('time',))
+    time.units = 'days since 2000-01-01 00:00:00'
+    time.calendar = calendar
+    time[:] = np.arange(start, start + ntime)
+    lat = nc.createVariable('lat', 'f4', ('lat',))
+    lat.units = 'degrees_north'
+    lat[:] = np.linspace(-90, 90, nlat)
+    lon = nc.createVariable('lon', 'f4', ('lon',))
+    lon.units = 'degrees_east'
+    lon[:] = np.linspace(0, 360, nlon, endpoint=False)
+    grid = np.arange(nlat * nlon, dtype='f4').reshape(nlat, nlon) / (nlat * nlon)
+    for i, name in enumerate(variables):
+        var = nc.createVariable(name, 'f4', ('time', 'lat', 'lon'), fill_value=1e20)
+        var.units = 'K'
+        var[:] = (i * 1000 + np.arange(start, start + ntime, dtype='f4'))[:, None, None] + grid
+    nc.close()
+    return filename
+
+
+class SlowDataset(object):
+    """
+    Read-only stand-in for an OPeNDAP dataset: every data request waits ``latency`` seconds.
+    """
+    def __init__(self, filename, mode='r', latency=0.05):
+        from netCDF4 import Dataset
+        self.requests = 0
+        self.latency = latency
+        self.nc = Dataset(filename, mode)
+        self.dimensions = self.nc.dimensions
+        self.variables = dict((name, SlowVariable(self, var)) for name, var in self.nc.variables.items())
+
+    def ncattrs(self):
+        return self.nc.ncattrs()
+
+    def getncattr(self, name):
+        return self.nc.getncattr(name)
+
+    def close(self):
+        self.nc.close()
+
+
+class SlowVariable(object):
+    def __init__(self, dataset, var):
+        self.dataset = dataset
+        self.var = var
+
+    def __getattr__(self, name):
+        return getattr(self.var, name)
+
+    def __getitem__(self, key):
+        time.sleep(self.dataset.latency)
+        self.dataset.requests += 1
+        return self.var[key]
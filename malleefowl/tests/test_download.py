@@ -17,3 +17,196 @@ def test_download_with_file_url():
     result = download(TESTDATA['noaa_nc_1'], use_file_url=True)
     assert os.path.basename(result) == "air.mon.ltm.nc"
     assert 'file:///' in result
+
+
+def test_search_and_download():
+    from malleefowl.esgf.search import ESGSearch
+    from malleefowl.download import search_and_download
+    from malleefowl.tests.common import FakeSearchIndex, cordex_docs
+
+    docs = cordex_docs()
+    for doc in docs:
+        if doc['type'] == 'File':
+            doc['url'] = ['file:///tmp/{0}|application/netcdf|HTTPServer'.format(doc['title'])]
+    with FakeSearchIndex(docs) as index:
+        esgsearch = ESGSearch(url=index.url)
+        files, summary = search_and_download(
+            esgsearch, constraints=[('project', 'CORDEX')], limit=100, temporal=False)
+    assert summary['number_of_files'] == 18
+    assert sorted(files) == sorted(['file:///tmp/{0}'.format(doc['title'])
+                                    for doc in docs if doc['type'] == 'File'])
+
+
+def test_is_opendap_url():
+    from malleefowl.download import is_opendap_url
+    assert is_opendap_url('http://esgf1.dkrz.de/thredds/dodsC/cmip5.output1.MPI-M.tas.aggregation')
+    assert not is_opendap_url('http://esgf1.dkrz.de/thredds/fileServer/cmip5/output1/tas.nc')
+
+
+def test_download_opendap(tmpdir, monkeypatch):
+    from netCDF4 import Dataset
+    from malleefowl import config, utils
+    from malleefowl import download as download_module
+    from malleefowl.tests.common import write_test_nc
+
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    copies = []
+
+    def nc_copy(url, target, **kwargs):
+        copies.append(url)
+        return utils.nc_copy(url, target, open_dataset=lambda url, mode: Dataset(source, mode), **kwargs)
+
+    monkeypatch.setattr(download_module, 'nc_copy', nc_copy)
+    monkeypatch.setattr(config, 'cache_path', lambda: str(tmpdir.join('cache')))
+    monkeypatch.chdir(str(tmpdir.mkdir('work')))
+
+    url = 'http://localhost/thredds/dodsC/cmip5.output1.MPI-M.tas.aggregation'
+    subset = dict(variables=['tas'], start='2000-01-11', end='2000-01-20')
+    files = download_module.download_files([url] * 3, subset=subset)
+    assert len(copies) == 1
+    assert len(set(files)) == 1
+    assert files[0].startswith('file://' + str(tmpdir.join('cache', 'localhost', 'thredds')))
+    nc = Dataset(files[0][len('file://'):])
+    assert sorted(nc.variables.keys()) == ['lat', 'lon', 'tas', 'time']
+    assert len(nc.dimensions['time']) == 10
+    nc.close()
+
+    # a different subset is another copy
+    download_module.download(url, subset=dict(variables=['pr']))
+    assert len(copies) == 2
+    # locks of finished downloads are removed
+    assert download_module._locks == {}
+
+
+def test_download_opendap_resume(tmpdir, monkeypatch):
+    import os
+    from netCDF4 import Dataset
+    from malleefowl import config, utils
+    from malleefowl import download as download_module
+    from malleefowl.exceptions import ProcessFailed
+    from malleefowl.tests.common import write_test_nc
+
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    failures = []
+    progress = []
+
+    def failing_monitor(message, value):
+        progress.append(value)
+        if not failures and value > 50:
+            failures.append(value)
+            raise Exception('connection lost')
+
+    def nc_copy(url, target, **kwargs):
+        return utils.nc_copy(url, target, open_dataset=lambda url, mode: Dataset(source, mode),
+                             memory_budget=10 * 800, prefetch=False, monitor=failing_monitor, **kwargs)
+
+    monkeypatch.setattr(download_module, 'nc_copy', nc_copy)
+    monkeypatch.setattr(config, 'cache_path', lambda: str(tmpdir.join('cache')))
+    monkeypatch.chdir(str(tmpdir.mkdir('work')))
+
+    url = 'http://localhost/thredds/dodsC/cmip5.output1.MPI-M.tas.aggregation'
+    with pytest.raises(ProcessFailed):
+        download_module.download(url)
+    # the partial copy is kept in the cache, not in the (request) working directory
+    filename = str(tmpdir.join('cache', 'localhost', 'thredds', 'dodsC', 'cmip5.output1.MPI-M.tas.aggregation.nc'))
+    assert os.path.exists(filename + '.part.checkpoint')
+    assert os.listdir(str(tmpdir.join('work'))) == []
+
+    del progress[:]
+    assert download_module.download(url) == filename
+    assert progress[0] > 50
+    assert not os.path.exists(filename + '.part')
+    assert not os.path.exists(filename + '.part.checkpoint')
+
+
+def test_download_opendap_credentials(tmpdir, monkeypatch):
+    import os
+    from malleefowl import config
+    from malleefowl import download as download_module
+
+    copies = []
+
+    def copy_with_credentials(url, filename, credentials, subset):
+        copies.append((url, credentials))
+        open(filename, 'w').close()
+
+    monkeypatch.setattr(download_module, '_copy_with_credentials', copy_with_credentials)
+    monkeypatch.setattr(config, 'cache_path', lambda: str(tmpdir.join('cache')))
+    monkeypatch.chdir(str(tmpdir.mkdir('work')))
+
+    for user in ['alice', 'bob']:
+        url = 'http://localhost/thredds/dodsC/{0}'.format(user)
+        filename = download_module.download(url, credentials=user)
+        assert os.path.isfile(filename)
+    assert copies == [('http://localhost/thredds/dodsC/alice', 'alice'), ('http://localhost/thredds/dodsC/bob', 'bob')]
+    assert os.listdir(str(tmpdir.join('work'))) == []
+
+
+def test_copy_with_credentials(tmpdir, monkeypatch):
+    import os
+    import glob
+    import tempfile
+    from datetime import datetime
+    from netCDF4 import Dataset
+    from malleefowl.download import _copy_with_credentials
+    from malleefowl.tests.common import write_test_nc
+
+    # the copy runs in a new python process which must import malleefowl
+    monkeypatch.setenv('PYTHONPATH', os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    _copy_with_credentials(source, target, 'credentials.pem',
+                           dict(variables=['tas'], start=datetime(2000, 1, 11), bbox=(0, -90, 90, 90)))
+    nc = Dataset(target)
+    assert sorted(nc.variables) == ['lat', 'lon', 'tas', 'time']
+    assert len(nc.dimensions['time']) == 90
+    assert len(nc.dimensions['lon']) == 6
+    nc.close()
+
+    with pytest.raises(Exception) as e:
+        _copy_with_credentials(str(tmpdir.join('missing.nc')), target, 'credentials.pem', None)
+    assert 'No such file' in str(e.value)
+    # the .dodsrc directories are removed
+    assert glob.glob(str(tmpdir.join('tmp', 'dodsrc-*'))) == []
+
+
+def test_concat_files(tmpdir):
+    from netCDF4 import Dataset
+    from malleefowl.download import concat_files
+    from malleefowl.tests.common import write_test_nc
+
+    files = ['file://' + write_test_nc(str(tmpdir.join('tas_day_MPI-ESM-LR_historical_r1i1p1_{0}.nc'.format(dates))),
+                                       start=start)
+             for start, dates in [(100, '20000410-20000718'), (0, '20000101-20000410')]]
+    files.append('file://' + write_test_nc(str(tmpdir.join('orog_fx_MPI-ESM-LR_historical_r0i0p0.nc'))))
+    result = concat_files(files, outdir=str(tmpdir))
+    target = str(tmpdir.join('tas_day_MPI-ESM-LR_historical_r1i1p1_20000101-20000718.nc'))
+    assert result == [files[2], 'file://' + target]
+    nc = Dataset(result[1][len('file://'):])
+    assert len(nc.dimensions['time']) == 200
+    nc.close()
+
+
+def test_concat_files_in_cache(tmpdir, monkeypatch):
+    import os
+    from malleefowl import config
+    from malleefowl import download as download_module
+    from malleefowl.tests.common import write_test_nc
+
+    monkeypatch.setattr(config, 'cache_path', lambda: str(tmpdir.join('cache')))
+    monkeypatch.chdir(str(tmpdir.mkdir('work')))
+    files = ['file://' + write_test_nc(str(tmpdir.join('tas_day_MPI-ESM-LR_historical_r1i1p1_{0}.nc'.format(dates))),
+                                       start=start)
+             for start, dates in [(0, '20000101-20000410'), (100, '20000410-20000718')]]
+    result = download_module.concat_files(files)
+    filename = result[0][len('file://'):]
+    # not in the request working directory, which is removed after the request
+    assert filename.startswith(str(tmpdir.join('cache', 'concat')))
+    assert os.path.basename(filename) == 'tas_day_MPI-ESM-LR_historical_r1i1p1_20000101-20000718.nc'
+    assert os.listdir(os.path.dirname(filename)) == [os.path.basename(filename)]
+    assert os.listdir(str(tmpdir.join('work'))) == []
+
+    # the concatenation of the same files is reused
+    monkeypatch.setattr(download_module, 'nc_concat', None)
+    assert download_module.concat_files(files) == result
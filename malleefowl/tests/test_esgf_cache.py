@@ -0,0 +1,41 @@
+import pytest
+
+import time
+
+from malleefowl import config
+from malleefowl.esgf.cache import SearchCache
+from malleefowl.esgf.search import ESGSearch
+from malleefowl.tests.common import FakeSearchIndex, cordex_docs
+
+
+@pytest.fixture
+def cache_path(tmpdir, monkeypatch):
+    path = str(tmpdir.join('search_cache.db'))
+    monkeypatch.setattr(config, 'esgf_search_cache', lambda: path)
+    return path
+
+
+def test_cache_expires(tmpdir):
+    cache = SearchCache(str(tmpdir.join('cache.db')), ttl=0.2)
+    cache.set('http://index', 'limit=0', {'response': {'numFound': 1}})
+    assert cache.get('http://index', 'limit=0') == {'response': {'numFound': 1}}
+    assert cache.get('http://other', 'limit=0') is None
+    time.sleep(0.3)
+    assert cache.get('http://index', 'limit=0') is None
+    cache.close()
+
+
+def test_summary_search_is_cached(cache_path):
+    with FakeSearchIndex(cordex_docs()) as index:
+        for _ in range(2):
+            (result, summary, facet_counts) = ESGSearch(index.url).search(
+                constraints=[('project', 'CORDEX')], search_type='Summary')
+            assert facet_counts['model']['EC-EARTH'] == 3
+        # zero hits are cached as well
+        for _ in range(2):
+            ESGSearch(index.url).search(constraints=[('project', 'CMIP5')], search_type='Summary')
+        assert len(index.requests) == 2
+
+        SearchCache(cache_path).clear(index.url)
+        ESGSearch(index.url).search(constraints=[('project', 'CORDEX')], search_type='Summary')
+        assert len(index.requests) == 3
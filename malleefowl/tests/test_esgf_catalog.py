@@ -0,0 +1,113 @@
+import pytest
+
+from malleefowl.esgf.catalog import Catalog, harvest
+from malleefowl.esgf.search import ESGSearch
+from malleefowl.tests.common import FakeSearchIndex, cordex_docs
+
+
+@pytest.fixture
+def catalog(tmpdir):
+    catalog = Catalog(str(tmpdir.join('catalog.db')))
+    yield catalog
+    catalog.close()
+
+
+def test_harvest_and_search(catalog):
+    with FakeSearchIndex(cordex_docs()) as index:
+        assert harvest(catalog, index.url, [('project', 'CORDEX')]) == 27
+        (expected, expected_summary, expected_counts) = ESGSearch(index.url).search(
+            constraints=[('project', 'CORDEX'), ('model', 'EC-EARTH')], search_type='File', limit=10)
+        # incremental harvest only asks for changed records
+        harvest(catalog, index.url, [('project', 'CORDEX')])
+        assert 'from' in index.requests[-1]
+
+    assert catalog.covers(index.url, [('project', 'CORDEX'), ('model', 'EC-EARTH')])
+    assert not catalog.covers(index.url, [('project', 'CMIP5')])
+
+    esgsearch = ESGSearch(index.url, catalog=catalog)
+    (result, summary, facet_counts) = esgsearch.search(
+        constraints=[('project', 'CORDEX'), ('model', 'EC-EARTH')], search_type='File', limit=10)
+    assert sorted(result) == sorted(expected)
+    assert summary['number_of_selected_files'] == expected_summary['number_of_selected_files']
+    assert facet_counts['model'] == expected_counts['model']
+
+
+def test_catalog_covers_search_types(catalog):
+    catalog.set_harvest('http://index', [('project', 'CORDEX')], '2017-01-01T00:00:00Z')
+    for search_type in ['Dataset', 'Summary', 'File']:
+        assert catalog.covers('http://index', [('project', 'CORDEX')], search_type)
+    # aggregations are not harvested
+    assert not catalog.covers('http://index', [('project', 'CORDEX')], 'Aggregation')
+    assert catalog.last_harvest('http://index', [('project', 'CORDEX')], ['Dataset', 'Aggregation']) is None
+
+
+def test_catalog_migrates_harvests(tmpdir):
+    import sqlite3
+    path = str(tmpdir.join('old.db'))
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE harvests (url TEXT, constraints TEXT, timestamp TEXT, PRIMARY KEY (url, constraints))')
+    db.execute('INSERT INTO harvests VALUES (?, ?, ?)', ('http://index', '{"project": ["CORDEX"]}', '2017'))
+    db.commit()
+    db.close()
+    catalog = Catalog(path)
+    try:
+        assert catalog.covers('http://index', [('project', 'CORDEX')], 'File')
+        assert not catalog.covers('http://index', [('project', 'CORDEX')], 'Aggregation')
+    finally:
+        catalog.close()
+
+
+@pytest.mark.parametrize("distrib,search_type,expected", [
+    (False, 'File', True), (True, 'File', False), (False, 'Aggregation', False)])
+def test_search_request_uses_catalog(catalog, monkeypatch, distrib, search_type, expected):
+    from malleefowl.esgf.catalog import CatalogConnection
+    from malleefowl.processes import wps_esgsearch
+
+    class Input(object):
+        def __init__(self, data):
+            self.data = data
+
+    class Request(object):
+        inputs = {'url': [Input('http://index')], 'constraints': [Input('project:CORDEX')],
+                  'distrib': [Input(distrib)]}
+
+    catalog.set_harvest('http://index', [('project', 'CORDEX')], '2017-01-01T00:00:00Z')
+    monkeypatch.setattr(wps_esgsearch, 'local_catalog', lambda: catalog)
+    (esgsearch, search_args) = wps_esgsearch.parse_search_request(Request(), search_type)
+    assert isinstance(esgsearch.conn, CatalogConnection) == expected
+
+
+def test_catalog_query(catalog):
+    catalog.add(cordex_docs())
+    response = catalog.query({'type': 'Dataset', 'query': 'HadGEM2', 'facets': 'model'}, limit=0)
+    assert response['response']['numFound'] == 3
+    assert response['response']['docs'] == []
+    assert response['facet_counts']['facet_fields']['model'] == ['HadGEM2-ES', 3]
+
+
+def test_catalog_query_time_range(catalog):
+    docs = cordex_docs(models=['EC-EARTH'], datasets_per_model=2)
+    docs[0].update(datetime_start='2001-01-01T00:00:00Z', datetime_stop='2005-12-31T00:00:00Z',
+                   _timestamp='2017-03-01T00:00:00Z')
+    catalog.add(docs)
+
+    def hits(**params):
+        params['type'] = 'Dataset'
+        return [doc['id'] for doc in catalog.query(params)['response']['docs']]
+
+    assert len(hits()) == 2
+    # records without time coverage do not match, like on the index node
+    assert hits(start='2004-01-01T00:00:00Z') == [docs[0]['id']]
+    assert hits(start='2006-01-01T00:00:00Z') == []
+    assert hits(end='2000-12-31T00:00:00Z') == []
+    assert hits(**{'from': '2017-01-01T00:00:00Z'}) == [docs[0]['id']]
+    assert hits(**{'to': '2017-01-01T00:00:00Z'}) == []
+
+
+def test_local_catalog(tmpdir, monkeypatch):
+    from malleefowl import config
+    from malleefowl.esgf.catalog import local_catalog
+    monkeypatch.setattr(config, 'esgf_catalog', lambda: None)
+    assert local_catalog() is None
+    monkeypatch.setattr(config, 'esgf_catalog', lambda: str(tmpdir.join('catalog.db')))
+    assert local_catalog() is local_catalog()
@@ -10,3 +10,154 @@ def test_parse_openid():
     assert username == "pingutest1"
     assert hostname == "esgf-data.dkrz.de"
     assert port == "7512"
+
+
+def fake_logon(lifetime, calls):
+    """
+    Returns a logon function writing a self-signed certificate valid for ``lifetime`` seconds.
+    """
+    import os
+    import time
+    import OpenSSL
+    from pyesgf.logon import ESGF_CREDENTIALS
+
+    def logon(openid, password=None, outdir=None):
+        calls.append(openid)
+        time.sleep(0.1)
+        key = OpenSSL.crypto.PKey()
+        key.generate_key(OpenSSL.crypto.TYPE_RSA, 1024)
+        cert = OpenSSL.crypto.X509()
+        cert.get_subject().CN = openid
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(lifetime)
+        cert.sign(key, 'sha256')
+        filename = os.path.join(outdir, ESGF_CREDENTIALS)
+        with open(filename, 'w') as fp:
+            fp.write(OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert))
+        return filename
+    return logon
+
+
+def test_credential_cache(tmpdir):
+    import threading
+    calls = []
+    cache = logon.CredentialCache(str(tmpdir.join('credentials')), margin=60, refresh_margin=120,
+                                  logon=fake_logon(3600, calls))
+    openid = "https://esgf-data.dkrz.de/esgf-idp/openid/pingutest1"
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.credentials(openid, 'secret')))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # concurrent logons are serialized and the certificate is reused
+    assert len(calls) == 1
+    assert len(set(results)) == 1
+    assert logon.cert_infos(results[0])['expires'] is not None
+
+
+def test_credential_cache_refresh(tmpdir):
+    import time
+    calls = []
+    openid = "https://esgf-data.dkrz.de/esgf-idp/openid/pingutest1"
+    # certificates expiring within the margin are replaced
+    cache = logon.CredentialCache(str(tmpdir.join('credentials')), margin=60, refresh_margin=120,
+                                  logon=fake_logon(30, calls))
+    cache.credentials(openid, 'secret')
+    cache.credentials(openid, 'secret')
+    assert len(calls) == 2
+    # certificates expiring within the refresh margin are renewed in the background
+    cache = logon.CredentialCache(str(tmpdir.join('credentials')), margin=60, refresh_margin=120,
+                                  logon=fake_logon(90, calls))
+    cache.credentials(openid, 'secret')
+    assert len(calls) == 3
+    cache.credentials(openid, 'secret')
+    time.sleep(0.5)
+    assert len(calls) == 4
+
+
+def test_credential_cache_password(tmpdir):
+    import os
+    import stat
+    calls = []
+    openid = "https://esgf-data.dkrz.de/esgf-idp/openid/pingutest1"
+    cache_dir = str(tmpdir.join('credentials'))
+    cache = logon.CredentialCache(cache_dir, margin=60, refresh_margin=120,
+                                  logon=fake_logon(3600, calls))
+    assert stat.S_IMODE(os.stat(cache_dir).st_mode) == 0700
+    filename = cache.credentials(openid, 'secret')
+    # a cache hit needs the password of the cached credentials, also in another process
+    cache = logon.CredentialCache(cache_dir, margin=60, refresh_margin=120,
+                                  logon=fake_logon(3600, calls))
+    assert cache.credentials(openid, 'secret') == filename
+    with pytest.raises(Exception) as e:
+        cache.credentials(openid, 'guess')
+    assert 'does not match' in str(e.value)
+    with pytest.raises(Exception):
+        cache.credentials(openid, None)
+    assert cache.credentials(openid, 'secret') == filename
+    assert cache.passwords[openid] == 'secret'
+    assert len(calls) == 1
+
+
+def test_credential_cache_dir_must_be_private(tmpdir):
+    import os
+    cache_dir = str(tmpdir.join('credentials'))
+    os.mkdir(cache_dir)
+    os.chmod(cache_dir, 0755)
+    with pytest.raises(Exception):
+        logon.CredentialCache(cache_dir)
+
+
+XRDS = """<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+  <XRD>
+    <Service priority="10">
+      <Type>urn:esg:security:myproxy-service</Type>
+      <URI>socket://esgf-data.dkrz.de:7512</URI>
+    </Service>
+  </XRD>
+</xrds:XRDS>
+"""
+
+
+def test_parse_openid_cached():
+    import time
+    import threading
+    import BaseHTTPServer
+    from malleefowl.tests.common import ThreadingHTTPServer
+
+    requests = []
+
+    class OpenIDHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xrds+xml')
+            self.end_headers()
+            self.wfile.write(XRDS)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OpenIDHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        openid = 'http://127.0.0.1:{0}/esgf-idp/openid/pingutest1'.format(server.server_address[1])
+        for _ in range(3):
+            (username, hostname, port) = logon.parse_openid(openid, ttl=0.2)
+            assert hostname == "esgf-data.dkrz.de"
+        assert len(requests) == 1
+        # stale result is returned and fetched again in the background
+        time.sleep(0.3)
+        assert logon.parse_openid(openid, ttl=0.2)[1] == "esgf-data.dkrz.de"
+        time.sleep(0.2)
+        assert len(requests) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
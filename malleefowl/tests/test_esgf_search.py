@@ -4,6 +4,9 @@ import pytest
 
 from unittest import TestCase
 
+from malleefowl.esgf.search import ESGSearch
+from malleefowl.tests.common import FakeSearchIndex, cordex_docs
+
 
 class EsgDistribSearchTestCase(TestCase):
 
@@ -258,3 +261,242 @@ class EsgSearchTestCase(TestCase):
 
         assert len(result) > 1
         assert summary['number_of_selected_files'] > 1
+
+
+def test_partitioned_search():
+    with FakeSearchIndex(cordex_docs()) as index:
+        esgsearch = ESGSearch(index.url)
+        (expected, _, _) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=100, partition_facet='model')
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=4, offset=4, partition_facet='model')
+    # all datasets exactly once, ordered by facet value
+    assert len(expected) == 9
+    assert len(set(ds['id'] for ds in expected)) == 9
+    assert [ds['id'] for ds in expected] == sorted(ds['id'] for ds in expected)
+    assert summary['number_of_datasets'] == 4
+    assert [ds['id'] for ds in result] == [ds['id'] for ds in expected[4:8]]
+
+
+def test_partitioned_search_multi_valued_facet():
+    docs = cordex_docs()
+    datasets = [doc for doc in docs if doc['type'] == 'Dataset']
+    # datasets with several variables are counted once per variable
+    for doc in datasets[::2]:
+        doc['variable'] = ['pr', 'tas']
+    with FakeSearchIndex(docs) as index:
+        esgsearch = ESGSearch(index.url)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=4, offset=4, partition_facet='variable')
+    assert sum(facet_counts['variable'].values()) > 9
+    assert summary['total_number_of_datasets'] == 9
+    assert [ds['id'] for ds in result] == [doc['id'] for doc in datasets[4:8]]
+
+
+def test_distributed_search_with_timeout():
+    docs = cordex_docs()
+    local_docs = [doc for doc in docs if 'MPI-ESM-LR' in doc['id']]
+    with FakeSearchIndex(local_docs) as local, FakeSearchIndex(docs) as remote, \
+            FakeSearchIndex(docs, delay=2) as slow:
+        esgsearch = ESGSearch([local.url, remote.url, slow.url], timeout=1)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=100, search_type='File')
+    assert summary['unavailable_index_nodes'] == [slow.url]
+    assert summary['number_of_datasets'] == 9
+    # sum of the node hit counts, datasets found on several nodes are counted on each node
+    assert summary['total_number_of_datasets'] == 3 + 9
+    assert summary['total_number_of_datasets_is_approximate'] is True
+    assert len(result) == 18
+    # datasets of the local node are only searched for files on the local node
+    file_requests = [params for params in remote.requests if params.get('type') == ['File']]
+    assert not [params for params in file_requests if 'MPI-ESM-LR' in params['dataset_id'][0]]
+
+
+def test_distributed_summary_search():
+    docs = cordex_docs()
+    with FakeSearchIndex(docs) as local, FakeSearchIndex(docs) as remote:
+        esgsearch = ESGSearch([local.url, remote.url])
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], search_type='Summary')
+        # only the hit count query, no datasets are paged
+        assert [len(local.requests), len(remote.requests)] == [1, 1]
+    assert result == []
+    assert summary['total_number_of_datasets'] == 18
+
+
+def test_abandoned_node_jobs_end():
+    import threading
+    import time
+    with FakeSearchIndex(cordex_docs()) as local, FakeSearchIndex(cordex_docs(), delay=2) as slow:
+        esgsearch = ESGSearch([local.url, slow.url], timeout=0.5)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=1, search_type='Dataset')
+        assert summary['unavailable_index_nodes'] == [slow.url]
+        deadline = time.time() + 3
+        while time.time() < deadline:
+            if not [t for t in threading.enumerate() if t.name.startswith('search-job-')]:
+                break
+            time.sleep(0.1)
+        assert not [t for t in threading.enumerate() if t.name.startswith('search-job-')]
+
+
+def test_file_search_fields():
+    with FakeSearchIndex(cordex_docs()) as index:
+        esgsearch = ESGSearch(index.url)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=2, search_type='File')
+        file_requests = [params for params in index.requests if params.get('type') == ['File']]
+    assert len(result) == 4
+    assert summary['file_size'] == 4 * 1024
+    # one query per dataset, without facet counts
+    assert len(file_requests) == 2
+    assert file_requests[0]['fields'] == ['id,dataset_id,title,size,checksum,checksum_type,url']
+    assert 'facets' not in file_requests[0]
+
+
+def test_search_connections_are_reused():
+    with FakeSearchIndex(cordex_docs()) as index:
+        for _ in range(2):
+            esgsearch = ESGSearch(index.url)
+            (result, summary, facet_counts) = esgsearch.search(
+                constraints=[('project', 'CORDEX')], limit=9, search_type='File')
+            assert len(result) == 18
+    assert len(index.requests) > 20
+    # at most one connection per search thread
+    assert index.connections <= 4
+
+
+def test_search_query_timeout():
+    import requests
+    from malleefowl.esgf.search import PooledSearchConnection
+    with FakeSearchIndex(cordex_docs(), delay=2) as index:
+        conn = PooledSearchConnection(index.url, distrib=False, timeout=0.5)
+        with pytest.raises(requests.exceptions.Timeout):
+            conn.new_context(project='CORDEX').hit_count
+
+
+def test_file_search_threads_are_stopped():
+    import threading
+    before = set(threading.enumerate())
+    with FakeSearchIndex(cordex_docs()) as index:
+        esgsearch = ESGSearch(index.url, num_threads=3)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=9, search_type='File')
+    assert len(result) == 18
+    assert not [t for t in set(threading.enumerate()) - before if t.name.startswith('search-job-')]
+
+
+def test_token_bucket():
+    import time
+    from malleefowl.esgf.search import TokenBucket
+    bucket = TokenBucket(rate=50, capacity=1)
+    t0 = time.time()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.time() - t0 >= 0.19
+
+
+def test_save_file_records(tmpdir):
+    import json
+    import numpy as np
+    from malleefowl.esgf.search import save_file_records
+    with FakeSearchIndex(cordex_docs()) as index:
+        esgsearch = ESGSearch(index.url)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], limit=2, search_type='File')
+    assert len(esgsearch.records) == 4
+
+    save_file_records(esgsearch.records, str(tmpdir.join('out.ndjson')), format='ndjson')
+    rows = [json.loads(line) for line in tmpdir.join('out.ndjson').readlines()]
+    assert [row['url'] for row in rows] == result
+    assert rows[0]['size'] == 1024
+    assert rows[0]['checksum'] in ('abc0', 'abc1')
+    assert rows[0]['dataset_id'].startswith('cordex.output.')
+    assert rows[0]['start'] in ('2001-01-01T00:00', '2002-01-01T00:00')
+
+    save_file_records(esgsearch.records, str(tmpdir.join('out.npz')), format='npz')
+    columns = np.load(str(tmpdir.join('out.npz')))
+    assert list(columns['url']) == result
+    assert columns['size'].sum() == summary['file_size']
+    assert columns['end'].dtype == np.dtype('datetime64[m]')
+
+
+def test_summary_search():
+    with FakeSearchIndex(cordex_docs()) as index:
+        esgsearch = ESGSearch(index.url)
+        (result, summary, facet_counts) = esgsearch.search(
+            constraints=[('project', 'CORDEX')], search_type='Summary', limit=10)
+        assert len(index.requests) == 1
+        assert index.requests[0]['limit'] == ['0']
+    assert result == []
+    assert summary['total_number_of_datasets'] == 9
+    assert facet_counts['model']['EC-EARTH'] == 3
+
+
+def test_temporal_filter_batch():
+    from malleefowl.esgf.search import temporal_filter_batch
+    filenames = ['tas_EUR-44_MPI-M-MPI-ESM-LR_historical_r1i1p1_MPI-CSC-REMO2009_v1_mon_200101-200012.nc',
+                 'tas_EUR-44_MPI-M-MPI-ESM-LR_historical_r1i1p1_MPI-CSC-REMO2009_v1_mon_200501-200512.nc',
+                 'tas_EUR-44_MPI-M-MPI-ESM-LR_historical_r1i1p1_MPI-CSC-REMO2009_v1_mon_200601-200612.nc',
+                 'orog_EUR-44_MPI-M-MPI-ESM-LR_historical_r0i0p0_MPI-CSC-REMO2009_v1_fx.nc',
+                 'orog_fx_MPI-ESM-LR_historical_r0i0p0.nc',
+                 'tas_Amon_MPI-ESM-LR_historical_r1i1p1_1850-2005.nc',
+                 'pr_6hr_MPI-ESM-LR_historical_r1i1p1_2005010100-2005063018.nc']
+    selected = temporal_filter_batch(filenames, start_date=datetime(2005, 7, 1), end_date=datetime(2006, 1, 1))
+    assert list(selected) == [False, True, True, True, True, True, False]
+    assert temporal_filter_batch(filenames).all()
+
+
+def _baseline_temporal_filter(filename, start_date, end_date):
+    # temporal_filter of malleefowl 0.6, which was called once per file
+    import logging
+    logger = logging.getLogger("PYWPS")
+    logger.debug('filename=%s, start_date=%s, end_date=%s', filename, start_date, end_date)
+    value = filename.split('.')
+    value.pop()
+    value = value[-1].split('_')[-1]
+    logger.debug('date part = %s', value)
+    if value == 'fx':
+        return True
+    value = value.split('-')
+    start_year, end_year = int(value[0][:4]), int(value[1][:4])
+    if start_year > end_date.year:
+        logger.debug('skip: %s > %s', start_year, end_date.year)
+        return False
+    if end_year < start_date.year:
+        logger.debug('skip: %s < %s', end_year, start_date.year)
+        return False
+    return True
+
+
+@pytest.mark.slow
+def test_temporal_filter_batch_benchmark():
+    import random
+    import time
+    from malleefowl.esgf.search import temporal_filter_batch
+
+    random.seed(1)
+    filenames = []
+    for i in range(100000):
+        year = random.randint(1850, 2100)
+        if i % 3 == 0:
+            filenames.append('tas_Amon_MPI-ESM-LR_historical_r1i1p1_{0}01-{1}12.nc'.format(year, year + 4))
+        elif i % 3 == 1:
+            filenames.append('tas_EUR-44_MPI-M-MPI-ESM-LR_rcp85_r1i1p1_MPI-CSC-REMO2009_v1_day_'
+                             '{0}0101-{0}1231.nc'.format(year))
+        else:
+            filenames.append('orog_EUR-44_MPI-M-MPI-ESM-LR_rcp85_r0i0p0_MPI-CSC-REMO2009_v1_fx.nc')
+    start_date = datetime(1960, 1, 1)
+    end_date = datetime(1990, 12, 31)
+
+    t0 = time.time()
+    expected = [_baseline_temporal_filter(filename, start_date, end_date) for filename in filenames]
+    loop_secs = time.time() - t0
+
+    t0 = time.time()
+    selected = temporal_filter_batch(filenames, start_date, end_date)
+    batch_secs = time.time() - t0
+
+    # all files have year precision boundaries within the window, so both agree
+    assert list(selected) == expected
+    assert batch_secs < loop_secs
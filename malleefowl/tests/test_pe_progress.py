@@ -0,0 +1,38 @@
+from multiprocessing import Process
+
+from malleefowl.utils import DataWrapper
+from malleefowl.pe.map import ProgressList
+from malleefowl.pe.progress_monitor import RangeGroupProgress
+
+
+class FakeMapPE(object):
+    def __init__(self):
+        self.progress_list = ProgressList(size=8)
+
+
+def test_range_group_progress():
+    map_pe = FakeMapPE()
+    provider = RangeGroupProgress(map_pe, 10, 50)
+    # the map sends the last index first
+    provider.set_headers({DataWrapper.HEADERS_MAP_INDEX: 3})
+    assert provider.progress(100) == (50 + 3 * 10) / 4
+    provider.set_headers({DataWrapper.HEADERS_MAP_INDEX: 0})
+    assert provider.progress(50) == (50 + 30 + 2 * 10) / 4
+
+
+def _report(progress_list, index):
+    progress_list.set(index, 100)
+
+
+def test_progress_list_is_shared_with_processes():
+    progress_list = ProgressList(size=8)
+    workers = [Process(target=_report, args=(progress_list, index)) for index in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert progress_list.length.value == 4
+    assert progress_list.average() == 100
+    # indexes beyond the board size share a slot
+    progress_list.set(9, 0)
+    assert progress_list.average() == 75
@@ -35,7 +35,7 @@ def test_dupname():
     f = open('/tmp/_test_dupname.nc', 'w')
     f.close()
     newname = utils.dupname('/tmp', '_test_dupname')
-    assert '_test_dupname_1' == newname
+    assert '_test_dupname_dup1' == newname
 
     import os
     os.remove('/tmp/_test_dupname.nc')
@@ -43,6 +43,68 @@ def test_dupname():
     assert '_test_dupname' == newname
 
 
+def test_dupname_index(tmpdir):
+    for fname in ['tas.nc', 'tas_dup2.nc', 'tasmax.nc', 'pr_dup1.nc', 'uas_2001.nc']:
+        tmpdir.join(fname).write('')
+    assert utils.dupname(str(tmpdir), 'tas') == 'tas_dup3'
+    assert utils.dupname(str(tmpdir), 'tas') == 'tas_dup4'
+    assert utils.dupname(str(tmpdir), 'tasm') == 'tasm'
+    assert utils.dupname(str(tmpdir), 'pr') == 'pr_dup2'
+    # a date suffix is not a counter
+    assert utils.dupname(str(tmpdir), 'uas') == 'uas'
+    assert utils.dupname(str(tmpdir), 'uas_2001') == 'uas_2001_dup1'
+
+
+def test_reserve_name(tmpdir):
+    import threading
+    path = str(tmpdir)
+    names = []
+
+    def reserve(index):
+        for _ in range(20):
+            names.append(index.reserve('out', '.nc'))
+
+    # two indexes of the same directory act like two processes
+    indexes = [utils.NameIndex(path), utils.NameIndex(path)]
+    threads = [threading.Thread(target=reserve, args=(indexes[i % 2],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(names)) == 80
+    assert sorted(tmpdir.listdir()) == sorted(tmpdir.join(name + '.nc') for name in names)
+    assert utils.reserve_name(path, 'out', '.nc') == 'out_dup80'
+
+
+def test_reserve_name_after_rescan(tmpdir):
+    index = utils.NameIndex(str(tmpdir))
+    assert index.reserve('tas', '.nc') == 'tas'
+    # an unrelated file changes the directory and the index lists it again
+    tmpdir.join('pr.nc').write('')
+    assert index.reserve('tas', '.nc') == 'tas_dup1'
+
+
+def test_reserve_name_rescans(tmpdir, monkeypatch):
+    import os
+    path = str(tmpdir)
+    index = utils.NameIndex(path)
+    assert index.reserve('out', '.nc') == 'out'
+    # files created by someone else within the timestamp resolution keep the mtime of the directory
+    for count in range(1, 6):
+        tmpdir.join('out_dup{0}.nc'.format(count)).write('')
+    index.mtime = os.stat(path).st_mtime
+
+    opened = []
+    os_open = os.open
+
+    def counting_open(*args):
+        opened.append(args[0])
+        return os_open(*args)
+    monkeypatch.setattr(os, 'open', counting_open)
+    assert index.reserve('out', '.nc') == 'out_dup6'
+    assert len(opened) == 2
+
+
 def test_user_id():
     user_id = utils.user_id("https://esgf-data.dkrz.de/esgf-idp/openid/jule")
     assert user_id == "jule_esgf-data.dkrz.de"
@@ -111,6 +173,344 @@ def test_filter_timesteps2():
     assert len(result) == 3
 
 
+def _within_date_range_loop(timesteps, start=None, end=None):
+    # implementation with a python loop for comparison
+    from dateutil.parser import parse as date_parser
+    start_date = date_parser(start) if start else None
+    end_date = date_parser(end) if end else None
+    new_timesteps = []
+    for timestep in timesteps:
+        candidate = date_parser(timestep)
+        if start_date is not None and candidate < start_date:
+            continue
+        if end_date is not None and candidate > end_date:
+            break
+        new_timesteps.append(timestep)
+    return new_timesteps
+
+
+def _filter_timesteps_loop(timesteps, aggregation="monthly", start=None, end=None):
+    # implementation with a python loop for comparison
+    from dateutil.parser import parse as date_parser
+    timesteps.sort()
+    work_timesteps = _within_date_range_loop(timesteps, start, end)
+    new_timesteps = [work_timesteps[0]]
+    for index in range(1, len(work_timesteps)):
+        current = date_parser(new_timesteps[-1])
+        candidate = date_parser(work_timesteps[index])
+        if current.year < candidate.year:
+            new_timesteps.append(work_timesteps[index])
+        elif current.year == candidate.year:
+            if aggregation == "daily" and current.timetuple()[7] == candidate.timetuple()[7]:
+                continue
+            elif aggregation == "weekly" and current.isocalendar()[1] == candidate.isocalendar()[1]:
+                continue
+            elif aggregation == "monthly" and current.month == candidate.month:
+                continue
+            elif aggregation == "yearly":
+                continue
+            new_timesteps.append(work_timesteps[index])
+    return new_timesteps
+
+
+def _random_timesteps(count, fmt="%Y-%m-%dT%H:%M:%S.000Z"):
+    import random
+    from datetime import datetime, timedelta
+    random.seed(count)
+    date = datetime(2003, 12, 20)
+    timesteps = []
+    for _ in range(count):
+        date = date + timedelta(hours=random.choice([6, 6, 24, 24 * 5, 24 * 30]))
+        timesteps.append(date.strftime(fmt))
+    return timesteps
+
+
+@pytest.mark.parametrize("fmt", ["%Y-%m-%dT%H:%M:%S.000Z", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S+05:00"])
+def test_filter_timesteps_same_as_loop(fmt):
+    timesteps = _random_timesteps(500, fmt)
+    for aggregation in ["hourly", "daily", "weekly", "monthly", "yearly"]:
+        for (start, end) in [(None, None), ("2004-02-01T00:00:00Z", "2006-06-30T12:00:00Z")]:
+            if start and '+' not in fmt and 'Z' not in fmt:
+                start, end = start[:-1], end[:-1]
+            expected = _filter_timesteps_loop(list(timesteps), aggregation, start, end)
+            assert utils.filter_timesteps(list(timesteps), aggregation, start, end) == expected
+
+
+def test_within_date_range_unsorted():
+    timesteps = ["2013-11-02T12:00:00Z", "2013-11-01T12:00:00Z", "2013-11-12T12:00:00Z", "2013-11-03T12:00:00Z"]
+    result = utils.within_date_range(timesteps, start="2013-11-02T00:00:00Z", end="2013-11-09T12:00:00Z")
+    assert result == _within_date_range_loop(timesteps, "2013-11-02T00:00:00Z", "2013-11-09T12:00:00Z")
+    assert result == ["2013-11-02T12:00:00Z"]
+
+
+@pytest.mark.slow
+def test_filter_timesteps_benchmark():
+    import time
+    # 6-hourly timesteps of a century
+    timesteps = _random_timesteps(150000)
+
+    t0 = time.time()
+    expected = _filter_timesteps_loop(list(timesteps[:5000]), "daily")
+    loop_secs = (time.time() - t0) * 30
+
+    t0 = time.time()
+    result = utils.filter_timesteps(list(timesteps), "daily")
+    numpy_secs = time.time() - t0
+
+    assert result[:len(expected) - 1] == expected[:-1]
+    assert numpy_secs < loop_secs
+
+
+@pytest.mark.parametrize("prefetch", [True, False])
+def test_nc_copy_local(tmpdir, prefetch):
+    import numpy as np
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    # budget of 3 records of tas (10 x 20 floats) per chunk
+    utils.nc_copy(source, target, istart=10, istop=95, memory_budget=2 * 3 * 800, prefetch=prefetch)
+
+    nc_in = Dataset(source)
+    nc_out = Dataset(target)
+    assert len(nc_out.dimensions['time']) == 85
+    assert nc_out.title == 'test data'
+    for name in ['tas', 'pr', 'time']:
+        assert (nc_out.variables[name][:] == nc_in.variables[name][10:95]).all()
+    assert (nc_out.variables['lat'][:] == nc_in.variables['lat'][:]).all()
+    assert nc_out.variables['tas']._FillValue == np.float32(1e20)
+    nc_in.close()
+    nc_out.close()
+
+
+def test_nc_copy_netcdf4_single_thread(tmpdir, monkeypatch):
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')), format='NETCDF4')
+    target = str(tmpdir.join('target.nc'))
+
+    def no_thread(*args, **kwargs):
+        raise AssertionError('netcdf is read on another thread')
+    # netCDF-C/HDF5 are not thread-safe: by default the copy must not read on a background thread
+    monkeypatch.setattr(utils.threading, 'Thread', no_thread)
+    utils.nc_copy(source, target, format='NETCDF4', zlib=True, memory_budget=3 * 800)
+    utils.nc_concat([source], str(tmpdir.join('concat.nc')), format='NETCDF4', memory_budget=3 * 800)
+
+    nc_in = Dataset(source)
+    for filename in [target, str(tmpdir.join('concat.nc'))]:
+        nc_out = Dataset(filename)
+        assert nc_out.data_model == 'NETCDF4'
+        for name in ['tas', 'pr', 'time', 'lat', 'lon']:
+            assert (nc_out.variables[name][:] == nc_in.variables[name][:]).all()
+        nc_out.close()
+    nc_in.close()
+
+
+def test_nc_copy_chunks():
+    import numpy as np
+
+    class FakeVariable(object):
+        dtype = np.dtype('f4')
+        shape = (100, 10, 20)
+
+    slabs = utils._slabs(FakeVariable(), True, None, 10, 95, 4 * 800)
+    assert len(slabs) == 22
+    assert slabs[0] == (slice(10, 14), slice(0, 4), 4 * 800)
+    assert slabs[-1] == (slice(94, 95), slice(84, 85), 800)
+    assert len(utils._slabs(FakeVariable(), True, 10, 10, 95, 4 * 800)) == 9
+
+
+def test_nc_copy_closes_source_on_error(tmpdir):
+    from malleefowl.tests.common import write_test_nc, SlowDataset
+    closed = []
+
+    class Dataset(SlowDataset):
+        def close(self):
+            closed.append(True)
+            SlowDataset.close(self)
+
+    def open_dataset(path, mode):
+        return Dataset(path, mode, latency=0)
+
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    tmpdir.join('target.nc').write('exists')
+    with pytest.raises(Exception):
+        utils.nc_copy(source, target, overwrite=False, open_dataset=open_dataset)
+    assert tmpdir.join('target.nc').read() == 'exists'
+    assert closed == [True]
+
+
+@pytest.mark.parametrize("chunking,chunks", [('timeseries', [85, 10, 20]), ('map', [1, 10, 20])])
+def test_nc_copy_netcdf4(tmpdir, chunking, chunks):
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    stats = utils.nc_copy(source, target, istart=10, istop=95, format='NETCDF4_CLASSIC',
+                          zlib=True, chunking=chunking)
+    assert stats['nbytes'] == 2 * 85 * 800 + 85 * 8 + 10 * 4 + 20 * 4
+    assert stats['ratio'] > 1
+
+    nc_in = Dataset(source)
+    nc_out = Dataset(target)
+    assert nc_out.data_model == 'NETCDF4_CLASSIC'
+    assert (nc_out.variables['tas'][:] == nc_in.variables['tas'][10:95]).all()
+    assert nc_out.variables['tas'].filters()['zlib'] is True
+    assert nc_out.variables['tas'].chunking() == chunks
+    nc_in.close()
+    nc_out.close()
+
+
+def test_nc_copy_chunk_sizes():
+    # chunks of at most 1 MB
+    assert utils._chunk_sizes(['time', 'lat', 'lon'], [36500, 180, 360], 4, 'timeseries', 'time') == [36500, 1, 3]
+    assert utils._chunk_sizes(['time', 'lat', 'lon'], [3650, 180, 360], 4, 'timeseries', 'time') == [3650, 5, 11]
+    assert utils._chunk_sizes(['time', 'lat', 'lon'], [3650, 720, 1440], 4, 'map', 'time') == [1, 362, 724]
+    assert utils._chunk_sizes(['lat', 'lon'], [180, 360], 4, 'map', 'time') is None
+
+
+def test_nc_copy_compression_needs_netcdf4(tmpdir):
+    with pytest.raises(ValueError):
+        utils.nc_copy('source.nc', str(tmpdir.join('target.nc')), zlib=True)
+
+
+def test_nc_copy_subset(tmpdir):
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    utils.nc_copy(source, target, start='2000-01-11', end='2000-01-21T12:00:00Z', bbox=(10, -50, 80, 50),
+                  memory_budget=2 * 3 * 100)
+
+    nc_in = Dataset(source)
+    nc_out = Dataset(target)
+    assert len(nc_out.dimensions['time']) == 11
+    assert list(nc_out.variables['lon'][:]) == [18, 36, 54, 72]
+    assert (nc_out.variables['lat'][:] == nc_in.variables['lat'][2:8]).all()
+    assert (nc_out.variables['time'][:] == nc_in.variables['time'][10:21]).all()
+    assert (nc_out.variables['tas'][:] == nc_in.variables['tas'][10:21, 2:8, 1:5]).all()
+    nc_in.close()
+    nc_out.close()
+
+
+def test_nc_copy_subset_calendar(tmpdir):
+    from netCDF4 import num2date
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')), calendar='360_day')
+    target = str(tmpdir.join('target.nc'))
+    # 2000-02-30 of the 360_day calendar
+    end = num2date(59, 'days since 2000-01-01 00:00:00', '360_day')
+    utils.nc_copy(source, target, start='2000-02-01', end=end)
+    nc_out = Dataset(target)
+    assert list(nc_out.variables['time'][[0, -1]]) == [30, 59]
+    nc_out.close()
+
+    with pytest.raises(ValueError):
+        utils.nc_copy(source, target, start='2001-01-01')
+    with pytest.raises(ValueError):
+        utils.nc_copy(source, target, bbox=(100, 95, 120, 100))
+
+
+def test_nc_copy_subset_prime_meridian(tmpdir):
+    import numpy as np
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    # crosses the 0 meridian of the 0-360 grid (lon = 0, 18, ... 342)
+    utils.nc_copy(source, target, bbox=(-40, 35, 40, 70), memory_budget=3 * 3 * 800)
+
+    nc_in = Dataset(source)
+    nc_out = Dataset(target)
+    assert list(nc_out.variables['lon'][:]) == [-36, -18, 0, 18, 36]
+    expected = np.concatenate([nc_in.variables['tas'][:, 7:9, 18:], nc_in.variables['tas'][:, 7:9, :3]], axis=2)
+    assert (nc_out.variables['tas'][:] == expected).all()
+    nc_in.close()
+    nc_out.close()
+
+    # the whole longitude axis
+    utils.nc_copy(source, target, bbox=(-180, -90, 180, 90))
+    nc_out = Dataset(target)
+    assert len(nc_out.dimensions['lon']) == 20
+    nc_out.close()
+
+
+def test_nc_copy_resume(tmpdir):
+    import os
+    from malleefowl.tests.common import write_test_nc
+    source = write_test_nc(str(tmpdir.join('source.nc')))
+    target = str(tmpdir.join('target.nc'))
+    status = []
+
+    def failing_monitor(message, progress):
+        status.append(progress)
+        if progress > 50:
+            raise Exception('connection lost')
+
+    with pytest.raises(Exception):
+        utils.nc_copy(source, target, memory_budget=10 * 800, prefetch=False, resume=True,
+                      monitor=failing_monitor)
+    assert os.path.exists(target + '.checkpoint')
+
+    progress = []
+    stats = utils.nc_copy(source, target, memory_budget=10 * 800, resume=True,
+                          monitor=lambda message, value: progress.append(value))
+    assert stats['nbytes'] < 2 * 100 * 800
+    assert progress[0] > 50
+    assert progress[-1] == 100
+    assert not os.path.exists(target + '.checkpoint')
+
+    nc_in = Dataset(source)
+    nc_out = Dataset(target)
+    for name in ['tas', 'pr', 'time', 'lat', 'lon']:
+        assert (nc_out.variables[name][:] == nc_in.variables[name][:]).all()
+    nc_in.close()
+    nc_out.close()
+
+
+def _yearly_files(tmpdir):
+    from malleefowl.tests.common import write_test_nc
+    files = []
+    for index, dates in enumerate(['20000101-20000410', '20000410-20000718', '20000719-20001025']):
+        files.append(write_test_nc(
+            str(tmpdir.join('tas_day_MPI-ESM-LR_historical_r1i1p1_{0}.nc'.format(dates))),
+            ntime=100, start=index * 100))
+    return files
+
+
+def test_nc_concat(tmpdir):
+    import numpy as np
+    files = _yearly_files(tmpdir)
+    # the last file has other time units
+    nc = Dataset(files[2], 'a')
+    nc.variables['time'].units = 'days since 2000-07-19 00:00:00'
+    nc.variables['time'][:] = np.arange(100)
+    nc.close()
+    target = str(tmpdir.join('tas.nc'))
+    ordered = utils.nc_concat([files[2], files[0], 'file://' + files[1]], target, memory_budget=2 * 7 * 800)
+    assert ordered == [files[0], 'file://' + files[1], files[2]]
+
+    nc_out = Dataset(target)
+    assert len(nc_out.dimensions['time']) == 300
+    assert (nc_out.variables['time'][:] == np.arange(300)).all()
+    assert (nc_out.variables['tas'][:, 0, 0] == np.arange(300, dtype='f4')).all()
+    assert (nc_out.variables['pr'][:, 0, 0] == np.arange(1000, 1300, dtype='f4')).all()
+    assert nc_out.variables['lat'].shape == (10,)
+    nc_out.close()
+
+
+def test_nc_concat_overlap(tmpdir):
+    from malleefowl.tests.common import write_test_nc
+    files = _yearly_files(tmpdir)
+    files.append(write_test_nc(str(tmpdir.join('tas_day_MPI-ESM-LR_historical_r1i1p1_20001020-20001130.nc')),
+                               start=290))
+    with pytest.raises(ValueError):
+        utils.nc_concat(files, str(tmpdir.join('tas.nc')))
+
+
+def test_index_range():
+    assert utils._index_range([1, 2, 3, 4, 5], 2, 4) == (1, 4)
+    assert utils._index_range([1, 2, 3, 4, 5], 2.5, None) == (2, 5)
+    assert utils._index_range([5, 4, 3, 2, 1], 2, 4) == (1, 4)
+    assert utils._index_range([5, 4, 3, 2, 1], 6, 7) == (0, 0)
+
+
 @pytest.mark.skipif(reason="no way of currently testing this")
 def test_nc_copy():
     dap_url = "http://bmbf-ipcc-ar5.dkrz.de/thredds/dodsC/cmip5.output1.MPI-M.MPI-ESM-LR.esmHistorical.day.atmos.day.r1i1p1.tas.20120315.aggregation"  # noqa
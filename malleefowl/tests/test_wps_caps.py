@@ -15,8 +15,10 @@ def test_wps_caps():
                             '/wps:Process'
                             '/ows:Identifier')
     assert sorted(names.split()) == [
+        'custom_workflow',
         'download',
         'esgsearch',
+        'esgsearch_download',
         'thredds_download',
         'workflow'
     ]
@@ -0,0 +1,65 @@
+from multiprocessing import Process
+
+from malleefowl.processes.wps_custom_workflow import WorkflowCollector
+
+
+class FakeResponse(object):
+    def __init__(self):
+        self.status = []
+
+    def update_status(self, message, progress):
+        self.status.append((message, progress))
+
+
+def _task(collector, index):
+    collector.update_status('task {0} running'.format(index), 10 + index)
+    collector.update_status('task {0} is sending value'.format(index), verbose=True)
+    collector.save_task_result('subset', dict(data_id=index, status='done'))
+    if index == 2:
+        try:
+            raise ValueError('task failed')
+        except ValueError as e:
+            collector.raise_exception(e)
+
+
+def test_collector(tmpdir):
+    response = FakeResponse()
+    collector = WorkflowCollector(response, str(tmpdir.join('logfile.txt')), status_rate=1000)
+    collector.start()
+    collector.update_status('starting workflow ...', 0)
+    collector.save_task_result('download', dict(status='done'))
+    tasks = [Process(target=_task, args=(collector, index)) for index in range(4)]
+    for task in tasks:
+        task.start()
+    for task in tasks:
+        task.join()
+    collector.log('done')
+    collector.close()
+
+    # task updates arriving within the status interval are coalesced, so not every task status is sent
+    assert response.status[0] == ('starting workflow ...', 0)
+    assert 2 <= len(response.status) <= 5
+    assert set(response.status[1:]) <= set(('task {0} running'.format(index), 10 + index) for index in range(4))
+    lines = tmpdir.join('logfile.txt').read().splitlines()
+    assert lines == collector.full_log
+    assert len(lines) == 10
+    assert lines[-1] == 'done'
+    assert len(collector.exceptions_list) == 1
+    assert 'task failed' in collector.exceptions_list[0]
+    summary = collector.summary()
+    assert summary[0] == {'download': [dict(status='done')]}
+    assert [result['data_id'] for result in summary[1]['subset']] == [0, 1, 2, 3]
+
+
+def test_collector_coalesces_status(tmpdir):
+    response = FakeResponse()
+    collector = WorkflowCollector(response, str(tmpdir.join('logfile.txt')), status_rate=0.1)
+    collector.start()
+    for progress in range(50):
+        collector.update_status('task running', progress)
+    collector.update_status('task done', 90, flush=True)
+    collector.update_status('workflow done', 100)
+    collector.close()
+
+    assert response.status == [('task running', 0), ('task done', 90), ('workflow done', 100)]
+    assert len(collector.full_log) == 52
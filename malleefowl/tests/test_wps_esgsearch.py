@@ -120,3 +120,17 @@ def test_file():
         identifier='esgsearch',
         datainputs=datainputs)
     assert_response_success(resp)
+
+
+def test_file_ndjson():
+    from malleefowl.tests.common import FakeSearchIndex, cordex_docs
+    client = client_for(Service(processes=[ESGSearchProcess()]))
+    with FakeSearchIndex(cordex_docs()) as index:
+        datainputs = "url={};search_type={};limit={};constraints={};output_format={}".format(
+            index.url, 'File', '2', 'project:CORDEX', 'ndjson')
+        resp = client.get(
+            service='WPS', request='Execute', version='1.0.0',
+            identifier='esgsearch',
+            datainputs=datainputs)
+    assert_response_success(resp)
+    assert 'application/x-ndjson' in resp.get_data()
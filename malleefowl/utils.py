@@ -2,10 +2,16 @@
 Utility functions for WPS processes.
 """
 
+import re
 import json
 from netCDF4 import Dataset
 import os
+import errno
 import copy
+import time
+import threading
+from Queue import Queue
+import numpy as np
 
 from malleefowl import config
 
@@ -43,16 +49,111 @@ def esgf_archive_path(url):
     return archive_path
 
 
+# Separator of the counter added by dupname. A dedicated separator keeps names
+# ending with a number (like tas_2001) from being taken for generated names.
+DUPNAME_SEPARATOR = '_dup'
+NUMBERED_NAME_REXP = re.compile(r'^(.+)' + DUPNAME_SEPARATOR + r'(\d+)$')
+
+
+class NameIndex(object):
+    """
+    In-memory index of the file names in directory ``path`` which generates unique names
+    like ``tas``, ``tas_dup1``, ``tas_dup2``, ...
+
+    The index keeps the next counter of each base name (file name without extension).
+    The directory is only listed again when it was changed by someone else (its mtime changed)
+    or when a name could not be reserved, because changes within the timestamp resolution
+    of the filesystem do not change the mtime.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.mtime = None
+
+    def _refresh(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+        counters = {}
+        for fname in os.listdir(self.path):
+            stem = os.path.splitext(fname)[0]
+            counters[stem] = max(counters.get(stem, 0), 1)
+            mo = NUMBERED_NAME_REXP.match(stem)
+            if mo:
+                base = mo.group(1)
+                counters[base] = max(counters.get(base, 0), int(mo.group(2)) + 1)
+        self.counters = counters
+        self.mtime = mtime
+
+    def name(self, filename):
+        """
+        Returns a name for ``filename`` which is not used in the directory.
+
+        Names returned before are only remembered until the directory is listed again,
+        so a name which was not created yet can be returned twice. Use :meth:`reserve`
+        to get a name which is exclusive.
+        """
+        with self.lock:
+            self._refresh()
+            count = self.counters.get(filename, 0)
+            self.counters[filename] = count + 1
+        if count == 0:
+            return filename
+        return filename + DUPNAME_SEPARATOR + str(count)
+
+    def reserve(self, filename, suffix=''):
+        """
+        Returns a name for ``filename`` and creates the empty file ``name + suffix``.
+        The file is created with ``O_EXCL``, so concurrent processes never get the same name.
+        """
+        while True:
+            name = self.name(filename)
+            try:
+                fd = os.open(os.path.join(self.path, name + suffix), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                LOGGER.debug('name %s is already used', name)
+                # the directory was changed without changing its mtime
+                with self.lock:
+                    self.mtime = None
+                continue
+            os.close(fd)
+            with self.lock:
+                self.mtime = os.stat(self.path).st_mtime
+            return name
+
+
+_name_indexes = {}
+_name_indexes_lock = threading.Lock()
+
+
+def name_index(path):
+    """
+    Returns the :class:`NameIndex` of directory ``path``.
+    """
+    path = os.path.abspath(path)
+    with _name_indexes_lock:
+        if path not in _name_indexes:
+            _name_indexes[path] = NameIndex(path)
+        return _name_indexes[path]
+
+
 def dupname(path, filename):
     """
-    avoid dupliate filenames
-    TODO: needs to be improved
+    avoid dupliate filenames: returns ``filename`` or ``filename_dup<n>`` if there is already
+    a file with this name (and any extension) in ``path``.
+    The name is not reserved: use :func:`reserve_name` to also create the file.
     """
-    newname = filename
-    count = sum(1 for fname in os.listdir(path) if filename in fname)
-    if count > 0:
-        return newname + '_' + str(count)
-    return newname
+    return name_index(path).name(filename)
+
+
+def reserve_name(path, filename, suffix=''):
+    """
+    Returns a unique name for ``filename`` in ``path`` and creates the empty file ``name + suffix``.
+    """
+    return name_index(path).reserve(filename, suffix)
 
 
 def user_id(openid):
@@ -73,65 +174,573 @@ def user_id(openid):
     return user_id
 
 
-def within_date_range(timesteps, start=None, end=None):
+def _parse_timesteps(timesteps):
+    """
+    Parses timestep strings once into numpy arrays.
+
+    :returns: tuple ``(dates, local_dates)`` of ``datetime64[us]`` arrays. ``dates`` are in UTC
+        and used for comparisons. ``local_dates`` keep the wall time of timesteps with utc offset
+        and are used for the calendar fields (like :func:`dateutil.parser.parse` would).
+    """
+    import warnings
+    values = [timestep[:-1] if timestep.endswith('Z') else timestep for timestep in timesteps]
+    try:
+        # fast path for ISO timesteps without utc offset. numpy only warns about offsets.
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            dates = np.array(values, dtype='datetime64[us]')
+        return (dates, dates)
+    except (ValueError, DeprecationWarning):
+        pass
     from dateutil.parser import parse as date_parser
-    start_date = None
-    if start is not None:
-        start_date = date_parser(start)
-    end_date = None
-    if end is not None:
-        end_date = date_parser(end)
-    new_timesteps = []
+    dates = []
+    local_dates = []
     for timestep in timesteps:
-        candidate = date_parser(timestep)
-        # within time range?
-        if start_date is not None and candidate < start_date:
-            continue
-        if end_date is not None and candidate > end_date:
-            break
-        new_timesteps.append(timestep)
-    return new_timesteps
+        date = date_parser(timestep)
+        local_date = date.replace(tzinfo=None)
+        local_dates.append(local_date)
+        if date.tzinfo is not None:
+            dates.append(local_date - date.utcoffset())
+        else:
+            dates.append(local_date)
+    return (np.array(dates, dtype='datetime64[us]'), np.array(local_dates, dtype='datetime64[us]'))
+
+
+def _parse_date(value):
+    return _parse_timesteps([value])[0][0]
+
+
+def _date_range_index(dates, start=None, end=None):
+    """
+    Returns the indices of ``dates`` within ``start`` and ``end``. As in a loop over the dates,
+    the first date after ``end`` stops the selection.
+    """
+    is_sorted = len(dates) < 2 or bool(np.all(dates[1:] >= dates[:-1]))
+    stop = len(dates)
+    if end is not None:
+        end_date = _parse_date(end)
+        if is_sorted:
+            stop = np.searchsorted(dates, end_date, side='right')
+        else:
+            after = np.flatnonzero(dates > end_date)
+            if len(after) > 0:
+                stop = after[0]
+    if start is None:
+        return np.arange(stop)
+    start_date = _parse_date(start)
+    if is_sorted:
+        return np.arange(np.searchsorted(dates[:stop], start_date, side='left'), stop)
+    return np.flatnonzero(dates[:stop] >= start_date)
+
+
+def within_date_range(timesteps, start=None, end=None):
+    if len(timesteps) == 0:
+        return []
+    dates, _ = _parse_timesteps(timesteps)
+    return [timesteps[i] for i in _date_range_index(dates, start, end)]
+
+
+def _calendar_fields(dates, aggregation):
+    """
+    Returns the years and the field (day of year, iso week, month or year) compared
+    by the ``aggregation``, or None for aggregations which keep all timesteps.
+    """
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    if aggregation == "daily":
+        field = days - dates.astype('datetime64[Y]').astype('datetime64[D]').astype(np.int64)
+    elif aggregation == "weekly":
+        # iso week is the week of the thursday of the same week (1970-01-01 is a thursday)
+        thursdays = days - (days + 3) % 7 + 3
+        year_starts = thursdays.astype('datetime64[D]').astype('datetime64[Y]').astype('datetime64[D]')
+        field = (thursdays - year_starts.astype(np.int64)) // 7 + 1
+    elif aggregation == "monthly":
+        field = dates.astype('datetime64[M]').astype(np.int64) % 12
+    elif aggregation == "yearly":
+        field = years
+    else:
+        field = None
+    return (years, field)
 
 
 def filter_timesteps(timesteps, aggregation="monthly", start=None, end=None):
-    from dateutil.parser import parse as date_parser
+    """
+    Selects the first timestep of each day, week, month or year (``aggregation``)
+    within ``start`` and ``end``. Other aggregations (like ``hourly``) keep all timesteps.
+
+    .. note:: ``timesteps`` is sorted in place.
+    """
     LOGGER.debug("aggregation: %s", aggregation)
 
     if (timesteps is None or len(timesteps) == 0):
         return []
     timesteps.sort()
-    work_timesteps = within_date_range(timesteps, start, end)
-
-    new_timesteps = [work_timesteps[0]]
-
-    for index in range(1, len(work_timesteps)):
-        current = date_parser(new_timesteps[-1])
-        candidate = date_parser(work_timesteps[index])
-
-        if current.year < candidate.year:
-            new_timesteps.append(work_timesteps[index])
-        elif current.year == candidate.year:
-            if aggregation == "daily":
-                if current.timetuple()[7] == candidate.timetuple()[7]:
-                    continue
-            elif aggregation == "weekly":
-                if current.isocalendar()[1] == candidate.isocalendar()[1]:
-                    continue
-            elif aggregation == "monthly":
-                if current.month == candidate.month:
-                    continue
-            elif aggregation == "yearly":
-                if current.year == candidate.year:
-                    continue
-            # all checks passed
-            new_timesteps.append(work_timesteps[index])
+    dates, local_dates = _parse_timesteps(timesteps)
+    index = _date_range_index(dates, start, end)
+    if len(index) == 0:
+        return []
+    years, field = _calendar_fields(local_dates[index], aggregation)
+
+    if np.all(years[1:] >= years[:-1]):
+        # the timestep is compared with the last selected one which has the same
+        # year and field as the previous timestep.
+        keep = np.ones(len(index), dtype=bool)
+        if field is not None:
+            keep[1:] = (years[1:] != years[:-1]) | (field[1:] != field[:-1])
+        return [timesteps[i] for i in index[keep]]
+
+    # timesteps with utc offsets may not be sorted by their local year
+    new_index = [0]
+    for i in range(1, len(index)):
+        current = new_index[-1]
+        if years[current] < years[i]:
+            new_index.append(i)
+        elif years[current] == years[i]:
+            if field is not None and field[current] == field[i]:
+                continue
+            new_index.append(i)
+    return [timesteps[index[i]] for i in new_index]
+
+
+class ByteBudget(object):
+    """
+    Limits the number of bytes held in memory by concurrent readers and writers.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        """
+        Blocks until ``nbytes`` are available. A single request larger than the budget
+        is granted when nothing else is held.
+        """
+        with self.cond:
+            while not self.closed and self.used > 0 and self.used + nbytes > self.max_bytes:
+                self.cond.wait()
+            if self.closed:
+                raise Exception("budget is closed")
+            self.used = self.used + nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used = self.used - nbytes
+            self.cond.notify_all()
+
+    def close(self):
+        """
+        Wakes up and fails all waiting and future :meth:`acquire` calls.
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def _record_nbytes(ncvar, shape=None):
+    """bytes of one record (along the first dimension) of a netcdf variable with (subset) ``shape``."""
+    if ncvar.dtype == str:
+        itemsize = 64
+    else:
+        itemsize = ncvar.dtype.itemsize
+    if shape is None:
+        shape = ncvar.shape
+    return max(1, itemsize * int(np.prod(shape[1:])))
+
+
+def _slabs(ncvar, hasunlimdim, nchunk, istart, istop, slab_bytes, subset=None):
+    """
+    Splits the copy of a variable into ``(read_slice, write_slice, nbytes)`` slabs.
+    Without ``nchunk`` the number of records per slab is derived from ``slab_bytes``.
+    ``subset`` maps dimension names to the index slices which are read (see :func:`_bbox_subset`).
+    The read slice of a subset variable is a tuple of slices.
+    """
+    subset = dict((name, index) for name, index in (subset or {}).items() if name in ncvar.dimensions)
+    shape = ncvar.shape
+    if subset:
+        shape = tuple(_index_size(subset[name], size) if name in subset else size
+                      for name, size in zip(ncvar.dimensions, ncvar.shape))
+
+    def _read_slice(index):
+        if not subset:
+            return index
+        return (index,) + tuple(subset.get(name, slice(None)) for name in ncvar.dimensions[1:])
+
+    record_nbytes = _record_nbytes(ncvar, shape)
+    if not hasunlimdim:
+        # no unlim dim or 1-d variable, just copy all data at once.
+        return [(_read_slice(subset.get(ncvar.dimensions[0], slice(None)) if shape else slice(None)),
+                 slice(None), record_nbytes * (shape[0] if shape else 1))]
+    if nchunk == 0:
+        return [(_read_slice(slice(istart, istop)), slice(0, istop - istart), record_nbytes * (istop - istart))]
+    step = max(1, nchunk or slab_bytes // record_nbytes)
+    slabs = []
+    for n in range(istart, istop, step):
+        nmax = min(n + step, istop)
+        slabs.append((_read_slice(slice(n, nmax)), slice(n - istart, nmax - istart), record_nbytes * (nmax - n)))
+    return slabs
+
+
+def _index_range(values, low=None, high=None):
+    """
+    Binary search of the index range ``[start, stop)`` of the sorted (ascending or descending)
+    coordinate ``values`` which are within ``low`` and ``high``.
+    """
+    values = np.asarray(values)
+    if values.size > 1 and values[0] > values[-1]:
+        start, stop = _index_range(values[::-1], low, high)
+        return (values.size - stop, values.size - start)
+    start = 0 if low is None else int(np.searchsorted(values, low, side='left'))
+    stop = values.size if high is None else int(np.searchsorted(values, high, side='right'))
+    return (start, max(start, stop))
+
+
+def _as_datetime(value):
+    """
+    Returns a naive (utc) datetime for a date string or datetime.
+    Other date objects (like the dates of non-standard calendars from ``netCDF4.num2date``) are returned unchanged.
+    """
+    if isinstance(value, basestring):
+        return _parse_date(value).astype(object)
+    if getattr(value, 'tzinfo', None) is not None:
+        return value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def _time_range(ncvar, start=None, end=None):
+    """
+    Returns the record range ``(istart, istop)`` of the time coordinate ``ncvar`` within ``start`` and ``end``.
+    The dates are converted with the units and calendar of ``ncvar``.
+    """
+    from netCDF4 import date2num
+    calendar = getattr(ncvar, 'calendar', 'standard')
+    bounds = [None if date is None else date2num(_as_datetime(date), ncvar.units, calendar)
+              for date in (start, end)]
+    return _index_range(ncvar[:], *bounds)
+
+
+def _find_coordinate(nc, names, units):
+    for name, ncvar in nc.variables.items():
+        if ncvar.dimensions != (name,):
+            continue
+        if name in names or getattr(ncvar, 'units', None) in units or \
+                getattr(ncvar, 'standard_name', None) == names[0]:
+            return name
+    raise ValueError("no 1-d %s coordinate found" % names[0])
+
+
+def _bbox_subset(nc, bbox):
+    """
+    Returns the index slices of the lat/lon dimensions within ``bbox`` (min_lon, min_lat, max_lon, max_lat).
+    The longitudes of the bbox are shifted to the range of the longitude coordinate.
+
+    If the bbox crosses the end of the longitude axis (like the 0 meridian of a 0-360 grid)
+    the longitude index is a list of two slices which are read and joined (see :func:`_read_subset`).
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lat_name = _find_coordinate(nc, ('latitude', 'lat'), ('degrees_north', 'degree_north'))
+    lon_name = _find_coordinate(nc, ('longitude', 'lon'), ('degrees_east', 'degree_east'))
+    lons = np.asarray(nc.variables[lon_name][:])
+    if max_lon - min_lon >= 360:
+        min_lon, max_lon = None, None
+    elif lons.min() >= 0:
+        min_lon, max_lon = min_lon % 360, max_lon % 360
+        if max_lon == 0 and bbox[2] > bbox[0]:
+            max_lon = 360
+    subset = {}
+    for name, low, high in [(lat_name, min_lat, max_lat), (lon_name, min_lon, max_lon)]:
+        if name == lon_name and min_lon > max_lon:
+            if lons.size > 1 and lons[0] > lons[-1]:
+                raise ValueError("bbox %s crosses the end of the descending longitudes of the data" % (bbox,))
+            # the eastern end of the axis followed by its western start
+            index = [slice(*_index_range(lons, min_lon, None)), slice(*_index_range(lons, None, max_lon))]
+            index = [piece for piece in index if piece.start < piece.stop]
+            if len(index) == 1:
+                index = index[0]
         else:
+            index = slice(*_index_range(nc.variables[name][:], low, high))
+        if _index_size(index, len(nc.dimensions[name])) == 0:
+            raise ValueError("no %s values within bbox %s" % (name, bbox))
+        subset[name] = index
+    return subset
+
+
+def _index_size(index, size):
+    """number of items selected by the slice (or list of slices) ``index`` of a dimension of ``size``."""
+    if isinstance(index, list):
+        return sum(_index_size(piece, size) for piece in index)
+    return len(range(*index.indices(size)))
+
+
+def _index_key(index):
+    """json representation of the slice (or list of slices) ``index``."""
+    if isinstance(index, list):
+        return [_index_key(piece) for piece in index]
+    return [index.start, index.stop]
+
+
+def _read_subset(ncvar, index):
+    """
+    Returns ``ncvar[index]``. One item of the tuple ``index`` may be a list of slices,
+    which are read one after the other and joined along their axis.
+    """
+    if isinstance(index, tuple):
+        for axis, item in enumerate(index):
+            if isinstance(item, list):
+                return np.ma.concatenate(
+                    [_read_subset(ncvar, index[:axis] + (piece,) + index[axis + 1:]) for piece in item], axis=axis)
+    return ncvar[index]
+
+
+def _longitude_shift(nc, subset, bbox):
+    """
+    Returns a function ``convert(varname, data)`` which shifts the longitudes (and longitude bounds)
+    of a subset crossing the end of the longitude axis by multiples of 360 degrees,
+    so that they are increasing like the longitudes of ``bbox``. Returns None if the subset does not cross it.
+    """
+    for name, index in subset.items():
+        if not isinstance(index, list):
             continue
-    return new_timesteps
+        ncvar = nc.variables[name]
+        names = [name] + getattr(ncvar, 'bounds', '').split()
+        count = index[0].stop - index[0].start
+        # the first piece starts at the west of the bbox, the second one follows 360 degrees later
+        west = bbox[0] % 360 if ncvar[:].min() >= 0 else bbox[0]
+        shift = bbox[0] - west
+
+        def convert(varname, data):
+            if varname in names:
+                data = data.copy()
+                data[:count] = data[:count] + shift
+                data[count:] = data[count:] + shift + 360
+            return data
+        return convert
+    return None
+
+
+CHUNK_BYTES = 1 << 20
+
+
+def _fit_chunk(sizes, max_items):
+    """
+    Shrinks all ``sizes`` by the same factor until their product is at most ``max_items``.
+    """
+    if not sizes:
+        return []
+    factor = min(1.0, (float(max(1, max_items)) / np.prod(sizes, dtype='f8')) ** (1.0 / len(sizes)))
+    return [max(1, int(size * factor)) for size in sizes]
 
 
-def nc_copy(source, target, overwrite=True, time_dimname='time', nchunk=10, istart=0, istop=-1, format='NETCDF3_64BIT'):
-    """copy netcdf file from opendap to netcdf3 file
+def _chunk_sizes(dimensions, shape, itemsize, chunking, time_dimname):
+    """
+    Chunk shape of a netcdf4 variable for the access pattern ``chunking``:
+
+    * ``timeseries``: the full time axis of a few grid cells per chunk.
+    * ``map``: one time step of the (full) grid per chunk.
+
+    Chunks hold at most about ``CHUNK_BYTES``. Returns None (library default) for variables without time axis.
+    """
+    if chunking not in ('timeseries', 'map'):
+        raise ValueError("unknown chunking %s" % chunking)
+    if time_dimname not in dimensions:
+        return None
+    shape = [max(1, size) for size in shape]
+    itime = dimensions.index(time_dimname)
+    other = shape[:itime] + shape[itime + 1:]
+    max_items = CHUNK_BYTES // itemsize
+    if chunking == 'timeseries':
+        ntime = min(shape[itime], max_items)
+        other = _fit_chunk(other, max_items // ntime)
+    else:
+        ntime = 1
+        other = _fit_chunk(other, max_items)
+    return other[:itime] + [ntime] + other[itime:]
+
+
+def _read_slabs(nc, jobs, budget):
+    """
+    Reads the slabs of ``jobs`` (tuples of variable name and slabs) from dataset ``nc``.
+
+    :returns: generator of ``(varname, write_slice, data, nbytes)``.
+        ``data`` is None after the last slab of a variable.
+    """
+    for varname, slabs in jobs:
+        ncvar = nc.variables[varname]
+        for read_slice, write_slice, nbytes in slabs:
+            budget.acquire(nbytes)
+            try:
+                data = _read_subset(ncvar, read_slice)
+            except Exception:
+                budget.release(nbytes)
+                raise Exception("%s: could not read records %s:%s" %
+                                (varname, write_slice.start, write_slice.stop))
+            yield (varname, write_slice, data, nbytes)
+        yield (varname, None, None, 0)
+
+
+def _fetch_slabs(nc, jobs, budget, output):
+    """
+    Puts the slabs read by :func:`_read_slabs` to the ``output`` queue. Errors are put to the queue as well.
+    """
+    try:
+        for item in _read_slabs(nc, jobs, budget):
+            output.put(item)
+    except Exception as e:
+        output.put(e)
+
+
+def _queue_items(queue, count):
+    """
+    Generator of the slabs put to ``queue`` by :func:`_fetch_slabs` until ``count`` variables are complete.
+    """
+    while count > 0:
+        item = queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item[2] is None:
+            count = count - 1
+        yield item
+
+
+def _selected_variables(nc, variables):
+    """
+    Returns the names of ``variables`` and of the coordinate, bounds and auxiliary coordinate variables they need.
+    """
+    selected = set()
+    pending = list(variables)
+    while pending:
+        name = pending.pop()
+        if name in selected:
+            continue
+        if name not in nc.variables:
+            raise ValueError("variable %s not found" % name)
+        selected.add(name)
+        ncvar = nc.variables[name]
+        pending.extend(dimname for dimname in ncvar.dimensions if dimname in nc.variables)
+        for attname in ('bounds', 'coordinates'):
+            pending.extend(item for item in getattr(ncvar, attname, '').split() if item in nc.variables)
+    return selected
+
+
+def _define_variable(nc_out, varname, ncvar, unlimdimname, zlib=False, complevel=4, shuffle=True,
+                     chunking=None):
+    """
+    Creates variable ``varname`` like ``ncvar`` in ``nc_out`` and copies its attributes.
+    """
+    if hasattr(ncvar, '_FillValue'):
+        FillValue = ncvar._FillValue
+    else:
+        FillValue = None
+    options = {}
+    if isinstance(ncvar.dtype, np.dtype):
+        if zlib:
+            options.update(zlib=True, complevel=complevel, shuffle=shuffle)
+        if chunking:
+            options['chunksizes'] = _chunk_sizes(
+                list(ncvar.dimensions), [len(nc_out.dimensions[name]) for name in ncvar.dimensions],
+                ncvar.dtype.itemsize, chunking, unlimdimname)
+    var = nc_out.createVariable(varname, ncvar.dtype, ncvar.dimensions, fill_value=FillValue, **options)
+    # fill variable attributes.
+    attdict = dict((name, ncvar.getncattr(name)) for name in ncvar.ncattrs())
+    if '_FillValue' in attdict:
+        del attdict['_FillValue']
+    var.setncatts(attdict)
+    return var
+
+
+def _slab_stop(write_slice):
+    """output record after a written slab. Variables without unlimited dimension count as one record."""
+    if write_slice.stop is None:
+        return 1
+    return write_slice.stop
+
+
+def _load_checkpoint(path, key):
+    """
+    Returns the committed records per variable of the checkpoint ``path``
+    or None if there is no checkpoint for a copy with the options ``key``.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as fp:
+            checkpoint = json.load(fp)
+    except ValueError:
+        LOGGER.warn('ignoring broken checkpoint %s', path)
+        return None
+    if checkpoint.get('key') != json.loads(json.dumps(key)):
+        LOGGER.info('checkpoint %s is for another copy', path)
+        return None
+    return checkpoint['records']
+
+
+def _save_checkpoint(path, key, records):
+    """
+    Writes the committed records per variable to the checkpoint ``path``. The file is replaced atomically.
+    """
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(dict(key=key, records=records), fp)
+    os.rename(path + '.tmp', path)
+
+
+def _copy_slabs(nc_in, nc_out, jobs, memory_budget, prefetch=False, offset=0, convert=None, committed=None):
+    """
+    Copies the slabs of ``jobs`` from ``nc_in`` to ``nc_out`` within ``memory_budget``.
+    The slabs are read inline or by a prefetch thread. The calling thread is the only writer.
+
+    :param offset: number of records the slabs are written after their record range.
+    :param convert: optional function ``convert(varname, data)`` applied to the data before writing.
+    :param committed: optional function ``committed(varname, write_slice, nbytes)`` called after
+        each written slab and (with write_slice None) after each copied variable.
+    :returns: number of copied bytes.
+    """
+    budget = ByteBudget(memory_budget)
+    readers = []
+    copied = 0
+    if prefetch:
+        output = Queue()
+        readers.append(threading.Thread(target=_fetch_slabs, args=(nc_in, jobs, budget, output)))
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        slabs = _queue_items(output, len(jobs))
+    else:
+        slabs = _read_slabs(nc_in, jobs, budget)
+    try:
+        for varname, write_slice, data, nbytes in slabs:
+            if data is None:
+                LOGGER.info('copied variable %s', varname)
+                nc_out.sync()  # flush data to disk
+                if committed is not None:
+                    committed(varname, None, 0)
+                continue
+            LOGGER.debug('copy %s [%s:%s]', varname, write_slice.start, write_slice.stop)
+            try:
+                if convert is not None:
+                    data = convert(varname, data)
+                if offset and write_slice.stop is not None:
+                    nc_out.variables[varname][write_slice.start + offset:write_slice.stop + offset] = data
+                else:
+                    nc_out.variables[varname][write_slice] = data
+            finally:
+                budget.release(nbytes)
+            copied = copied + nbytes
+            if committed is not None:
+                committed(varname, write_slice, nbytes)
+    finally:
+        # stop the readers if writing failed
+        budget.close()
+        for reader in readers:
+            reader.join()
+    return copied
+
+
+def nc_copy(source, target, overwrite=True, time_dimname='time', nchunk=None, istart=0, istop=-1,
+            format='NETCDF3_64BIT', memory_budget=None, prefetch=False, open_dataset=Dataset,
+            zlib=False, complevel=4, shuffle=True, chunking=None, start=None, end=None, bbox=None,
+            resume=False, monitor=None, variables=None):
+    """copy netcdf file from opendap to netcdf file
 
      :param overwrite:
 
@@ -139,13 +748,15 @@ def nc_copy(source, target, overwrite=True, time_dimname='time', nchunk=10, ista
 
      :param format:
 
-          netcdf3 format to use (NETCDF3_64BIT by default, can be set to NETCDF3_CLASSIC)
+          netcdf format to use (NETCDF3_64BIT by default, can be set to NETCDF3_CLASSIC,
+          NETCDF4_CLASSIC or NETCDF4). Compression and chunking need a NETCDF4 format.
 
-     :param chunk:
+     :param nchunk:
 
           number of records along unlimited dimension to
-          write at once. Default 10. Ignored if there is no unlimited
-          dimension. chunk=0 means write all the data at once.
+          write at once. By default it is derived from the memory budget
+          and the record size of each variable. Ignored if there is no unlimited
+          dimension. nchunk=0 means write all the data at once.
 
      :param istart:
 
@@ -156,74 +767,285 @@ def nc_copy(source, target, overwrite=True, time_dimname='time', nchunk=10, ista
 
           number of record to stop at along unlimited dimension.
           Default -1.  Ignored if there is no unlimited dimension.
+
+     :param memory_budget:
+
+          bytes of data held in memory. Default is ``nc_copy_memory_budget`` of the configuration.
+
+     :param prefetch:
+
+          read the next chunk on a background thread while the current chunk is written.
+          The budget is then shared by two chunks. Default False: netCDF-C and HDF5 are only
+          safe for concurrent reads and writes when they are built thread-safe, so enable it
+          only with such a build.
+
+     :param open_dataset:
+
+          function ``open_dataset(source, mode)`` used to open the source. Default ``netCDF4.Dataset``.
+
+     :param zlib, complevel, shuffle:
+
+          zlib compression of the variables, its level (1-9) and whether the shuffle filter is used.
+
+     :param chunking:
+
+          chunk shapes for an access pattern: ``timeseries`` (full time axis of a few grid cells)
+          or ``map`` (full grid of one time step). Default is the netcdf library default.
+
+     :param start, end:
+
+          date range (date strings, datetimes or dates of ``netCDF4.num2date``) of the copied time steps.
+          They are resolved with the units and calendar of the time coordinate and replace ``istart``/``istop``.
+
+     :param bbox:
+
+          tuple (min_lon, min_lat, max_lon, max_lat) of the copied region on a grid
+          with 1-d latitude and longitude coordinates. A region crossing the end of the longitude axis
+          (like -10 to 30 on a 0-360 grid) is read in two parts and joined, its longitudes
+          are shifted to increase like those of the bbox.
+
+     :param resume:
+
+          keep a checkpoint (``<target>.checkpoint``) of the written records of each variable
+          and continue an interrupted copy with the same options from the last written chunk.
+          The checkpoint is removed when the copy is complete.
+
+     :param monitor:
+
+          function ``monitor(message, progress)`` called with the progress (0-100) of the copy.
+
+     :param variables:
+
+          names of the copied variables. Their coordinate and bounds variables are copied as well.
+          Default is to copy all variables.
+
+     :returns: dict with the copied bytes (``nbytes``), the output ``file_size``,
+          the compression ``ratio``, the ``seconds`` spent copying data and the ``throughput`` (bytes/s).
     """
+    if (zlib or chunking) and not format.startswith('NETCDF4'):
+        raise ValueError("compression and chunking need a NETCDF4 format, not %s" % format)
+    memory_budget = memory_budget or config.nc_copy_memory_budget()
+    nc_in = open_dataset(source, 'r')
+    nc_out = None
+    try:
+        subset = {}
+        if variables:
+            variables = _selected_variables(nc_in, variables)
+        if start is not None or end is not None:
+            istart, istop = _time_range(nc_in.variables[time_dimname], start, end)
+            if istart == istop:
+                raise ValueError("no time steps between %s and %s" % (start, end))
+        convert = None
+        if bbox is not None:
+            subset = _bbox_subset(nc_in, bbox)
+            convert = _longitude_shift(nc_in, subset, bbox)
+        # check for unlimited dim.
+        unlimdimname = False
+        unlimdim = None
+        for dimname, dim in nc_in.dimensions.items():
+            if dim.isunlimited() or dimname == time_dimname:
+                unlimdimname = dimname
+                unlimdim = dim
+                if istop == -1:
+                    istop = len(unlimdim)
+                LOGGER.debug('unlimited dimension = %s, length = %d', unlimdimname, len(unlimdim))
 
-    nc_in = Dataset(source, 'r')
-    nc_out = Dataset(target, 'w', clobber=overwrite, format=format)
-
-    # create dimensions. Check for unlimited dim.
-    unlimdimname = False
-    unlimdim = None
-
-    # create global attributes.
-    LOGGER.info('copying global attributes ...')
-    nc_out.setncatts(nc_in.__dict__)
-    LOGGER.info('copying dimensions ...')
-    for dimname, dim in nc_in.dimensions.items():
-        if dim.isunlimited() or dimname == time_dimname:
-            unlimdimname = dimname
-            unlimdim = dim
-            if istop == -1:
-                istop = len(unlimdim)
-            nc_out.createDimension(dimname, istop - istart)
-            LOGGER.debug('unlimited dimension = %s, length = %d', unlimdimname, len(unlimdim))
-        else:
-            nc_out.createDimension(dimname, len(dim))
-
-    # create variables.
-    for varname, ncvar in nc_in.variables.items():
-        LOGGER.info('copying variable %s', varname)
-        # is there an unlimited dimension?
-        if unlimdimname and unlimdimname in ncvar.dimensions:
-            hasunlimdim = True
+        checkpoint = target + '.checkpoint'
+        checkpoint_key = dict(source=source, istart=istart, istop=istop, format=format,
+                              subset=dict((name, _index_key(index)) for name, index in subset.items()),
+                              variables=sorted(variables) if variables else None)
+        records = None
+        if resume and os.path.exists(target):
+            records = _load_checkpoint(checkpoint, checkpoint_key)
+        if records is not None:
+            LOGGER.info('resuming copy to %s', target)
+            nc_out = Dataset(target, 'a')
         else:
-            hasunlimdim = False
-        if hasattr(ncvar, '_FillValue'):
-            FillValue = ncvar._FillValue
-        else:
-            FillValue = None
-        var = nc_out.createVariable(varname, ncvar.dtype, ncvar.dimensions, fill_value=FillValue)
-        # fill variable attributes.
-        attdict = ncvar.__dict__
-        if '_FillValue' in attdict:
-            del attdict['_FillValue']
-        var.setncatts(attdict)
-        if hasunlimdim:  # has an unlim dim, loop over unlim dim index.
-            # range to copy
-            if nchunk:
-                start = istart
-                stop = istop
-                step = nchunk
-                if step < 1:
-                    step = 1
-                for n in range(start, stop, step):
-                    nmax = n + nchunk
-                    if nmax > istop:
-                        nmax = istop
-                    LOGGER.debug('copy chunk [%d:%d]', n, nmax)
-                    try:
-                        var[n - istart:nmax - istart] = ncvar[n:nmax]
-                    except Exception:
-                        msg = "n=%d nmax=%d istart=%d istop=%d" % (n, nmax, istart, istop)
-                        raise Exception(msg)
+            records = {}
+            nc_out = Dataset(target, 'w', clobber=overwrite, format=format)
+
+            # create global attributes.
+            LOGGER.info('copying global attributes ...')
+            nc_out.setncatts(dict((name, nc_in.getncattr(name)) for name in nc_in.ncattrs()))
+            LOGGER.info('copying dimensions ...')
+            for dimname, dim in nc_in.dimensions.items():
+                if dimname == unlimdimname:
+                    nc_out.createDimension(dimname, istop - istart)
+                elif dimname in subset:
+                    nc_out.createDimension(dimname, _index_size(subset[dimname], len(dim)))
+                else:
+                    nc_out.createDimension(dimname, len(dim))
+
+        # create variables. All variables are defined before copying data to avoid redefinitions.
+        slab_bytes = memory_budget // 2 if prefetch else memory_budget
+        jobs = []
+        total = 0
+        done = 0
+        for varname, ncvar in nc_in.variables.items():
+            if variables and varname not in variables:
+                continue
+            # is there an unlimited dimension?
+            if unlimdimname and unlimdimname in ncvar.dimensions:
+                hasunlimdim = True
+            else:
+                hasunlimdim = False
+            if varname not in nc_out.variables:
+                _define_variable(nc_out, varname, ncvar, unlimdimname,
+                                 zlib=zlib, complevel=complevel, shuffle=shuffle, chunking=chunking)
+            slabs = _slabs(ncvar, hasunlimdim, nchunk, istart, istop, slab_bytes, subset)
+            total = total + sum(slab[2] for slab in slabs)
+            # slabs up to the checkpoint are already in the output
+            committed = records.setdefault(varname, 0)
+            done = done + sum(slab[2] for slab in slabs if _slab_stop(slab[1]) <= committed)
+            slabs = [slab for slab in slabs if _slab_stop(slab[1]) > committed]
+            if slabs:
+                jobs.append((varname, slabs))
+        if resume:
+            nc_out.sync()
+            _save_checkpoint(checkpoint, checkpoint_key, records)
+
+        state = dict(done=done)
+
+        def committed(varname, write_slice, nbytes):
+            if write_slice is None:
+                message = 'copied variable %s' % varname
+            else:
+                state['done'] = state['done'] + nbytes
+                if resume:
+                    nc_out.sync()
+                    records[varname] = _slab_stop(write_slice)
+                    _save_checkpoint(checkpoint, checkpoint_key, records)
+                message = 'copied %s records %s:%s' % (varname, write_slice.start, write_slice.stop)
+            if monitor is not None:
+                monitor(message, state['done'] * 100.0 / max(total, 1))
+
+        started = time.time()
+        copied = _copy_slabs(nc_in, nc_out, jobs, memory_budget, prefetch=prefetch, convert=convert,
+                             committed=committed)
+    finally:
+        # close files.
+        if nc_out is not None:
+            nc_out.close()
+        nc_in.close()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    seconds = max(time.time() - started, 1e-6)
+    file_size = os.path.getsize(target)
+    stats = dict(nbytes=copied, file_size=file_size, seconds=seconds,
+                 ratio=float(total) / max(file_size, 1), throughput=copied / seconds)
+    LOGGER.info('copied %d bytes in %.1f s (%.1f MB/s), compression ratio %.2f',
+                copied, seconds, stats['throughput'] / 1e6, stats['ratio'])
+    return stats
+
+
+def _local_path(source):
+    if source.startswith('file://'):
+        return source[len('file://'):]
+    return source
+
+
+def _filename_order(source):
+    from malleefowl.esgf.search import date_from_filename
+    filename = os.path.basename(source)
+    return (date_from_filename(filename) or (0, 0), filename)
+
+
+def nc_concat(sources, target, time_dimname='time', format='NETCDF3_64BIT', memory_budget=None, prefetch=False,
+              monitor=None):
+    """
+    Concatenates netcdf files along the time dimension into one file.
+    The data is streamed with the chunked copy of :func:`nc_copy` within ``memory_budget``
+    and written directly at its position in the output.
+
+    The files are ordered by the time range in their filename
+    (see :func:`malleefowl.esgf.search.date_from_filename`). Variables without time dimension
+    are copied from the first file. Time values are converted to the units of the first file.
+
+    :param sources: list of netcdf files (paths or ``file://`` urls).
+    :param prefetch: read the next chunk while the current chunk is written (see :func:`nc_copy`).
+    :param monitor: optional function ``monitor(message, progress)``.
+    :returns: list of the sources in the order they were concatenated.
+    """
+    from netCDF4 import num2date, date2num
+    sources = sorted(sources, key=_filename_order)
+    memory_budget = memory_budget or config.nc_copy_memory_budget()
+    slab_bytes = memory_budget // 2 if prefetch else memory_budget
+
+    # time axis of each file
+    lengths = []
+    last = None
+    for source in sources:
+        nc_in = Dataset(_local_path(source), 'r')
+        try:
+            if time_dimname not in nc_in.dimensions:
+                raise ValueError("%s has no dimension %s" % (source, time_dimname))
+            times = nc_in.variables[time_dimname]
+            lengths.append(len(nc_in.dimensions[time_dimname]))
+            if lengths[-1] == 0:
+                continue
+            calendar = getattr(times, 'calendar', 'standard')
+            first, final = num2date(times[[0, -1]], times.units, calendar)
+            if last is not None and first <= last:
+                raise ValueError("time steps of %s overlap the previous file" % source)
+            last = final
+        finally:
+            nc_in.close()
+
+    nc_first = Dataset(_local_path(sources[0]), 'r')
+    nc_out = None
+    try:
+        nc_out = Dataset(target, 'w', format=format)
+        time_var = nc_first.variables[time_dimname]
+        units = time_var.units
+        calendar = getattr(time_var, 'calendar', 'standard')
+        time_vars = set([time_dimname] + getattr(time_var, 'bounds', '').split())
+        nc_out.setncatts(dict((name, nc_first.getncattr(name)) for name in nc_first.ncattrs()))
+        for dimname, dim in nc_first.dimensions.items():
+            if dimname == time_dimname:
+                nc_out.createDimension(dimname, sum(lengths))
             else:
-                var[0:istop - istart] = ncvar[:]
-        else:  # no unlim dim or 1-d variable, just copy all data at once.
-            var[:] = ncvar[:]
-        nc_out.sync()  # flush data to disk
-    # close files.
-    nc_out.close()
-    nc_in.close()
+                nc_out.createDimension(dimname, len(dim))
+        for varname, ncvar in nc_first.variables.items():
+            _define_variable(nc_out, varname, ncvar, time_dimname)
+    except Exception:
+        if nc_out is not None:
+            nc_out.close()
+        raise
+    finally:
+        nc_first.close()
+
+    try:
+        offset = 0
+        for index, source in enumerate(sources):
+            nc_in = Dataset(_local_path(source), 'r')
+            try:
+                source_units = nc_in.variables[time_dimname].units
+
+                def convert(varname, data):
+                    if varname in time_vars and source_units != units:
+                        return date2num(num2date(data, source_units, calendar), units, calendar)
+                    return data
+
+                jobs = []
+                for varname in nc_out.variables:
+                    outvar = nc_out.variables[varname]
+                    if time_dimname in outvar.dimensions:
+                        if varname not in nc_in.variables:
+                            raise ValueError("variable %s is missing in %s" % (varname, source))
+                        ncvar = nc_in.variables[varname]
+                        jobs.append((varname, _slabs(ncvar, True, None, 0, lengths[index], slab_bytes)))
+                    elif index == 0:
+                        jobs.append((varname, _slabs(nc_in.variables[varname], False, None, 0, -1, slab_bytes)))
+                _copy_slabs(nc_in, nc_out, jobs, memory_budget, prefetch=prefetch, offset=offset, convert=convert)
+            finally:
+                nc_in.close()
+            offset = offset + lengths[index]
+            LOGGER.info('concatenated %s', source)
+            if monitor is not None:
+                monitor('concatenated %s' % os.path.basename(source), (index + 1) * 100.0 / len(sources))
+    finally:
+        nc_out.close()
+    return sources
 
 
 class auto_list:
@@ -277,11 +1099,13 @@ class Monitor:
         """
         return copy.copy(self)
 
-    def update_status(self, message, progress=None):
+    def update_status(self, message, progress=None, verbose=False, flush=False):
         """
         Update the PyWPS status
         :param message: New message
         :param progress: New progress
+        :param verbose: Detailed message which is only written to the log
+        :param flush: Final or error state of a task which must not be delayed
         :return: None
         """
         pass
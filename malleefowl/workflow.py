@@ -153,6 +153,8 @@ class GenericWPS(MonitorPE):
 
 
 class EsgSearch(GenericWPS):
+    IDENTIFIER = 'esgsearch'
+
     def __init__(self, url,
                  search_url='https://esgf-data.dkrz.de/esg-search',
                  constraints='project:CORDEX',
@@ -164,8 +166,9 @@ class EsgSearch(GenericWPS):
                  latest=True,
                  temporal=False,
                  start=None,
-                 end=None):
-        GenericWPS.__init__(self, url, 'esgsearch', output='output')
+                 end=None,
+                 headers=None):
+        GenericWPS.__init__(self, url, self.IDENTIFIER, output='output', headers=headers)
         self.search_url = search_url
         self.constraints = constraints
         self.query = query
@@ -184,7 +187,8 @@ class EsgSearch(GenericWPS):
         if self.query:
             self.wps_inputs.append(('query', self.query))
         self.wps_inputs.append(('limit', str(self.limit)))
-        self.wps_inputs.append(('search_type', self.search_type))
+        if self.search_type is not None:
+            self.wps_inputs.append(('search_type', self.search_type))
         self.wps_inputs.append(('distrib', str(self.distrib)))
         self.wps_inputs.append(('replica', str(self.replica)))
         self.wps_inputs.append(('latest', str(self.latest)))
@@ -204,6 +208,18 @@ class EsgSearch(GenericWPS):
         return result
 
 
+class EsgSearchDownload(EsgSearch):
+    """
+    Runs the combined ESGF search and download process.
+    Files are downloaded while the search is running.
+    """
+    IDENTIFIER = 'esgsearch_download'
+
+    def __init__(self, url, **kwargs):
+        kwargs['search_type'] = None
+        EsgSearch.__init__(self, url, **kwargs)
+
+
 class SolrSearch(MonitorPE):
     """
     Run search against birdhouse solr index and return a list of download urls.
@@ -276,28 +292,24 @@ def esgf_workflow(source, worker, monitor=None, headers=None):
     graph = WorkflowGraph()
 
     # TODO: configure limit
-    esgsearch = EsgSearch(
+    esgsearch = EsgSearchDownload(
         url=wps_url(),
         search_url=source.get('url', 'https://esgf-data.dkrz.de/esg-search'),
         constraints=source.get('constraints', source.get('facets')),  # facets for backward compatibility
         query=source.get('query'),
         limit=source.get('limit', 100),
-        search_type='File',
         distrib=source.get('distrib'),
         replica=source.get('replica'),
         latest=source.get('latest'),
         temporal=source.get('temporal'),
         start=source.get('start'),
-        end=source.get('end'))
-    esgsearch.set_monitor(monitor, 0, 10)
-    download = Download(url=wps_url(), headers=headers)
-    download.set_monitor(monitor, 10, 50)
+        end=source.get('end'),
+        headers=headers)
+    esgsearch.set_monitor(monitor, 0, 50)
     doit = GenericWPS(headers=headers, **worker)
     doit.set_monitor(monitor, 50, 100)
 
-    graph.connect(esgsearch, esgsearch.OUTPUT_NAME,
-                  download, download.INPUT_NAME)
-    graph.connect(download, download.OUTPUT_NAME, doit, doit.INPUT_NAME)
+    graph.connect(esgsearch, esgsearch.OUTPUT_NAME, doit, doit.INPUT_NAME)
 
     result = simple_process.process_and_return(graph, inputs={esgsearch: [{}]})
 